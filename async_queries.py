@@ -0,0 +1,79 @@
+import asyncio
+
+from neo4j_connection import AsyncConnectionManager, run_query_async, DEFAULT_POOL_SIZE
+
+# Default maximum number of queries running at once in the database
+DEFAULT_CONCURRENCY = 8
+
+async def run_bounded(coroutines, max_concurrency=DEFAULT_CONCURRENCY):
+    '''
+    Run `coroutines` concurrently, at most `max_concurrency` at once (the others wait for a slot),
+    so that a long list of queries does not open as many transactions in the database.
+
+    Returns the list of their results, in the order of `coroutines`. A coroutine that raised an exception
+    gives the exception as its result, so that one failing query does not cancel the others.
+    '''
+
+    if max_concurrency < 1:
+        raise ValueError(f'run_bounded: max_concurrency must be at least 1, got {max_concurrency}')
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+async def send_async(cache, driver, query, fuzzy=False, top_k=None, rank_on_server=False, text=False):
+    '''
+    Same as `QueryService.send`, with the asyncio driver : compile the query (if `fuzzy`), send it, and rank the results.
+
+    The compilation and the ranking use the CPU, so they run in a worker thread, and the event loop
+    keeps sending the other queries meanwhile.
+
+    - cache          : the `QueryCache` used to compile the fuzzy queries ;
+    - driver         : an `AsyncConnectionManager` (or a neo4j async driver) ;
+    - query          : the query (crisp, or fuzzy if `fuzzy`) ;
+    - fuzzy          : if True, the query is compiled before being sent, and the results are ranked ;
+    - top_k          : with `fuzzy`, keep only the `top_k` best results ;
+    - rank_on_server : with `fuzzy`, compute the degrees in the database (see `reformulate_fuzzy_query`) ;
+    - text           : with `fuzzy`, return the result as text instead of a list of dicts.
+    '''
+
+    from process_results import process_results_to_dict, process_results_to_text, process_crisp_results_to_dict
+
+    if not fuzzy:
+        if rank_on_server or top_k is not None or text:
+            raise ValueError('send_async: top_k, rank_on_server and text can only be used with fuzzy queries')
+        return process_crisp_results_to_dict(await run_query_async(driver, query))
+
+    compiled_query = await asyncio.to_thread(cache.compile, query, True, rank_on_server, top_k if rank_on_server else None)
+    result = await run_query_async(driver, compiled_query.crisp_query, compiled_query.params, read_only=True)
+
+    process = process_results_to_text if text else process_results_to_dict
+    return await asyncio.to_thread(process, result, compiled_query.fuzzy_query, top_k)
+
+async def send_many_async(cache, driver, queries, max_concurrency=DEFAULT_CONCURRENCY, **options):
+    '''
+    Send independent queries concurrently (see `send_async` and `run_bounded`).
+
+    - queries : the list of queries ;
+    - options : the options of `send_async` (`fuzzy`, `top_k`, ...), the same for all the queries.
+
+    Returns the list of the results (or exceptions), in the order of `queries`.
+    '''
+
+    return await run_bounded((send_async(cache, driver, query, **options) for query in queries), max_concurrency)
+
+def send_many(cache, uri, user, password, queries, max_concurrency=DEFAULT_CONCURRENCY, max_pool_size=DEFAULT_POOL_SIZE, **options):
+    '''
+    Same as `send_many_async`, from synchronous code : the queries run on a new event loop,
+    with a connection manager opened for them.
+    '''
+
+    async def run():
+        async with AsyncConnectionManager(uri, user, password, max_pool_size) as driver:
+            return await send_many_async(cache, driver, queries, max_concurrency, **options)
+
+    return asyncio.run(run())
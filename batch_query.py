@@ -0,0 +1,80 @@
+import re
+
+from neo4j_connection import run_query
+from process_results import get_ordered_results_2, RankedSequences
+from query_budget import check_budget
+
+# Name of the parameter holding the rows of a batch (one per pattern), of the row variable, and of the pattern number returned
+BATCH_PARAMETER = 'patterns'
+ROW_VARIABLE = 'p'
+PATTERN_FIELD = 'pattern'
+
+# A string literal (kept as is) or a parameter
+PARAMETER_REGEX = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|\$(\w+)""")
+
+def make_batch_query(crisp_query):
+    '''
+    Return the batch version of a parameterized compiled query : it is run once per row of `$patterns`,
+    whose fields are the parameters of the query (`$d0` becomes `p.d0`), and returns the `pattern` number of its row.
+
+    The queries compiled from the notes of patterns with the same shape (number of notes, fuzzy parameters, ...)
+    have the same text, so they are run as one query : the database plans it once, in one round trip.
+    '''
+
+    if '\nORDER BY' in crisp_query:
+        raise ValueError('make_batch_query: the query can not be ranked by the database (a LIMIT can not depend on the row)')
+
+    def replace(match):
+        return match.group(1) or f'{ROW_VARIABLE}.{match.group(2)}'
+
+    body = PARAMETER_REGEX.sub(replace, crisp_query)
+    return f'UNWIND ${BATCH_PARAMETER} AS {ROW_VARIABLE}\n{body},\n{ROW_VARIABLE}.{PATTERN_FIELD} AS {PATTERN_FIELD}'
+
+def compile_batch(cache, queries, max_expansion=None):
+    '''
+    Compile fuzzy queries, and group them by shape.
+
+    - cache         : the `QueryCache` used to compile the queries ;
+    - queries       : the list of fuzzy queries ;
+    - max_expansion : the budget of each query (see `check_budget`), or None. A query above it is refused,
+                      as a LIMIT would apply to the rows of all the patterns of its batch.
+
+    Returns a list of (batch query, rows), one per shape : the rows are the parameters of the queries
+    of this shape, with their `pattern` number (their position in `queries`).
+    Also returns the list of the `CompiledQuery` of each query (used to rank its results).
+    '''
+
+    compiled_queries = [cache.compile(query, True) for query in queries]
+    for compiled_query in compiled_queries:
+        check_budget(compiled_query, max_expansion, 'refuse')
+
+    groups = {} # crisp query -> rows
+    for pattern, compiled_query in enumerate(compiled_queries):
+        row = dict(compiled_query.params, **{PATTERN_FIELD: pattern})
+        groups.setdefault(compiled_query.crisp_query, []).append(row)
+
+    return [(make_batch_query(crisp_query), rows) for crisp_query, rows in groups.items()], compiled_queries
+
+def run_batch(driver, batches, compiled_queries, top_k=None, timeout=None):
+    '''
+    Search several fuzzy queries at once : the queries of the same shape are sent as one query (see `make_batch_query`),
+    and the records are then split back by pattern and ranked.
+
+    - driver           : the neo4j driver (or connection manager) ;
+    - batches          : the batch queries with their rows, and
+    - compiled_queries : the `CompiledQuery` of each query, as returned by `compile_batch` ;
+    - top_k            : if not None, keep only the `top_k` best results of each query ;
+    - timeout          : the maximum duration of each batch in the database (in seconds), or None.
+
+    Returns the list of the ranked results of each query (`RankedSequences`), in the order of the queries.
+    '''
+
+    records = [[] for _ in compiled_queries]
+    for batch_query, rows in batches:
+        for record in run_query(driver, batch_query, {BATCH_PARAMETER: rows}, read_only=True, timeout=timeout):
+            records[record[PATTERN_FIELD]].append(record)
+
+    return [
+        RankedSequences(get_ordered_results_2(pattern_records, compiled_query.fuzzy_query, top_k))
+        for pattern_records, compiled_query in zip(records, compiled_queries)
+    ]
@@ -0,0 +1,387 @@
+import os
+
+import numpy as np
+
+def below(value):
+    '''Greatest float lower than `value` (to write a strict upper bound as a closed one).'''
+
+    return float(np.nextafter(value, -np.inf))
+
+def above(value):
+    '''Lowest float greater than `value` (to write a strict lower bound as a closed one).'''
+
+    return float(np.nextafter(value, np.inf))
+
+# Symbols of the contour strings, with the closed range [min ; max] of the values they stand for, following the thresholds
+# of `extract_contour_from_notes` (`*U` and `*D` are written `+` and `-`, to keep one character per NEXT relationship).
+MELODIC_CLASSES = {
+    '-': (float('-inf'), below(-2)), 'D': (-2, below(-1)), 'd': (-1, below(0)), 'R': (0, 0),
+    'u': (above(0), 1), 'U': (above(1), 2), '+': (above(2), float('inf'))
+}
+RHYTHMIC_CLASSES = { # 's' also holds ]1 ; 1.5[
+    'S': (float('-inf'), 0.25), 's': (above(0.25), below(1.5)), 'M': (1, 1), 'l': (1.5, below(4)), 'L': (4, float('inf'))
+}
+
+# Symbol of a NEXT relationship without value (rest, or last event of a voice). No pattern contains it.
+NULL_SYMBOL = 'X'
+
+# The suffixes are sorted on their first MAX_DEPTH symbols only : longer patterns are searched on their prefix.
+MAX_DEPTH = 64
+
+# When the rarest part of a pattern occurs at more than this fraction of the events, the index does not restrict the search
+# (reading the occurrences would then cost as much as checking all the events).
+MAX_CANDIDATE_RATIO = 0.05
+
+# Maximum number of suffix array ranges followed while searching a pattern with several symbols allowed by position.
+# Above, the search stops at the current prefix of the pattern (the candidates are then less restricted).
+MAX_RANGES = 4096
+
+class ContourIndex:
+    '''
+    Index of the contour string of the corpus : one symbol per event, for the value of its outgoing NEXT relationship
+    (see `extract_contour_from_notes`), and the suffix array of this string.
+
+    As the events of a voice are consecutive in the corpus (see `Corpus`), the position of a symbol is the index of its event,
+    and the `NULL_SYMBOL` of the last event of each voice prevents a pattern from spanning two voices.
+
+    A query is turned into a pattern of symbol sets (the symbols whose range meets the bounds of each NEXT relationship).
+    The pattern is split around the unconstrained relationships (`X` in a contour query), and the parts are searched
+    in the suffix array : the candidates are the first events of the query for which all the parts are found.
+    The matches are then verified by `CorpusMatcher` with the conditions of the query.
+    '''
+
+    field = None
+    name = None
+    classes = None
+
+    def __init__(self, text, suffixes):
+        '''
+        - text     : the contour string, as an array of bytes (one per event) ;
+        - suffixes : the suffix array of `text` (sorted on the first `MAX_DEPTH` symbols).
+        '''
+
+        self.text = text
+        self.suffixes = suffixes
+
+    #---Creation
+    def contour(self, values):
+        '''Return the contour string of `values` (array of the NEXT relationship values), as an array of bytes.'''
+
+        raise NotImplementedError
+
+    @classmethod
+    def build(cls, corpus):
+        '''Build the index of `corpus` (see `Corpus`).'''
+
+        index = cls(None, None)
+        text = index.contour(np.asarray(corpus.events[cls.field], dtype=float))
+        return cls(text, make_suffix_array(text))
+
+    #---Storage
+    def paths(self, path):
+        return [os.path.join(path, f'{self.name}_{table}.npy') for table in ('text', 'suffixes')]
+
+    def save(self, path):
+        '''Save the index in the corpus directory `path` (written aside and then renamed).'''
+
+        for table_path, table in zip(self.paths(path), (self.text, self.suffixes)):
+            tmp_path = os.path.join(os.path.dirname(table_path), '.' + os.path.basename(table_path) + '.tmp.npy')
+            np.save(tmp_path, table)
+            os.replace(tmp_path, table_path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load the index saved in the corpus directory `path`, or return None if there is none.
+
+        - mmap : if True, the files are memory-mapped (read only) instead of being read.
+        '''
+
+        paths = cls(None, None).paths(path)
+        if not all(os.path.exists(table_path) for table_path in paths):
+            return None
+        return cls(*(np.load(table_path, mmap_mode='r' if mmap else None) for table_path in paths))
+
+    #---Search
+    def symbol_set(self, low, high):
+        '''Return the symbols (bytes) whose range meets [low ; high], or None if it does not constrain the symbol.'''
+
+        symbols = [ord(symbol) for symbol, (min_value, max_value) in self.classes.items() if min_value <= high and low <= max_value]
+        if len(symbols) == len(self.classes):
+            return None
+        return symbols
+
+    def core_symbols(self, low, high):
+        '''
+        Return the symbols (bytes) of the values in [low ; high] (e.g the values of degree 1 of a condition) :
+        the symbol of the value if `low` = `high`, and otherwise the symbols whose range meets [low ; high].
+        '''
+
+        if low == high:
+            return [int(self.contour(np.array([low], dtype=float))[0])]
+        return [ord(symbol) for symbol, (min_value, max_value) in self.classes.items() if min_value <= high and low <= max_value]
+
+    def symbols_at(self, positions, depth):
+        '''Symbols at `depth` in the suffixes at `positions` of the suffix array (-1 after the end of the text).'''
+
+        indices = np.asarray(self.suffixes[np.minimum(positions, len(self.suffixes) - 1)]) + depth
+        inside = indices < len(self.text)
+        return np.where(inside, self.text[np.where(inside, indices, 0)], -1)
+
+    def bound(self, starts, ends, depth, symbol, strict):
+        '''
+        For each range [starts ; ends[ of the suffix array (suffixes sharing their first `depth` symbols), return the first
+        position whose symbol at `depth` is >= `symbol` (> `symbol` if `strict`), as a vectorized binary search.
+        '''
+
+        low, high = starts.copy(), ends.copy()
+        while (low < high).any():
+            middle = (low + high) // 2
+            values = self.symbols_at(middle, depth)
+            after = values <= symbol if strict else values < symbol
+            active = low < high
+            low = np.where(active & after, middle + 1, low)
+            high = np.where(active & ~after, middle, high)
+
+        return low
+
+    def ranges(self, part):
+        '''
+        Return the ranges (starts, ends) of the suffix array of the suffixes starting with `part` (a list of symbol sets).
+        Only the first `MAX_DEPTH` symbols are searched, and less if the search would follow more than `MAX_RANGES` ranges.
+        '''
+
+        starts, ends = np.array([0]), np.array([len(self.suffixes)])
+        for depth, symbols in enumerate(part[:MAX_DEPTH]):
+            narrowed_starts = np.concatenate([self.bound(starts, ends, depth, symbol, False) for symbol in symbols])
+            narrowed_ends = np.concatenate([self.bound(starts, ends, depth, symbol, True) for symbol in symbols])
+            found = narrowed_starts < narrowed_ends
+
+            if found.sum() > MAX_RANGES:
+                break
+            starts, ends = narrowed_starts[found], narrowed_ends[found]
+            if not len(starts):
+                break
+
+        return starts, ends
+
+    def candidates(self, bounds):
+        '''
+        Return the sorted events that can be the first event of a match, or None if the index can not restrict them.
+
+        - bounds : for each NEXT relationship of the query, the (low, high) bounds of its value, or None if it is not constrained.
+
+        The occurrences of the part of the pattern with the fewest occurrences are read from the suffix array,
+        and the other constrained symbols of the pattern are then checked directly in the text.
+        '''
+
+        if self.text is None or not len(self.text):
+            return None
+
+        pattern = [None if bound is None else self.symbol_set(*bound) for bound in bounds]
+
+        #---Split the pattern around the unconstrained relationships
+        parts = [] # (position in the query, symbol sets)
+        for position, symbols in enumerate(pattern):
+            if symbols is None:
+                continue
+            if parts and parts[-1][0] + len(parts[-1][1]) == position:
+                parts[-1][1].append(symbols)
+            else:
+                parts.append((position, [symbols]))
+
+        if not parts:
+            return None
+
+        #---Occurrences of the rarest part
+        rarest = None
+        for offset, part in parts:
+            starts, ends = self.ranges(part)
+            count = (ends - starts).sum()
+            if rarest is None or count < rarest[0]:
+                rarest = (count, offset, starts, ends)
+
+        count, offset, starts, ends = rarest
+        if not count:
+            return np.empty(0, dtype=np.int64)
+        if count > MAX_CANDIDATE_RATIO * len(self.text):
+            return None
+        candidates = np.unique(np.concatenate([self.suffixes[start:end] for start, end in zip(starts, ends)])) - offset
+        candidates = candidates[candidates >= 0]
+
+        #---Check the other symbols of the pattern
+        for position, symbols in enumerate(pattern):
+            if symbols is None or not len(candidates):
+                continue
+            indices = candidates + position
+            candidates = candidates[indices < len(self.text)]
+            allowed = np.zeros(256, dtype=bool)
+            allowed[symbols] = True
+            candidates = candidates[allowed[self.text[indices[indices < len(self.text)]]]]
+
+        return candidates
+
+def make_suffix_array(text, max_depth=MAX_DEPTH):
+    '''
+    Return the suffix array of `text` (array of bytes), sorted on the first `max_depth` symbols of the suffixes
+    (prefix doubling : the ranks of the suffixes on their first k symbols give the ranks on their first 2k symbols).
+    '''
+
+    nb_symbols = len(text)
+    ranks = np.asarray(text, dtype=np.int64)
+    order = np.argsort(ranks, kind='stable')
+
+    depth = 1
+    while depth < max_depth and nb_symbols:
+        # Rank of the second half of each suffix (-1 after the end of the text, so that a shorter suffix comes first)
+        next_ranks = np.full(nb_symbols, -1, dtype=np.int64)
+        next_ranks[:nb_symbols - depth] = ranks[depth:]
+
+        order = np.lexsort((next_ranks, ranks))
+        changes = (ranks[order][1:] != ranks[order][:-1]) | (next_ranks[order][1:] != next_ranks[order][:-1])
+        ranks = np.empty(nb_symbols, dtype=np.int64)
+        ranks[order] = np.concatenate(([0], np.cumsum(changes)))
+
+        depth *= 2
+        if ranks[order[-1]] == nb_symbols - 1: # All the suffixes are distinct
+            break
+
+    return order.astype(np.int64)
+
+def to_bytes(symbols):
+    '''Return the array of bytes of a list of one-character symbols.'''
+
+    return np.frombuffer(''.join(symbols).encode('ascii'), dtype=np.uint8).copy()
+
+class MelodicContourIndex(ContourIndex):
+    '''Index of the melodic contour (`NEXT.interval`, in tones), with the thresholds of `extract_contour_from_notes`.'''
+
+    field = 'interval'
+    name = 'melodic_contour_index'
+    classes = MELODIC_CLASSES
+
+    def contour(self, values):
+        with np.errstate(invalid='ignore'):
+            conditions = [np.isnan(values), values > 2, values > 1, values > 0, values == 0, values < -2, values < -1]
+        return to_bytes(np.select(conditions, [NULL_SYMBOL, '+', 'U', 'u', 'R', '-', 'D'], 'd'))
+
+class RhythmicContourIndex(ContourIndex):
+    '''Index of the rhythmic contour (`NEXT.duration_ratio`), with the thresholds of `extract_contour_from_notes`.'''
+
+    field = 'duration_ratio'
+    name = 'rhythmic_contour_index'
+    classes = RHYTHMIC_CLASSES
+
+    def contour(self, values):
+        with np.errstate(invalid='ignore'):
+            conditions = [np.isnan(values), values >= 4.0, values >= 1.5, values == 1.0, values <= 0.25]
+        return to_bytes(np.select(conditions, [NULL_SYMBOL, 'L', 'l', 'M', 'S'], 's'))
+
+def neighbour_symbols(classes, symbols):
+    '''Return the symbols (bytes) of `classes` next to one of `symbols` in the order of the classes, but not in `symbols`.'''
+
+    order = [ord(symbol) for symbol in classes]
+    neighbours = set()
+    for k, symbol in enumerate(order):
+        if symbol in symbols:
+            neighbours.update(order[max(k - 1, 0):k + 2])
+    return sorted(neighbours - set(symbols))
+
+def approximate_search(patterns, voice_offsets, max_substitutions=0, max_insertions=0):
+    '''
+    Approximate search of a contour pattern in the contour strings, with a bit-parallel automaton
+    (shift-and, with one state per number of errors as in Wu and Manber's agrep).
+
+    Bit j of the state (s, i) is set when the first j + 1 relationships of the pattern match the text ending at the current position,
+    with exactly s substitutions and i insertions.
+    A relationship of the text matches exactly when its symbol is one of the values of degree 1 of the condition (its core, e.g `u`
+    for `stepUp`, `M` for `sameDuration`), and not only of its support. The errors are :
+        - substitutions : a relationship of the text whose symbol is next to an exact one (e.g `R` or `U` for `u`, `S` or `M` for `s`) ;
+        - insertions    : relationships of the text skipped between two relationships of the pattern. They are plain edit-distance
+                          insertions : the interval (or duration ratio) of a skipped relationship is not added to the next one,
+                          and the durations of the events are not checked, so they do not follow the duration gap of the queries
+                          (e.g the pattern `U` does not match c -> d -> e (`uu`) with one insertion, while a gap query matches c -> e).
+
+    The text is read once : the voices are read in parallel (one state per voice for each number of errors),
+    so that there is one step per event of the longest voice.
+
+    - patterns          : list of (`ContourIndex`, bounds, cores), with the bounds of each NEXT relationship of the query (see `candidates`),
+                          and the bounds of its values of degree 1 (None if the same as the bounds).
+                          The bounds have the same length for all the indexes (at most 63) ;
+    - voice_offsets     : the first event of each voice, followed by the number of events (see `Corpus`) ;
+    - max_substitutions : the maximum number of substitutions ;
+    - max_insertions    : the maximum number of insertions in the whole match.
+
+    Returns (starts, ends, substitutions, insertions) : for each match, its first and last NEXT relationships (i.e events)
+    and its number of errors. A match is kept once, with its fewest substitutions.
+    '''
+
+    length = len(patterns[0][1])
+    if length == 0 or length > 63:
+        raise ValueError(f'approximate_search: the pattern must have between 1 and 63 relationships (got {length})')
+    # Otherwise, every window of the corpus would match without error
+    if all(bound is None for _, bounds, _ in patterns for bound in bounds):
+        raise ValueError('approximate_search: the pattern must constrain the interval or the duration ratio of at least one relationship')
+
+    #---Masks of the pattern positions allowed by each symbol (exactly, or with a substitution)
+    tables = []
+    for index, bounds, cores in patterns:
+        exact, near = np.zeros(256, dtype=np.uint64), np.zeros(256, dtype=np.uint64)
+        for position, (bound, core) in enumerate(zip(bounds, cores)):
+            bit = np.uint64(1 << position)
+            symbols = None if bound is None else index.symbol_set(*bound)
+            if symbols is None:
+                exact |= bit
+            else:
+                if core is not None:
+                    symbols = index.core_symbols(*core)
+                exact[symbols] |= bit
+                near[neighbour_symbols(index.classes, symbols)] |= bit
+        tables.append((index.text, exact, near))
+
+    one, final = np.uint64(1), np.uint64(1 << (length - 1))
+    # The last event of a voice has no NEXT relationship
+    firsts, ends = np.asarray(voice_offsets[:-1], dtype=np.int64), np.asarray(voice_offsets[1:], dtype=np.int64) - 1
+    nb_voices = len(firsts)
+    states = {(s, i): np.zeros(nb_voices, dtype=np.uint64) for s in range(max_substitutions + 1) for i in range(max_insertions + 1)}
+    hits = [] # (voice, position, substitutions, insertions)
+
+    for step in range(int((ends - firsts).max(initial=0))):
+        positions = firsts + step
+        active = positions < ends
+        positions = np.where(active, positions, 0)
+
+        exact_mask, near_mask = np.where(active, ~np.uint64(0), np.uint64(0)), np.where(active, ~np.uint64(0), np.uint64(0))
+        for text, exact, near in tables:
+            symbols = np.asarray(text[positions])
+            exact_mask &= exact[symbols]
+            near_mask &= exact[symbols] | near[symbols]
+        near_mask &= ~exact_mask
+
+        new_states = {}
+        for (s, i), state in states.items():
+            # A match starts (bit 0) in the states without insertion : exactly, or with a substitution
+            new_state = ((state << one) | np.uint64(s == 0 and i == 0)) & exact_mask
+            if s > 0:
+                new_state |= ((states[(s - 1, i)] << one) | np.uint64(s == 1 and i == 0)) & near_mask
+            if i > 0: # The symbol is inserted : the prefix does not change (not after the whole pattern)
+                new_state |= states[(s, i - 1)] & ~final & np.where(active, ~np.uint64(0), np.uint64(0))
+            new_states[(s, i)] = new_state
+
+            for voice in np.flatnonzero(new_state & final):
+                hits.append((voice, step, s, i))
+        states = new_states
+
+    #---Matches
+    best = {} # (start, end) -> (substitutions, insertions)
+    for voice, step, s, i in hits:
+        end = firsts[voice] + step
+        key = (end - (length - 1) - i, end)
+        if key not in best or s < best[key][0]:
+            best[key] = (s, i)
+
+    keys = sorted(best)
+    return (
+        np.array([key[0] for key in keys], dtype=np.int64), np.array([key[1] for key in keys], dtype=np.int64),
+        np.array([best[key][0] for key in keys], dtype=np.int64), np.array([best[key][1] for key in keys], dtype=np.int64)
+    )
@@ -0,0 +1,873 @@
+import os
+
+import numpy as np
+
+from note import Note
+from neo4j_connection import run_query
+from ngram_index import build_indexes
+from corpus_stats import CorpusStats, STATS_FILE
+from contour_index import ContourIndex, approximate_search
+from query_parser import parse_fuzzy_query, tokenize, KEYWORD
+from find_nearby_pitches import find_frequency_bounds
+from find_duration_range import find_duration_range_multiplicative_factor_sym
+from reformulation_V3 import split_note_accidental, get_max_hops
+from utils import calculate_intervals_list, calculate_dur_ratios_list
+
+# Queries used to export the graph (read only). The sources already in the corpus (`$sources`) are skipped.
+EXPORT_EVENTS_QUERY = '''
+MATCH (e:Event)
+WHERE NOT e.source IN $sources
+OPTIONAL MATCH (e)-[n:NEXT]->(next:Event)
+RETURN id(e) AS key, id(next) AS next_key, e.source AS source, e.start AS start, e.end AS end, e.duration AS duration,
+       e.dur AS dur, e.dots AS dots, e.id AS id, n.interval AS interval, n.duration_ratio AS duration_ratio
+ORDER BY source, start
+'''
+EXPORT_FACTS_QUERY = '''
+MATCH (e:Event)--(f:Fact)
+WHERE NOT e.source IN $sources
+RETURN id(e) AS event_key, f.class AS class, f.octave AS octave, f.accid AS accid, f.accid_ges AS accid_ges,
+       f.frequency AS frequency, f.halfTonesFromA4 AS halfTonesFromA4, f.duration AS duration, f.type AS type
+'''
+EXPORT_VOICES_QUERY = 'MATCH (:Voice)-[:timeSeries]->(e:Event) WHERE NOT e.source IN $sources RETURN DISTINCT id(e) AS key'
+EXPORT_COLLECTIONS_QUERY = '''
+MATCH (tp:TopRhythmic)-[:RHYTHMIC]->(:Measure)-[:HAS]->(e:Event)
+WHERE NOT e.source IN $sources
+RETURN id(e) AS key, tp.collection AS collection
+'''
+
+# Fields of the corpus, by kind : 'float' (NaN for null), 'int' (stored as float, NaN for null) or 'str' ('' for null).
+# The interval and duration ratio of an event are the ones of its outgoing NEXT relationship.
+EVENT_FIELDS = {
+    'source': 'str', 'start': 'float', 'end': 'float', 'duration': 'float', 'dur': 'int', 'dots': 'int', 'id': 'str',
+    'interval': 'float', 'duration_ratio': 'float', 'collection': 'str'
+}
+FACT_FIELDS = {
+    'class': 'str', 'octave': 'int', 'accid': 'str', 'accid_ges': 'str', 'frequency': 'float',
+    'halfTonesFromA4': 'float', 'duration': 'float', 'type': 'str'
+}
+EDGE_FIELDS = ('interval', 'duration_ratio')
+
+# Files of a corpus directory (one `.npy` file per table)
+CORPUS_TABLES = ('events', 'facts', 'voices', 'fact_offsets')
+
+# Number of records built at once by `CorpusMatcher.records`
+RECORD_CHUNK_SIZE = 10000
+
+# Margin added to the onset bound of the duration gap when looking for the next events (see `CorpusMatcher.next_events`)
+ONSET_TOLERANCE = 1e-9
+
+def make_column(values, kind):
+    '''Convert a list of values (None for null) to the array of a column of type `kind` (see `EVENT_FIELDS`).'''
+
+    if kind == 'str':
+        return np.array(['' if value is None else str(value) for value in values], dtype=str).reshape(len(values))
+    return np.array([np.nan if value is None else value for value in values], dtype=float).reshape(len(values))
+
+def make_table(columns):
+    '''
+    Build a structured array (fixed width records) from `columns`, a dict field -> array.
+    The strings are stored with the width of the longest one.
+    '''
+
+    dtype = [(field, column.dtype) for field, column in columns.items()]
+    table = np.empty(len(next(iter(columns.values()))), dtype=dtype)
+    for field, column in columns.items():
+        table[field] = column
+    return table
+
+def concatenate_tables(table_1, table_2):
+    '''Concatenate two structured arrays with the same fields (the strings are widened if needed).'''
+
+    columns = {field: np.concatenate((table_1[field], table_2[field])) for field in table_1.dtype.names}
+    return make_table(columns)
+
+def column_values(column, kind):
+    '''Convert a column back to a list of python values (with None for null), as returned by the driver.'''
+
+    values = column.tolist()
+    if kind == 'str':
+        return [value if value else None for value in values]
+    if kind == 'int':
+        return [None if value != value else int(value) for value in values]
+    return [None if value != value else value for value in values]
+
+def compare(column, operator, value):
+    '''
+    Evaluate `column operator value` with the cypher semantics : a comparison with null, or between
+    a number and a string, is not true.
+
+    - column   : a column of the corpus, or None if the attribute does not exist (null everywhere) ;
+    - operator : '=', '<>', '!=', '<', '>', '<=', '>=', 'IS' or 'IS NOT' (only with NULL) ;
+    - value    : the parsed value (see `parse_value`).
+    '''
+
+    if operator in ('IS', 'IS NOT'):
+        if value != 'NULL':
+            raise ValueError(f'compare: unsupported condition "{operator} {value}"')
+        if column is None:
+            return operator == 'IS'
+        exists = column != '' if column.dtype.kind == 'U' else ~np.isnan(column)
+        return ~exists if operator == 'IS' else exists
+
+    if column is None or (column.dtype.kind == 'U') != isinstance(value, str) or isinstance(value, bool) or value is None:
+        return False
+
+    exists = column != '' if column.dtype.kind == 'U' else ~np.isnan(column)
+    if operator == '=':
+        return exists & (column == value)
+    if operator in ('<>', '!='):
+        return exists & (column != value)
+    if operator == '<':
+        return exists & (column < value)
+    if operator == '>':
+        return exists & (column > value)
+    if operator == '<=':
+        return exists & (column <= value)
+    if operator == '>=':
+        return exists & (column >= value)
+
+    raise ValueError(f'compare: unsupported operator "{operator}"')
+
+class Corpus:
+    '''
+    The Event / Fact / NEXT graph, exported once into fixed width structured arrays.
+
+    - `events` : one record per event (see `EVENT_FIELDS`), with also its `voice` and `incipit` (first event of a Voice).
+                 The events of each voice (chain of NEXT relationships) are contiguous, so the event following `i`
+                 in its voice is `i + 1` ;
+    - `facts`  : one record per fact (see `FACT_FIELDS`), with also its `event`. The facts are sorted by event,
+                 the facts of the event `i` being `fact_offsets[i]:fact_offsets[i + 1]` (a chord has several facts) ;
+    - `voices` : the offset table, with the `source` and the index of the `first_event` of each voice.
+
+    On disk, a corpus is a directory with one `.npy` file per table, that can be memory-mapped : the processes
+    using the same corpus then share its pages instead of each loading a copy.
+    '''
+
+    def __init__(self, events, facts, voices, fact_offsets):
+        self.events = events
+        self.facts = facts
+        self.voices = voices
+        self.fact_offsets = fact_offsets
+
+        self.nb_events = len(events)
+        self.nb_facts = len(facts)
+        self.event_voices = events['voice'] # Voice of each event
+        self.fact_events = facts['event'] # Event of each fact
+        self.voice_offsets = np.append(voices['first_event'], self.nb_events)
+
+    def event_column(self, field):
+        '''Return the column `field` of the events, or None if there is no such field.'''
+
+        return self.events[field] if field in self.events.dtype.names else None
+
+    def fact_column(self, field):
+        '''Return the column `field` of the facts, or None if there is no such field.'''
+
+        return self.facts[field] if field in self.facts.dtype.names else None
+
+    def sources(self):
+        '''Return the list of the sources in the corpus.'''
+
+        return np.unique(self.voices['source']).tolist()
+
+    #---Creation
+    @classmethod
+    def from_rows(cls, event_rows, fact_rows, voice_keys=(), collection_rows=()):
+        '''
+        Build the corpus from the rows of the export queries.
+
+        - event_rows      : rows of `EXPORT_EVENTS_QUERY` (one per event, with the key of the next event) ;
+        - fact_rows       : rows of `EXPORT_FACTS_QUERY` ;
+        - voice_keys      : keys of the first events of the voices (`EXPORT_VOICES_QUERY`) ;
+        - collection_rows : rows of `EXPORT_COLLECTIONS_QUERY`.
+        '''
+
+        rows = {}
+        for row in event_rows:
+            rows.setdefault(row['key'], row) # An event with several NEXT relationships keeps the first one
+
+        #---Order the events by voice, following the NEXT relationships from the events without predecessor
+        has_previous = {row['next_key'] for row in rows.values() if row['next_key'] is not None}
+        order = []
+        voice_offsets = [0]
+        visited = set()
+        for starts in ([key for key in rows if key not in has_previous], list(rows)): # The second pass handles cycles
+            for key in starts:
+                if key in visited:
+                    continue
+                while key is not None and key in rows and key not in visited:
+                    visited.add(key)
+                    order.append(key)
+                    key = rows[key]['next_key']
+                voice_offsets.append(len(order))
+
+        index = {key: i for i, key in enumerate(order)}
+        voice_ends = set(voice_offsets[1:])
+        collections = {row['key']: row['collection'] for row in collection_rows}
+        voice_keys = set(voice_keys)
+
+        events = {}
+        for field, kind in EVENT_FIELDS.items():
+            if field == 'collection':
+                values = [collections.get(key) for key in order]
+            elif field in EDGE_FIELDS: # Only the NEXT relationship followed in the voice is kept
+                values = [rows[key][field] if i + 1 not in voice_ends else None for i, key in enumerate(order)]
+            else:
+                values = [rows[key][field] for key in order]
+            events[field] = make_column(values, kind)
+        events['voice'] = np.repeat(np.arange(len(voice_offsets) - 1), np.diff(voice_offsets))
+        events['incipit'] = np.array([key in voice_keys for key in order], dtype=bool).reshape(len(order))
+
+        voices = {
+            'source': events['source'][voice_offsets[:-1]],
+            'first_event': np.array(voice_offsets[:-1], dtype=np.int64)
+        }
+
+        #---Facts, sorted by event
+        fact_rows = sorted((row for row in fact_rows if row['event_key'] in index), key=lambda row: index[row['event_key']])
+        facts = {field: make_column([row[field] for row in fact_rows], kind) for field, kind in FACT_FIELDS.items()}
+        facts['event'] = np.array([index[row['event_key']] for row in fact_rows], dtype=np.int64).reshape(len(fact_rows))
+        fact_offsets = np.concatenate(([0], np.cumsum(np.bincount(facts['event'], minlength=len(order))))).astype(np.int64)
+
+        return cls(make_table(events), make_table(facts), make_table(voices), fact_offsets)
+
+    @classmethod
+    def export(cls, driver, known_sources=()):
+        '''
+        Export the graph of the database of `driver` (read only queries).
+
+        - known_sources : sources not to export (e.g the ones already in a corpus, see `update_corpus`).
+        '''
+
+        params = {'sources': list(known_sources)}
+        return cls.from_rows(
+            run_query(driver, EXPORT_EVENTS_QUERY, params, read_only=True),
+            run_query(driver, EXPORT_FACTS_QUERY, params, read_only=True),
+            [row['key'] for row in run_query(driver, EXPORT_VOICES_QUERY, params, read_only=True)],
+            run_query(driver, EXPORT_COLLECTIONS_QUERY, params, read_only=True)
+        )
+
+    def append(self, other):
+        '''Return a new corpus with the voices of `self` followed by the ones of `other`.'''
+
+        events = other.events.copy()
+        events['voice'] += len(self.voices)
+        facts = other.facts.copy()
+        facts['event'] += self.nb_events
+        voices = other.voices.copy()
+        voices['first_event'] += self.nb_events
+
+        return Corpus(
+            concatenate_tables(self.events, events),
+            concatenate_tables(self.facts, facts),
+            concatenate_tables(self.voices, voices),
+            np.concatenate((self.fact_offsets[:-1], other.fact_offsets + self.nb_facts))
+        )
+
+    #---Storage
+    def save(self, path):
+        '''
+        Save the corpus in the directory `path` (one `.npy` file per table).
+        Each file is written aside and then renamed, so the processes that have mapped the previous files keep reading them.
+        '''
+
+        os.makedirs(path, exist_ok=True)
+        for name in CORPUS_TABLES:
+            tmp_path = os.path.join(path, f'.{name}.tmp.npy')
+            np.save(tmp_path, getattr(self, name))
+            os.replace(tmp_path, os.path.join(path, f'{name}.npy'))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load the corpus saved in the directory `path`.
+
+        - mmap : if True, the files are memory-mapped (read only) instead of being read.
+        '''
+
+        tables = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None) for name in CORPUS_TABLES]
+        return cls(*tables)
+
+    #---Notes
+    def facts_of(self, events):
+        '''
+        Return the facts of `events` (array of event indices), and for each of them, its position in `events`.
+        '''
+
+        counts = self.fact_offsets[events + 1] - self.fact_offsets[events]
+        firsts = np.cumsum(counts) - counts
+        facts = np.repeat(self.fact_offsets[events] - firsts, counts) + np.arange(counts.sum())
+        return facts, np.repeat(np.arange(len(events)), counts)
+
+    def get_notes(self, source, start_time, end_time):
+        '''Same as `get_notes_from_source_and_time_interval`, from the corpus.'''
+
+        notes = []
+        for voice in np.flatnonzero(self.voices['source'] == source):
+            first, last = self.voice_offsets[voice], self.voice_offsets[voice + 1]
+            events = first + np.flatnonzero((self.events['start'][first:last] >= start_time) & (self.events['end'][first:last] <= end_time))
+            facts, positions = self.facts_of(events)
+            events = events[positions]
+
+            columns = [column_values(self.facts[field][facts], FACT_FIELDS[field]) for field in ('class', 'octave')]
+            columns += [column_values(self.events[field][events], EVENT_FIELDS[field]) for field in ('dur', 'dots', 'start', 'end')]
+            for pitch, octave, dur, dots, start, end in zip(*columns):
+                notes.append(Note(pitch, octave, dur, dots, None, start, end))
+
+        notes.sort(key=lambda note: note.start)
+        return notes
+
+    def __repr__(self):
+        return f'Corpus({len(self.voices)} voices, {self.nb_events} events, {self.nb_facts} facts)'
+
+def update_corpus(path, driver):
+    '''
+    Add the sources of the database that are not yet in the corpus of the directory `path`
+    (e.g after loading new dumps with `execute_cypher_dumps`). The corpus is created if needed,
+    and its n-gram indexes (see `ngram_index`) and statistics (see `corpus_stats`) are rebuilt.
+
+    Returns the updated corpus.
+    '''
+
+    if not os.path.exists(os.path.join(path, 'events.npy')):
+        corpus = Corpus.export(driver)
+    else:
+        corpus = Corpus.load(path)
+        new_corpus = Corpus.export(driver, corpus.sources())
+        if new_corpus.nb_events == 0:
+            return corpus
+        corpus = corpus.append(new_corpus)
+
+    corpus.save(path)
+    build_indexes(corpus, path)
+    CorpusStats.from_corpus(corpus).save(os.path.join(path, STATS_FILE))
+    return corpus
+
+class CorpusMatcher:
+    '''
+    Executes a fuzzy query on a `Corpus`, without cypher.
+
+    The matches are the same as the ones of the query compiled by `reformulate_fuzzy_query` : the conditions
+    of its WHERE clause are evaluated as array operations over all the facts (pitch, duration, membership supports),
+    or all the NEXT relationships (interval, duration ratio). The matches are then built note by note : the
+    partial matches (one fact per searched note) are extended to the next events of their voice (the next one,
+    or the ones starting within the duration gap), and filtered with the masks of the next note.
+
+    The records have the same fields as the ones returned by the compiled query, so they can be ranked by `get_ordered_results_2`.
+
+    With n-gram indexes (see `ngram_index`), the first events of the matches are restricted beforehand to the candidates
+    given by the indexes for the bounds of the NEXT relationships, and only these candidates are extended and verified.
+
+    Only the patterns written by `create_query_from_list_of_notes` and `create_query_from_contour` are supported :
+    a chain of events linked by NEXT, one fact per event, optionally the voice (incipit) and the collection of the first event.
+    '''
+
+    def __init__(self, corpus, query, indexes=()):
+        '''
+        - corpus  : the `Corpus` ;
+        - query   : the fuzzy query (string or `FuzzyQuery`) ;
+        - indexes : the n-gram indexes of the corpus (see `load_indexes`), used to find the candidate matches.
+        '''
+
+        self.corpus = corpus
+        self.indexes = indexes
+        self.query = parse_fuzzy_query(query)
+        self.pitch_distance, self.duration_factor, self.duration_gap, self.alpha, self.allow_transposition, self.allow_homothety = self.query.fuzzy_parameters()
+
+        notes = self.query.notes
+        self.event_nodes = [node_name for node_name, attrs in notes.items() if attrs.get('type') == 'Event']
+        self.fact_nodes = [node_name for node_name, attrs in notes.items() if attrs.get('type') == 'Fact']
+        if not self.event_nodes or len(self.event_nodes) != len(self.fact_nodes):
+            raise ValueError('CorpusMatcher: the query must have one Fact for each Event')
+        self.nb_notes = len(self.event_nodes)
+
+        # Position of each variable in the searched sequence : `('event' | 'fact' | 'edge', idx)`, or `(label, None)`
+        self.variables = {node_name: ('event', idx) for idx, node_name in enumerate(self.event_nodes)}
+        self.variables.update({node_name: ('fact', idx) for idx, node_name in enumerate(self.fact_nodes)})
+        self.collection_positions = {} # TopRhythmic variable -> positions of the events in its measures
+        self.read_patterns()
+
+        #---Masks of the conditions
+        self.fact_masks = [np.ones(corpus.nb_facts, dtype=bool) for _ in range(self.nb_notes)]
+        self.edge_masks = [np.ones(corpus.nb_events, dtype=bool) for _ in range(self.nb_notes - 1)]
+        self.pair_conditions = [[] for _ in range(self.nb_notes - 1)] # Conditions between consecutive notes (with a duration gap)
+        # (low, high) of the NEXT relationships (between consecutive notes with a duration gap), for the indexes,
+        # and (low, high) of their values of degree 1, for the approximate search
+        self.edge_bounds = {field: [None] * (self.nb_notes - 1) for field in EDGE_FIELDS}
+        self.edge_cores = {field: [None] * (self.nb_notes - 1) for field in EDGE_FIELDS}
+
+        if self.duration_gap > 0:
+            self.max_hops = get_max_hops(self.duration_gap) # As in `create_match_clause`
+        else:
+            self.max_hops = 1
+
+        self.add_note_conditions()
+        self.add_membership_conditions()
+        self.add_other_conditions()
+
+
+    #---Query structure
+    def read_patterns(self):
+        '''Check the patterns of the MATCH clause, and read the positions constrained to be an incipit, or in a collection.'''
+
+        notes = self.query.notes
+        self.incipit_positions = set()
+        measure_positions = {} # Measure variable -> positions of the events it has
+        measures = {} # TopRhythmic variable -> Measure variables
+
+        for pattern in self.query.patterns:
+            if '<-' in pattern.text:
+                raise ValueError(f'CorpusMatcher: unsupported pattern "{pattern.text}"')
+
+            elements = pattern.elements
+            for k, element in enumerate(elements[:-1]):
+                if not element.is_node:
+                    continue
+
+                # `(a)-[r]->(b)`, or `(a)--(b)` (no relationship element)
+                relationship = None if elements[k + 1].is_node else elements[k + 1]
+                other = elements[k + 1] if relationship is None else elements[k + 2]
+                label = None if relationship is None else relationship.label
+
+                kind_1, position_1 = self.variables.get(element.variable, (notes.get(element.variable, {}).get('type'), None))
+                kind_2, position_2 = self.variables.get(other.variable, (notes.get(other.variable, {}).get('type'), None))
+
+                if (kind_1, label, kind_2) == ('event', 'NEXT', 'event') and position_2 == position_1 + 1:
+                    if relationship.variable:
+                        self.variables[relationship.variable] = ('edge', position_1)
+                elif {kind_1, kind_2} == {'event', 'fact'} and label is None and position_1 == position_2:
+                    pass
+                elif (kind_1, label, kind_2) == ('Voice', 'timeSeries', 'event'):
+                    self.incipit_positions.add(position_2)
+                elif (kind_1, label, kind_2) == ('Measure', 'HAS', 'event'):
+                    measure_positions.setdefault(element.variable, set()).add(position_2)
+                elif (kind_1, label, kind_2) == ('TopRhythmic', 'RHYTHMIC', 'Measure'):
+                    self.variables[element.variable] = ('TopRhythmic', None)
+                    measures.setdefault(element.variable, set()).add(other.variable)
+                else:
+                    raise ValueError(f'CorpusMatcher: unsupported pattern "{pattern.text}"')
+
+        self.collection_positions = {
+            top_rhythmic: set().union(*(measure_positions.get(measure, set()) for measure in measure_variables))
+            for top_rhythmic, measure_variables in measures.items()
+        }
+
+    def column(self, variable, attribute):
+        '''
+        Return `(kind, position, column)` for `variable.attribute`, where `kind` is 'fact', 'event' or 'edge'.
+        The column is None if the attribute is not in the corpus (it is then null everywhere).
+        '''
+
+        kind, position = self.variables.get(variable, (None, None))
+        if kind == 'fact':
+            return kind, position, self.corpus.fact_column(attribute) if attribute != 'event' else None
+        if kind == 'event':
+            return kind, position, self.corpus.event_column(attribute) if attribute not in EDGE_FIELDS + ('collection', 'voice', 'incipit') else None
+        if kind == 'edge':
+            if self.duration_gap > 0: # The NEXT relationships are not named in the compiled query (see `create_match_clause`)
+                raise ValueError(f'CorpusMatcher: {variable}.{attribute} cannot be used with a duration gap')
+            return kind, position, self.corpus.events[attribute] if attribute in EDGE_FIELDS else None
+
+        raise ValueError(f'CorpusMatcher: unsupported condition on "{variable}.{attribute}"')
+
+    def add_mask(self, kind, position, mask):
+        '''Restrict the matches with `mask`, a boolean array over the facts, the events or the NEXT relationships (`kind`).'''
+
+        if kind == 'fact':
+            self.fact_masks[position] &= mask
+        elif kind == 'event':
+            self.fact_masks[position] &= mask[self.corpus.fact_events] if isinstance(mask, np.ndarray) else mask
+        else:
+            self.edge_masks[position] &= mask
+
+    def add_edge_bounds(self, field, position, low, high, core):
+        '''
+        Record that `field` of the NEXT relationship `position` is in [low ; high] (used to query the indexes),
+        with a membership degree of 1 in `core` = (low, high) (used by the approximate search).
+        '''
+
+        for table, (new_low, new_high) in ((self.edge_bounds, (low, high)), (self.edge_cores, core)):
+            bounds = table[field][position]
+            if bounds is not None:
+                new_low, new_high = max(new_low, bounds[0]), min(new_high, bounds[1])
+            table[field][position] = (new_low, new_high)
+
+    #---Conditions
+    def add_note_conditions(self):
+        '''Conditions on the searched notes, as in `create_where_clause`.'''
+
+        notes = self.query.notes
+        facts = self.corpus.facts
+        alpha = self.alpha
+
+        if self.allow_transposition:
+            intervals = calculate_intervals_list(notes)
+        if self.allow_homothety:
+            dur_ratios = calculate_dur_ratios_list(notes)
+
+        for idx, f_node in enumerate(self.fact_nodes):
+            attrs = notes[f_node]
+            last = idx == self.nb_notes - 1
+
+            # Duration (see `make_duration_condition`) or duration ratio (see `make_duration_ratio_condition`)
+            if self.allow_homothety:
+                if not last and dur_ratios[idx] is not None:
+                    duration_factor = 1.0 / self.duration_factor if self.duration_factor < 1 else self.duration_factor
+                    if duration_factor > 1:
+                        bounds = find_duration_range_multiplicative_factor_sym(dur_ratios[idx], duration_factor, alpha)
+                    else:
+                        bounds = (dur_ratios[idx], dur_ratios[idx])
+
+                    self.add_edge_bounds('duration_ratio', idx, *bounds, (dur_ratios[idx], dur_ratios[idx]))
+                    if self.duration_gap > 0:
+                        self.pair_conditions[idx].append(('duration_ratio', bounds))
+                    else:
+                        ratios = self.corpus.events['duration_ratio']
+                        self.add_mask('edge', idx, (bounds[0] <= ratios) & (ratios <= bounds[1]))
+
+            elif attrs.get('dur') is not None:
+                duration = 1.0 / attrs['dur']
+                if attrs.get('dots'):
+                    duration = duration * 1.5
+
+                if self.duration_factor != 1:
+                    min_duration, max_duration = find_duration_range_multiplicative_factor_sym(duration, self.duration_factor, alpha)
+                    self.add_mask('fact', idx, (facts['duration'] >= min_duration) & (facts['duration'] <= max_duration))
+                else:
+                    self.add_mask('fact', idx, facts['duration'] == duration)
+
+            # Interval (see `make_interval_condition`) or pitch (see `make_pitch_condition`)
+            if self.allow_transposition:
+                if not last and intervals[idx] != 'NA':
+                    interval = intervals[idx]
+                    if interval is None:
+                        bounds = None
+                    elif self.pitch_distance > 0:
+                        bounds = (interval - self.pitch_distance * (1 - alpha), interval + self.pitch_distance * (1 - alpha))
+                    else:
+                        bounds = (interval, interval)
+
+                    if bounds is not None:
+                        self.add_edge_bounds('interval', idx, *bounds, (interval, interval))
+                    if self.duration_gap > 0:
+                        self.pair_conditions[idx].append(('interval', bounds))
+                    else:
+                        intervals_column = self.corpus.events['interval']
+                        if bounds is None:
+                            self.add_mask('edge', idx, np.isnan(intervals_column))
+                        else:
+                            self.add_mask('edge', idx, (bounds[0] <= intervals_column) & (intervals_column <= bounds[1]))
+
+            else:
+                self.add_pitch_condition(idx, attrs.get('class'), attrs.get('octave'))
+
+            # Sequencing (see `make_sequencing_condition`)
+            if self.duration_gap > 0 and not last:
+                self.pair_conditions[idx].append(('sequencing', self.duration_gap * (1 - alpha)))
+
+        for position in self.incipit_positions:
+            self.add_mask('event', position, self.corpus.events['incipit'])
+
+    def add_pitch_condition(self, idx, pitch, octave):
+        '''Pitch condition of the note `idx` (see `make_pitch_condition`).'''
+
+        facts = self.corpus.facts
+
+        if pitch is None:
+            if octave is not None:
+                self.add_mask('fact', idx, compare(facts['octave'], '=', octave))
+
+        elif self.pitch_distance == 0 or pitch == 'r':
+            if pitch == 'r':
+                self.add_mask('fact', idx, facts['type'] == 'rest')
+            else:
+                base_note, accidental = split_note_accidental(pitch)
+                self.add_mask('fact', idx, facts['class'] == base_note)
+                if accidental:
+                    self.add_mask('fact', idx, (facts['accid'] == accidental) | (facts['accid_ges'] == accidental))
+                else:
+                    self.add_mask('fact', idx, facts['accid'] == '')
+                if octave is not None:
+                    self.add_mask('fact', idx, compare(facts['octave'], '=', octave))
+
+        else:
+            low_frequency, high_frequency = find_frequency_bounds(pitch, 4 if octave is None else octave, self.pitch_distance, self.alpha)
+            self.add_mask('fact', idx, (low_frequency <= facts['frequency']) & (facts['frequency'] <= high_frequency))
+
+    def add_membership_conditions(self):
+        '''The attributes with a membership function must be in its support (as in `create_where_clause`).'''
+
+        support_intervals = self.query.membership_function_support_intervals()
+        core_intervals = self.query.membership_function_core_intervals()
+
+        for node_name, attribute_name, membership_function_name in self.query.attributes_with_membership_functions:
+            min_value, max_value = support_intervals[membership_function_name]
+            kind, position, column = self.column(node_name, attribute_name)
+
+            if min_value != float('-inf'):
+                self.add_mask(kind, position, compare(column, '>', min_value))
+            if max_value != float('inf'):
+                self.add_mask(kind, position, compare(column, '<', max_value))
+            if kind == 'edge' and attribute_name in EDGE_FIELDS: # Strict bounds, as the closest floats inside
+                low = min_value if min_value == float('-inf') else np.nextafter(min_value, np.inf)
+                high = max_value if max_value == float('inf') else np.nextafter(max_value, -np.inf)
+                self.add_edge_bounds(attribute_name, position, low, high, core_intervals[membership_function_name])
+
+    def add_other_conditions(self):
+        '''The other conditions of the WHERE clause, that must be simple comparisons (`x.attr op value`).'''
+
+        for condition in self.query.conditions:
+            # Handled by `add_note_conditions` and `add_membership_conditions`
+            if condition.operator == '=' and condition.attribute.lower() in ('class', 'octave', 'dur', 'interval', 'dots'):
+                continue
+            if condition.membership_function is not None:
+                continue
+
+            if condition.variable is None or any(token[KEYWORD] in ('AND', 'OR', 'XOR', 'NOT') for token in tokenize(condition.text)[3:]):
+                raise ValueError(f'CorpusMatcher: unsupported condition "{condition.text}"')
+
+            if self.variables.get(condition.variable, (None, None))[0] == 'TopRhythmic':
+                if condition.attribute != 'collection':
+                    raise ValueError(f'CorpusMatcher: unsupported condition "{condition.text}"')
+                mask = compare(self.corpus.events['collection'], condition.operator, condition.value)
+                for position in self.collection_positions.get(condition.variable, ()):
+                    self.add_mask('event', position, mask)
+                continue
+
+            kind, position, column = self.column(condition.variable, condition.attribute)
+            self.add_mask(kind, position, compare(column, condition.operator, condition.value))
+
+    def pair_mask(self, idx, previous_facts, facts):
+        '''Mask of the conditions between the note `idx` (`previous_facts`) and the note `idx + 1` (`facts`), with a duration gap.'''
+
+        corpus = self.corpus
+        mask = np.ones(len(facts), dtype=bool)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for kind, bounds in self.pair_conditions[idx]:
+                if kind == 'sequencing':
+                    events = corpus.events
+                    mask &= events['end'][corpus.fact_events[previous_facts]] >= events['start'][corpus.fact_events[facts]] - bounds
+                    continue
+
+                if kind == 'interval':
+                    half_tones = corpus.facts['halfTonesFromA4']
+                    values = (half_tones[facts] - half_tones[previous_facts]) / 2
+                else:
+                    durations = corpus.facts['duration']
+                    values = durations[facts] / durations[previous_facts]
+
+                if bounds is None: # Rest : one of the facts has no pitch
+                    mask &= np.isnan(values)
+                else:
+                    mask &= (bounds[0] <= values) & (values <= bounds[1])
+
+        return mask
+
+    #---Matching
+    def candidate_events(self):
+        '''
+        Return the sorted events that can be the first event of a match according to the indexes,
+        or None if they do not restrict them (no index, no usable bounds, or a duration gap).
+        '''
+
+        if self.duration_gap > 0: # The notes are not on consecutive NEXT relationships
+            return None
+
+        candidates = None
+        for index in self.indexes:
+            starts = index.candidates(self.edge_bounds[index.field])
+            if starts is not None:
+                candidates = starts if candidates is None else np.intersect1d(candidates, starts, assume_unique=True)
+
+        return candidates
+
+    def match(self):
+        '''
+        Return the matches, as an array with one row per match and one column per searched note,
+        holding the index of the matched fact.
+        '''
+
+        corpus = self.corpus
+
+        candidates = self.candidate_events()
+        if candidates is None:
+            rows = np.flatnonzero(self.fact_masks[0])
+        else:
+            facts, _ = corpus.facts_of(candidates[candidates < corpus.nb_events])
+            rows = facts[self.fact_masks[0][facts]]
+        rows = rows.reshape(-1, 1)
+
+        for idx in range(1, self.nb_notes):
+            previous_facts = rows[:, -1]
+            parents, events = self.next_events(idx - 1, corpus.fact_events[previous_facts])
+
+            # All the facts of these events (several for a chord)
+            facts, positions = corpus.facts_of(events)
+            parents = parents[positions]
+
+            keep = self.fact_masks[idx][facts]
+            if self.duration_gap > 0:
+                keep &= self.pair_mask(idx - 1, previous_facts[parents], facts)
+
+            rows = np.column_stack((rows[parents[keep]], facts[keep]))
+            if not len(rows):
+                break
+
+        return rows
+
+    def next_events(self, idx, previous_events):
+        '''
+        Return (parents, events) : the events that can follow the events `previous_events` of the note `idx`,
+        with for each of them the position of its previous event in `previous_events`.
+
+        Without duration gap, it is the next event of the voice, if the NEXT relationship matches.
+        With a duration gap, the events are found by onset time rather than by hop count : they are the events
+        of the voice starting before the end of the previous one plus the gap (see `make_sequencing_condition`),
+        found by binary search on the start times of the voice (at most `max_hops` of them, as in `create_match_clause`).
+        '''
+
+        corpus = self.corpus
+        voice_ends = corpus.voice_offsets[corpus.event_voices[previous_events] + 1]
+
+        if self.duration_gap == 0:
+            parents = np.flatnonzero((previous_events + 1 < voice_ends) & self.edge_masks[idx][previous_events])
+            return parents, previous_events[parents] + 1
+
+        # The sequencing condition is checked exactly by `pair_mask` : the bound is only slightly widened against rounding
+        limits = np.asarray(corpus.events['end'])[previous_events] + self.duration_gap * (1 - self.alpha) + ONSET_TOLERANCE
+        window_ends = search_sorted_ranges(corpus.events['start'], previous_events + 1, voice_ends, limits)
+        counts = np.minimum(window_ends - previous_events - 1, self.max_hops)
+
+        parents = np.repeat(np.arange(len(previous_events)), counts)
+        hops = np.arange(len(parents)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        return parents, previous_events[parents] + hops
+
+    def approximate_matches(self, max_substitutions=0, max_insertions=0):
+        '''
+        Return the approximate matches of the conditions on the NEXT relationships (interval, duration ratio),
+        searched in the contour strings of the indexes (see `approximate_search`), as a list of dicts
+        `{source, start, end, substitutions, insertions}`, sorted by number of errors.
+
+        The other conditions (pitch, duration, collection) are not checked, except the incipit.
+
+        - max_substitutions : the maximum number of relationships matched by a neighbouring contour symbol ;
+        - max_insertions    : the maximum number of relationships skipped in the whole match. They are edit-distance insertions
+                              (see `approximate_search`), not the events allowed by a duration gap.
+
+        The contour strings only hold the relationships between consecutive events : a query with a duration gap is refused
+        (rather than searched as a query without gap).
+        '''
+
+        if self.duration_gap > 0:
+            raise ValueError('CorpusMatcher: the approximate search does not support a duration gap (use --insertions to skip relationships)')
+        patterns = [
+            (index, self.edge_bounds[index.field], self.edge_cores[index.field]) for index in self.indexes if isinstance(index, ContourIndex)
+        ]
+        if not patterns:
+            raise ValueError('CorpusMatcher: the approximate search needs the contour indexes of the corpus (see `build_indexes`)')
+        corpus = self.corpus
+        starts, ends, substitutions, insertions = approximate_search(patterns, corpus.voice_offsets, max_substitutions, max_insertions)
+        if 0 in self.incipit_positions:
+            keep = np.asarray(corpus.events['incipit'])[starts]
+            starts, ends, substitutions, insertions = starts[keep], ends[keep], substitutions[keep], insertions[keep]
+
+        events = corpus.events
+        matches = [
+            {'source': str(events['source'][start]), 'start': float(events['start'][start]), 'end': float(events['end'][end + 1]),
+             'substitutions': int(s), 'insertions': int(i)}
+            for start, end, s, i in zip(starts, ends, substitutions, insertions)
+        ]
+        matches.sort(key=lambda match: (match['substitutions'] + match['insertions'], match['source'], match['start']))
+        return matches
+
+    def records(self, chunk_size=RECORD_CHUNK_SIZE):
+        '''
+        Yield the matches as records (dicts), with the same fields as the records of the compiled query (see `create_return_clause`).
+        The records are built `chunk_size` at a time, so that they can be ranked while they are produced.
+        '''
+
+        rows = self.match()
+        if rows.shape[1] < self.nb_notes:
+            return
+
+        for start in range(0, len(rows), chunk_size):
+            columns = self.record_columns(rows[start:start + chunk_size])
+            keys = list(columns)
+            for values in zip(*columns.values()):
+                yield dict(zip(keys, values))
+
+    def record_columns(self, rows):
+        '''Return the fields of the records of the matches `rows`, as a dict alias -> list of values.'''
+
+        corpus = self.corpus
+        events, facts = corpus.events, corpus.facts
+        event_rows = corpus.fact_events[rows]
+        nb_notes = self.nb_notes
+        columns = {}
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for idx in range(nb_notes):
+                for field in ('duration', 'dots', 'start', 'end', 'id'):
+                    columns[f"{field}_{idx}"] = column_values(events[field][event_rows[:, idx]], EVENT_FIELDS[field])
+
+                if self.allow_transposition and idx < nb_notes - 1:
+                    if self.duration_gap > 0:
+                        values = (facts['halfTonesFromA4'][rows[:, idx + 1]] - facts['halfTonesFromA4'][rows[:, idx]]) / 2
+                    else:
+                        values = events['interval'][event_rows[:, idx]]
+                    columns[f"interval_{idx}"] = column_values(values, 'float')
+
+                if self.allow_homothety and idx < nb_notes - 1:
+                    if self.duration_gap > 0:
+                        values = facts['duration'][rows[:, idx + 1]] / facts['duration'][rows[:, idx]]
+                    else:
+                        values = events['duration_ratio'][event_rows[:, idx]]
+                    columns[f"duration_ratio_{idx}"] = column_values(values, 'float')
+
+            for idx in range(nb_notes):
+                columns[f"octave_{idx}"] = column_values(facts['octave'][rows[:, idx]], FACT_FIELDS['octave'])
+                columns[f"pitch_{idx}"] = column_values(facts['class'][rows[:, idx]], FACT_FIELDS['class'])
+
+        columns['source'] = column_values(events['source'][event_rows[:, 0]], 'str')
+        columns['start'] = columns['start_0']
+        columns['end'] = columns[f"end_{nb_notes - 1}"]
+
+        # Attributes with a membership function
+        for node_name, attribute_name, membership_function_name in self.query.attributes_with_membership_functions:
+            kind, position, column = self.column(node_name, attribute_name)
+            alias = f"{attribute_name}_{node_name}_{membership_function_name}"
+            if column is None:
+                columns[alias] = [None] * len(rows)
+            else:
+                indices = rows[:, position] if kind == 'fact' else event_rows[:, position]
+                columns[alias] = column_values(column[indices], 'float' if column.dtype.kind == 'f' else 'str')
+
+        return columns
+
+def search_sorted_ranges(values, starts, ends, targets):
+    '''
+    For each range [starts ; ends[ of `values` (sorted inside each range), return the first index whose value is > the target
+    (`ends` if there is none), as a binary search over all the ranges at once.
+    '''
+
+    values = np.asarray(values)
+    low, high = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+    while (low < high).any():
+        active = low < high
+        middle = (low + high) // 2
+        after = values[np.minimum(middle, len(values) - 1)] <= targets
+        low = np.where(active & after, middle + 1, low)
+        high = np.where(active & ~after, middle, high)
+
+    return low
+
+def match_corpus(corpus, query, indexes=()):
+    '''
+    Execute the fuzzy `query` on `corpus`, and return the records of the matches (generator).
+    They can be ranked with `get_ordered_results_2` (or `process_results_to_dict`, ...), as the records returned by the database.
+
+    - indexes : the n-gram indexes of the corpus (see `load_indexes`), to only verify the candidate matches they give.
+    '''
+
+    return CorpusMatcher(corpus, query, indexes).records()
@@ -0,0 +1,249 @@
+import os
+import json
+import hashlib
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import accumulate
+
+from neo4j_connection import run_query
+
+# Name of the statistics file in a corpus directory
+STATS_FILE = 'stats.json'
+
+# Histograms kept for each label : (label, attribute).
+# The number of events of each source and of each collection are the histograms of `Event.source` and `Event.collection`.
+HISTOGRAMS = (
+    ('Fact', 'class'), ('Fact', 'octave'), ('Fact', 'frequency'), ('Fact', 'duration'), ('Fact', 'type'),
+    ('Event', 'duration'), ('Event', 'dots'), ('Event', 'source'), ('Event', 'collection'),
+    ('NEXT', 'interval'), ('NEXT', 'duration_ratio')
+)
+
+# Queries used to collect the statistics from the graph (read only). The sources already counted (`$sources`) are skipped.
+HISTOGRAM_QUERIES = {
+    'Fact': 'MATCH (e:Event)--(f:Fact) WHERE NOT e.source IN $sources RETURN f.{attribute} AS value, count(*) AS count',
+    'Event': 'MATCH (e:Event) WHERE NOT e.source IN $sources RETURN e.{attribute} AS value, count(*) AS count',
+    'NEXT': 'MATCH (e:Event)-[n:NEXT]->(:Event) WHERE NOT e.source IN $sources RETURN n.{attribute} AS value, count(*) AS count'
+}
+COLLECTIONS_QUERY = '''
+MATCH (tp:TopRhythmic)-[:RHYTHMIC]->(:Measure)-[:HAS]->(e:Event)
+WHERE NOT e.source IN $sources
+RETURN tp.collection AS value, count(DISTINCT e) AS count
+'''
+INDEXES_QUERY = 'SHOW INDEXES'
+
+class Histogram:
+    '''
+    Number of occurrences of each value of an attribute (the null values are not counted).
+    The values are sorted, with the cumulated counts, to count the values in a range.
+    '''
+
+    def __init__(self, counts):
+        '''
+        - counts : dict value -> number of occurrences (the values are all numbers, or all strings).
+        '''
+
+        self.values = sorted(counts)
+        self.counts_by_value = dict(counts)
+        self.counts = [counts[value] for value in self.values]
+        self.cumulated = list(accumulate(self.counts, initial=0))
+        self.total = self.cumulated[-1]
+
+    def count(self, value):
+        '''Return the number of occurrences of `value`.'''
+
+        position = bisect_left(self.values, value)
+        if position < len(self.values) and self.values[position] == value:
+            return self.counts[position]
+        return 0
+
+    def range_count(self, low, high):
+        '''Return the number of values in [low ; high].'''
+
+        return self.cumulated[bisect_right(self.values, high)] - self.cumulated[bisect_left(self.values, low)]
+
+    def mean(self):
+        '''Return the mean of the values (numbers), or None if there is none.'''
+
+        if self.total == 0:
+            return None
+        return sum(value * count for value, count in zip(self.values, self.counts)) / self.total
+
+    def __add__(self, other):
+        return Histogram(Counter(self.counts_by_value) + Counter(other.counts_by_value))
+
+    def to_list(self):
+        return [[value, count] for value, count in zip(self.values, self.counts)]
+
+class CorpusStats:
+    '''
+    Statistics of a corpus, used to estimate the selectivity of the conditions of a query at compile time
+    (see `reformulation_V3.choose_anchor`) : the number of elements of each label, and a histogram of the values
+    of each attribute of `HISTOGRAMS`.
+
+    They are collected from the graph (see `from_graph`, and the `stats` mode of `main_parser`) or from a local corpus,
+    and saved as a json file (see `save`), so that the compilation never queries the database.
+    As the counts add up, the statistics of new sources can be added to the saved ones (see `update_stats`).
+    '''
+
+    def __init__(self, counts, histograms, indexes=()):
+        '''
+        - counts     : dict label -> number of elements (`Event`, `Fact`, `NEXT`) ;
+        - histograms : dict (label, attribute) -> `Histogram` ;
+        - indexes    : the (label, attribute) pairs with a property index in the database (used for the `USING INDEX` hints).
+        '''
+
+        self.counts = counts
+        self.histograms = histograms
+        self.indexes = set(indexes)
+
+        content = json.dumps(self.to_dict(), sort_keys=True)
+        self.fingerprint = hashlib.sha256(content.encode('utf-8')).hexdigest()[:16] # Identifies the statistics in the cache keys
+
+    #---Creation
+    @classmethod
+    def from_graph(cls, driver, known_sources=()):
+        '''
+        Collect the statistics of the graph of the database of `driver` (read only queries).
+
+        - known_sources : sources not to count (e.g the ones already in saved statistics, see `update_stats`).
+        '''
+
+        params = {'sources': list(known_sources)}
+        counts = {label: 0 for label in HISTOGRAM_QUERIES}
+        histograms = {}
+        for label, attribute in HISTOGRAMS:
+            if (label, attribute) == ('Event', 'collection'):
+                rows = run_query(driver, COLLECTIONS_QUERY, params, read_only=True)
+            else:
+                rows = run_query(driver, HISTOGRAM_QUERIES[label].format(attribute=attribute), params, read_only=True)
+                counts[label] = sum(row['count'] for row in rows) # The rows of null values are counted too
+
+            histograms[label, attribute] = Histogram({row['value']: row['count'] for row in rows if row['value'] is not None})
+
+        return cls(counts, histograms, get_indexes(driver))
+
+    @classmethod
+    def from_corpus(cls, corpus):
+        '''Compute the statistics of a local corpus (see `corpus_engine.Corpus`).'''
+
+        from corpus_engine import column_values, FACT_FIELDS, EVENT_FIELDS
+
+        histograms = {}
+        for label, attribute in HISTOGRAMS:
+            if label == 'Fact':
+                values = column_values(corpus.facts[attribute], FACT_FIELDS[attribute])
+            else: # The NEXT values are stored in their first event
+                values = column_values(corpus.events[attribute], EVENT_FIELDS[attribute])
+            histograms[label, attribute] = Histogram(Counter(value for value in values if value is not None))
+
+        counts = {'Event': corpus.nb_events, 'Fact': corpus.nb_facts, 'NEXT': corpus.nb_events - len(corpus.voices)}
+        return cls(counts, histograms)
+
+    def __add__(self, other):
+        '''Return the statistics of both corpora (with the indexes of `other`, the most recent).'''
+
+        counts = {label: self.counts.get(label, 0) + other.counts.get(label, 0) for label in {**self.counts, **other.counts}}
+        histograms = {}
+        for key in {**self.histograms, **other.histograms}:
+            if key in self.histograms and key in other.histograms:
+                histograms[key] = self.histograms[key] + other.histograms[key]
+            else:
+                histograms[key] = self.histograms.get(key, other.histograms.get(key))
+
+        return CorpusStats(counts, histograms, other.indexes)
+
+    def sources(self):
+        '''Return the list of the sources counted in the statistics.'''
+
+        histogram = self.histograms.get(('Event', 'source'))
+        return [] if histogram is None else list(histogram.values)
+
+    #---Storage
+    def to_dict(self):
+        return {
+            'counts': self.counts,
+            'histograms': {f'{label}.{attribute}': histogram.to_list() for (label, attribute), histogram in self.histograms.items()},
+            'indexes': sorted(f'{label}.{attribute}' for label, attribute in self.indexes)
+        }
+
+    def save(self, path):
+        '''Save the statistics in the json file `path` (written aside and then renamed).'''
+
+        tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''Load the statistics saved in the json file `path`.'''
+
+        with open(path) as file:
+            content = json.load(file)
+
+        histograms = {
+            tuple(name.split('.', 1)): Histogram({value: count for value, count in pairs})
+            for name, pairs in content['histograms'].items()
+        }
+        indexes = [tuple(name.split('.', 1)) for name in content.get('indexes', [])]
+        return cls(content['counts'], histograms, indexes)
+
+    #---Selectivity
+    def fraction(self, label, attribute, low, high=None):
+        '''
+        Return the estimated fraction of the elements of `label` whose `attribute` is in [low ; high]
+        (equal to `low` if `high` is None). Returns 1 if there is no histogram for this attribute.
+        '''
+
+        histogram = self.histograms.get((label, attribute))
+        total = self.counts.get(label, 0)
+        if histogram is None or total == 0:
+            return 1.0
+
+        count = histogram.count(low) if high is None else histogram.range_count(low, high)
+        return count / total
+
+    def null_fraction(self, label, attribute):
+        '''Return the estimated fraction of the elements of `label` without `attribute`.'''
+
+        histogram = self.histograms.get((label, attribute))
+        total = self.counts.get(label, 0)
+        if histogram is None or total == 0:
+            return 1.0
+
+        return max(total - histogram.total, 0) / total
+
+    def __repr__(self):
+        return f"CorpusStats({', '.join(f'{count} {label}' for label, count in self.counts.items())})"
+
+def get_indexes(driver):
+    '''Return the (label, attribute) pairs with an online property index in the database of `driver`.'''
+
+    indexes = set()
+    for row in run_query(driver, INDEXES_QUERY, read_only=True):
+        row = dict(row)
+        if row.get('state', 'ONLINE') != 'ONLINE' or not row.get('labelsOrTypes') or not row.get('properties'):
+            continue # Token lookup indexes have no label nor property
+        for label in row['labelsOrTypes']:
+            indexes.update((label, attribute) for attribute in row['properties'])
+
+    return indexes
+
+def update_stats(path, driver, rebuild=False):
+    '''
+    Add the statistics of the sources of the database that are not yet counted in the statistics file `path`
+    (e.g after loading new dumps with `execute_cypher_dumps`). The file is created if needed.
+
+    - rebuild : if True, all the statistics are collected again (e.g after deleting sources).
+
+    Returns the updated statistics.
+    '''
+
+    if rebuild or not os.path.exists(path):
+        stats = CorpusStats.from_graph(driver)
+    else:
+        stats = CorpusStats.load(path)
+        stats += CorpusStats.from_graph(driver, stats.sources())
+
+    stats.save(path)
+    return stats
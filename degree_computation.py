@@ -1,3 +1,9 @@
+# Semitone distance from C for each note
+SEMITONES_FROM_C = {
+    'c': 0, 'c#': 1, 'd': 2, 'd#': 3, 'e': 4, 'f': 5, 'f#': 6,
+    'g': 7, 'g#': 8, 'a': 9, 'a#': 10, 'b': 11
+}
+
 def convert_note_to_sharp(note: str) -> str:
     '''
     Convert a note to its equivalent in sharp (if it is a flat).
@@ -28,12 +34,6 @@ def note_distance_in_tones(note1, octave1, note2, octave2):
         else:
             return 12 * abs(octave2 - octave1) / 2
 
-    #---Define the semitone distance from C for each note
-    semitones_from_c = {
-        'c': 0, 'c#': 1, 'd': 2, 'd#': 3, 'e': 4, 'f': 5, 'f#': 6, 
-        'g': 7, 'g#': 8, 'a': 9, 'a#': 10, 'b': 11
-    }
-
     #---Replace 's' with '#' and convert flat to sharp
     note1 = convert_note_to_sharp(note1)
     note2 = convert_note_to_sharp(note2)
@@ -51,8 +51,8 @@ def note_distance_in_tones(note1, octave1, note2, octave2):
     
     #---Calculate the distances
     # Calculate the semitone position for each note
-    semitone1 = semitones_from_c[note1] + (octave1 * 12)
-    semitone2 = semitones_from_c[note2] + (octave2 * 12)
+    semitone1 = SEMITONES_FROM_C[note1] + (octave1 * 12)
+    semitone2 = SEMITONES_FROM_C[note2] + (octave2 * 12)
     
     # Calculate the absolute distance in semitones
     distance_in_semitones = abs(semitone2 - semitone1)
@@ -1,5 +1,4 @@
 import re
-import numpy as np
 
 def extract_notes_from_query_dict(query: str) -> dict:
     '''
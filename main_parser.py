@@ -4,21 +4,18 @@
 ##-Imports
 #---General
 import argparse
-from os.path import exists
+from os.path import exists, join
 from ast import literal_eval # safer than eval
 import re
-
-# import neo4j.exceptions.CypherSyntaxError
-import neo4j
+import json
+from itertools import chain
 
 #---Project
-from reformulation_V3 import reformulate_fuzzy_query
-from neo4j_connection import connect_to_neo4j, run_query
-from process_results import process_results_to_text, process_results_to_mp3, process_results_to_json, process_crisp_results_to_json
-from utils import get_first_k_notes_of_each_score, create_query_from_list_of_notes, create_query_from_contour
-
-#---Performance tests
-from testing_utilities import PerformanceLogger
+# Only the light modules are imported here. The neo4j driver, the ranking (numpy), the audio (pydub)
+# and the performance tests (matplotlib) are imported by the subcommands that need them.
+from query_cache import QueryCache
+from neo4j_connection import connect_to_neo4j, run_query, stream_query, get_connection_manager, close_connections, is_timeout_error, DEFAULT_POOL_SIZE
+from utils import get_first_k_notes_of_each_score, create_query_from_list_of_notes, create_query_from_contour, list_available_songs
 
 ##-Init
 # version = '1.0'
@@ -198,24 +195,6 @@ def check_notes_input_format(notes_input: str) -> list[list[tuple[str|None, int|
     return notes
 
 
-
-def list_available_songs(driver, collection=None):
-    '''
-    Return a list of all the available songs.
-
-    - driver     : the neo4j connection driver ;
-    - collection : List only scores for the given collection. If `None`, list for all.
-    '''
-
-    if collection == None:
-        query = 'MATCH (s:Score) RETURN DISTINCT s.source AS source'
-    else:
-        query = f'MATCH (s:Score) WHERE s.collection CONTAINS "{collection}" RETURN DISTINCT s.source AS source'
-
-    result = run_query(driver, query)
-
-    return [record['source'] for record in result]
-
 ##-Parser
 class Parser:
     '''Defines an argument parser'''
@@ -234,11 +213,19 @@ class Parser:
             \tcompile a query from file : python3 main_parser.py compile -F fuzzy_query.cypher -o crisp_query.cypher
             \tsend a query              : python3 main_parser.py send -F crisp_query.cypher -t result.txt
             \tsend a query 2            : python3 main_parser.py -u user -p pwd send -F -f fuzzy_query.cypher -t result.txt -m 6
+            \tsend several queries      : python3 main_parser.py send -f -B fuzzy_queries.json -k 10 -j
             \twrite a fuzzy query       : python3 main_parser.py write \"[[('c', 5), 1, 1], [('d', 5), None]]\" -a 0.5 -t -o fuzzy_query.cypher
             \twrite a query from file   : python3 main_parser.py w \"$(python3 main_parser.py g \"10343_Avant_deux.mei\" 9)\" -p 2
             \tget notes from a song     : python3 main_parser.py get Air_n_83.mei 5 -o notes
             \tlist all songs            : python3 main_parser.py l
-            \tlist all songs (compact)  : python3 main_parser.py l -n 0''',
+            \tlist all songs (compact)  : python3 main_parser.py l -n 0
+            \tstart the query service   : python3 main_parser.py serve -P 8765
+            \tcreate the SKIP edges     : python3 main_parser.py enrich -g 0.5
+            \tuse the SKIP edges        : python3 main_parser.py --skip-max-gap 0.5 send -F -f fuzzy_query.cypher
+            \tcollect the statistics    : python3 main_parser.py stats stats.json
+            \tuse the statistics        : python3 main_parser.py --stats stats.json compile -F fuzzy_query.cypher
+            \testimate a query          : python3 main_parser.py --stats stats.json estimate -F fuzzy_query.cypher
+            \tbound the queries         : python3 main_parser.py --timeout 30 --budget-policy limit send -F -f fuzzy_query.cypher''',
             formatter_class=argparse.RawDescriptionHelpFormatter
         )
 
@@ -265,6 +252,47 @@ class Parser:
             default='12345678',
             help='the password to access the database'
         )
+        self.parser.add_argument(
+            '--pool-size',
+            default=DEFAULT_POOL_SIZE,
+            type=int,
+            help=f'maximum number of connections to the database kept open. Default is {DEFAULT_POOL_SIZE}.'
+        )
+        self.parser.add_argument(
+            '-D', '--cache-dir',
+            help='directory where compiled fuzzy queries are cached (shared between runs). If omitted, they are only cached in memory.'
+        )
+        self.parser.add_argument(
+            '--cache-size',
+            default=64,
+            type=lambda x: restricted_float(x, 0, None),
+            help='maximum size of the on-disk cache, in MB. Default is 64.'
+        )
+        self.parser.add_argument(
+            '--skip-max-gap',
+            type=lambda x: restricted_float(x, 0, None),
+            help='the maximum gap of the SKIP relationships of the database (created by the enrich mode). Fuzzy queries with a duration gap up to SKIP_MAX_GAP use them instead of variable-length NEXT paths. It can not be larger than the gap given to the enrich mode.'
+        )
+        self.parser.add_argument(
+            '--stats',
+            help='the corpus statistics (written by the stats mode, or by the export mode in the corpus directory). The compiled queries then start from their most selective note.'
+        )
+        self.parser.add_argument(
+            '--timeout',
+            type=lambda x: restricted_float(x, 0, None),
+            help='the maximum duration of a query in the database, in seconds (send and serve modes). The database stops the queries running longer.'
+        )
+        self.parser.add_argument(
+            '--max-expansion',
+            type=int,
+            help='the budget of the fuzzy queries (send and serve modes) : their estimated path expansion, from their number of notes, duration gap and tolerances, and from the intervals / duration ratios they constrain. If omitted (or 0), there is no budget.'
+        )
+        self.parser.add_argument(
+            '--budget-policy',
+            choices=['refuse', 'limit'],
+            default='refuse',
+            help='what to do with a fuzzy query above the budget : refuse it, or add a LIMIT to it (its results are then ranked among the first matches only). Default is refuse.'
+        )
 
         #------Sub-parsers
         self.subparsers = self.parser.add_subparsers(required=True, dest='subparser')
@@ -274,22 +302,59 @@ class Parser:
         self.create_write();
         self.create_get();
         self.create_list();
+        self.create_serve();
+        self.create_export();
+        self.create_enrich();
+        self.create_stats();
+        self.create_estimate();
+
+    def get_max_expansion(self, args):
+        '''Return the budget of the fuzzy queries (see `query_budget.check_budget`), or None if there is none.'''
 
-    def init_driver(self, uri, user, password):
+        if args.max_expansion != None and args.max_expansion < 0:
+            self.parser.error('--max-expansion must be a non-negative integer')
+        return args.max_expansion or None
+
+    def init_driver(self, uri, user, password, max_pool_size=DEFAULT_POOL_SIZE):
         '''
-        Creates self.driver.
+        Sets self.driver to the process-wide connection manager (created on first use).
 
-        - uri      : the uri of the database ;
-        - user     : the username to access the database ;
-        - password : the password to access the database.
+        - uri           : the uri of the database ;
+        - user          : the username to access the database ;
+        - password      : the password to access the database ;
+        - max_pool_size : the maximum number of connections in the pool.
         '''
 
-        self.driver = connect_to_neo4j(uri, user, password)
+        self.driver = get_connection_manager(uri, user, password, max_pool_size)
+
+    def check_skip_edges(self):
+        '''Checks once, after connecting, that the SKIP relationships of the database allow --skip-max-gap (see `skip_edges.check_skip_max_gap`).'''
+
+        if self.cache.skip_max_gap == None:
+            return
+
+        from skip_edges import check_skip_max_gap
+
+        try:
+            check_skip_max_gap(self.driver, self.cache.skip_max_gap)
+        except ValueError as err:
+            self.close_driver()
+            self.parser.error(str(err))
 
     def close_driver(self):
-        '''Closes the driver'''
+        '''Closes the process-wide connections'''
+
+        close_connections()
+
+    def load_stats(self, path):
+        '''Loads the corpus statistics of the file `path` (see `corpus_stats`).'''
 
-        self.driver.close()
+        from corpus_stats import CorpusStats
+
+        if not exists(path):
+            self.parser.error(f'The statistics file "{path}" does not exist')
+
+        return CorpusStats.load(path)
 
 
     def create_compile(self):
@@ -313,6 +378,21 @@ class Parser:
             '-o', '--output',
             help='give a filename where to write result. If not set, just print it.'
         )
+        self.parser_c.add_argument(
+            '-P', '--parameters',
+            action='store_true',
+            help='write the values of the searched notes as query parameters ($p0_low, ...). The result is then a json object {"query": ..., "params": ...}.'
+        )
+        self.parser_c.add_argument(
+            '-R', '--rank-on-server',
+            action='store_true',
+            help='compute the degrees in the query : only the matches with a degree of at least alpha are returned, best first.'
+        )
+        self.parser_c.add_argument(
+            '-k', '--top-k',
+            type=int,
+            help='with -R, return only the TOP_K best matches.'
+        )
 
     def create_send(self):
         '''Creates the send subparser and add its arguments.'''
@@ -336,6 +416,21 @@ class Parser:
             action='store_true',
             help='the query is a fuzzy one. Convert it before sending it.'
         )
+        self.parser_s.add_argument(
+            '-S', '--stream',
+            action='store_true',
+            help='with -f, rank the records while they are received instead of fetching them all first (lower memory usage for large results).'
+        )
+        self.parser_s.add_argument(
+            '-k', '--top-k',
+            type=int,
+            help='with -f, keep only the TOP_K best results.'
+        )
+        self.parser_s.add_argument(
+            '-R', '--rank-on-server',
+            action='store_true',
+            help='with -f, compute the degrees in the database, so that only the matches with a degree of at least alpha (and, with -k, only the TOP_K best ones) are transferred.'
+        )
         self.parser_s.add_argument(
             '-j', '--json',
             action='store_true',
@@ -350,6 +445,37 @@ class Parser:
             type=int,
             help='save the result as mp3 files. MP3 is the maximum number of files to write.'
         )
+        self.parser_s.add_argument(
+            '-L', '--local',
+            help='with -f, run the query on the corpus LOCAL (directory written by the export mode) instead of the database.'
+        )
+        self.parser_s.add_argument(
+            '-A', '--approximate',
+            type=int,
+            help='with -L, search the intervals and duration ratios of the query in the contour strings of the corpus, allowing APPROXIMATE relationships with a contour symbol next to the searched one (e.g `R` or `U` for `u`, `S` or `M` for `s`). Matches are sorted by number of errors.'
+        )
+        self.parser_s.add_argument(
+            '--insertions',
+            type=int,
+            default=0,
+            help='with -A, also allow INSERTIONS relationships of the corpus to be skipped in a match (edit-distance insertions : the skipped intervals are not added up as with a duration gap). Default is 0.'
+        )
+        self.parser_s.add_argument(
+            '--partitions',
+            type=int,
+            help='with -f, split the sources of the database into PARTITIONS disjoint parts, run the query on them concurrently, and merge the rankings.'
+        )
+        self.parser_s.add_argument(
+            '-B', '--batch',
+            action='store_true',
+            help='with -f, QUERY is a json file holding a list of fuzzy queries. The queries with the same shape are sent as one query, and the results are ranked for each query.'
+        )
+        self.parser_s.add_argument(
+            '--partition-by',
+            choices=('source', 'collection'),
+            default='source',
+            help='with --partitions, split the sources by hash of their source (default), or of their collection.'
+        )
 
     def create_write(self):
         '''Creates the write subparser and add its arguments.'''
@@ -467,6 +593,107 @@ class Parser:
         )
 
 
+    def create_serve(self):
+        '''Creates the serve subparser and add its arguments.'''
+
+        #---Init
+        self.parser_serve = self.subparsers.add_parser('serve', help='run a local service answering compile, write, send, estimate, cancel, get and list requests (HTTP / json)')
+
+        #---Add arguments
+        # The defaults are the ones of `query_server` (not imported here, as it is only needed by this subcommand)
+        self.parser_serve.add_argument(
+            '-H', '--host',
+            help='the address to listen on. Default is 127.0.0.1.'
+        )
+        self.parser_serve.add_argument(
+            '-P', '--port',
+            type=int,
+            help='the port to listen on. Default is 8765.'
+        )
+        self.parser_serve.add_argument(
+            '-s', '--socket',
+            help='listen on the unix socket SOCKET instead of HOST:PORT.'
+        )
+
+
+    def create_export(self):
+        '''Creates the export subparser and add its arguments.'''
+
+        #---Init
+        self.parser_e = self.subparsers.add_parser('export', help='export the notes of the database to a local corpus, to run fuzzy queries without the database (send --local)')
+
+        #---Add arguments
+        self.parser_e.add_argument(
+            'CORPUS',
+            help='the directory where to write the corpus (one .npy file per table, and the n-gram indexes).'
+        )
+        self.parser_e.add_argument(
+            '-a', '--append',
+            action='store_true',
+            help='if CORPUS exists, only add the sources that are not in it yet (e.g after loading new dumps).'
+        )
+
+
+    def create_enrich(self):
+        '''Creates the enrich subparser and add its arguments.'''
+
+        #---Init
+        self.parser_en = self.subparsers.add_parser('enrich', help='create the SKIP relationships between the events of a voice, used by the queries with a duration gap (--skip-max-gap)')
+
+        #---Add arguments
+        self.parser_en.add_argument(
+            '-g', '--max-gap',
+            required=True,
+            type=lambda x: restricted_float(x, 0, None),
+            help='the maximum gap of the relationships (as the duration gap of the queries).'
+        )
+        self.parser_en.add_argument(
+            '-v', '--verbose',
+            action='store_true',
+            help='print the number of relationships created for each source.'
+        )
+
+
+    def create_stats(self):
+        '''Creates the stats subparser and add its arguments.'''
+
+        #---Init
+        self.parser_st = self.subparsers.add_parser('stats', help='collect the statistics of the database (histograms of the values of the notes), used by the compilation (--stats)')
+
+        #---Add arguments
+        self.parser_st.add_argument(
+            'FILE',
+            help='the json file where to write the statistics. If it exists, only the sources that are not counted in it yet are added.'
+        )
+        self.parser_st.add_argument(
+            '-r', '--rebuild',
+            action='store_true',
+            help='collect all the statistics again, even if FILE exists (e.g after deleting sources).'
+        )
+
+    def create_estimate(self):
+        '''Creates the estimate subparser and add its arguments.'''
+
+        #---Init
+        self.parser_es = self.subparsers.add_parser('estimate', help='estimate the number of results and the latency of a fuzzy query from the statistics (--stats), without the database')
+
+        #---Add arguments
+        self.parser_es.add_argument(
+            'QUERY',
+            help='the fuzzy query to estimate (string, or filename if -F is used).'
+        )
+        self.parser_es.add_argument(
+            '-F', '--file',
+            action='store_true',
+            help='if used, QUERY will be considered as a file name and not a raw query.'
+        )
+        self.parser_es.add_argument(
+            '-j', '--json',
+            action='store_true',
+            help='print the estimate as json.'
+        )
+
+
     def parse(self):
         '''Parse the args'''
 
@@ -474,6 +701,9 @@ class Parser:
         args = self.parser.parse_args()
         # print(args)
 
+        stats = self.load_stats(args.stats) if args.stats != None else None
+        self.cache = QueryCache(cache_dir=args.cache_dir, max_disk_bytes=int(args.cache_size * 1024 * 1024), skip_max_gap=args.skip_max_gap, stats=stats)
+
         #---Redirect towards the right method
         if args.subparser in ('c', 'compile'):
             self.parse_compile(args)
@@ -494,6 +724,21 @@ class Parser:
         elif args.subparser in ('l', 'list'):
             self.parse_list(args)
 
+        elif args.subparser == 'serve':
+            self.parse_serve(args)
+
+        elif args.subparser == 'export':
+            self.parse_export(args)
+
+        elif args.subparser == 'enrich':
+            self.parse_enrich(args)
+
+        elif args.subparser == 'stats':
+            self.parse_stats(args)
+
+        elif args.subparser == 'estimate':
+            self.parse_estimate(args)
+
     def parse_compile(self, args):
         '''Parse the args for the compile mode'''
 
@@ -502,7 +747,14 @@ class Parser:
         else:
             query = args.QUERY
 
-        res = reformulate_fuzzy_query(query)
+        if args.top_k != None and not args.rank_on_server:
+            self.parser_c.error('--top-k can only be used with --rank-on-server (-R)')
+
+        if args.parameters:
+            compiled_query = self.cache.compile(query, True, args.rank_on_server, args.top_k)
+            res = json.dumps({'query': compiled_query.crisp_query, 'params': compiled_query.params}, indent=4)
+        else:
+            res = self.cache.compile(query, False, args.rank_on_server, args.top_k).crisp_query
         # try:
         #     res = reformulate_fuzzy_query(query)
         # except:
@@ -518,39 +770,157 @@ class Parser:
     def parse_send(self, args):
         '''Parse the args for the send mode'''
 
-        if args.file:
+        import neo4j
+        from process_results import process_results_to_text, process_results_to_mp3, process_results_to_json, process_crisp_results_to_json
+
+        if args.file or args.batch:
             query = get_file_content(args.QUERY, self.parser_s)
         else:
             query = args.QUERY
 
+        if args.batch:
+            self.parse_send_batch(args, query)
+            return
+
+        if args.rank_on_server and not args.fuzzy:
+            self.parser_s.error('--rank-on-server can only be used with fuzzy queries (-f)')
+
         if args.fuzzy:
             try:
-                crisp_query = reformulate_fuzzy_query(query)
+                # The parsed query is shared by the compilation and the ranking of the results.
+                # The query is parameterized so that Neo4j reuses its plan for queries of the same shape.
+                # With --rank-on-server, the database only returns the matches kept by the ranking.
+                top_k = args.top_k if args.rank_on_server else None
+                compiled_query = self.cache.compile(query, True, args.rank_on_server, top_k)
+                crisp_query = compiled_query.crisp_query
+                params = compiled_query.params
+                query = compiled_query.fuzzy_query
             except:
                 print('parse_send: compile query: error: query may not be correctly written')
                 return
 
         else:
             crisp_query = query
+            params = None
+
+        if args.stream:
+            if not args.fuzzy:
+                self.parser_s.error('--stream can only be used with fuzzy queries (-f)')
+            if args.text_output != None and args.mp3 != None:
+                self.parser_s.error('--stream can only produce one output (-t or -m)')
+
+        if args.local != None:
+            if not args.fuzzy:
+                self.parser_s.error('--local can only be used with fuzzy queries (-f)')
+            if args.rank_on_server or args.mp3 != None:
+                self.parser_s.error('--local cannot be used with --rank-on-server (-R) or --mp3 (-m)')
+            if args.approximate != None:
+                if args.stream or args.text_output != None:
+                    self.parser_s.error('--approximate cannot be used with --stream (-S) or --text-output (-t)')
+                if args.approximate < 0:
+                    self.parser_s.error('--approximate must be a non-negative integer')
+            if args.insertions != 0:
+                if args.approximate == None:
+                    self.parser_s.error('--insertions can only be used with --approximate (-A)')
+                if args.insertions < 0:
+                    self.parser_s.error('--insertions must be a non-negative integer')
+
+            from corpus_engine import Corpus, CorpusMatcher, match_corpus
+            from ngram_index import load_indexes
+
+            if not exists(args.local):
+                self.parser_s.error(f'The file {args.local} has not been found')
+            corpus = Corpus.load(args.local)
+            indexes = load_indexes(args.local)
+
+            if args.approximate != None:
+                try:
+                    matcher = CorpusMatcher(corpus, query, indexes)
+                except ValueError as err: # Query not supported by the local corpus
+                    print('parse_send: local corpus: ' + str(err))
+                    return
+                # The contour strings only hold the relationships between consecutive events
+                if matcher.duration_gap > 0:
+                    self.parser_s.error('--approximate cannot be used with a duration gap (use --insertions to skip relationships)')
+                if all(bound is None for bounds in matcher.edge_bounds.values() for bound in bounds):
+                    self.parser_s.error('--approximate needs a query with conditions on its intervals or duration ratios (e.g written with -C, -t or -H in the write mode)')
+
+        else:
+            if args.approximate != None:
+                self.parser_s.error('--approximate can only be used with --local (-L)')
+
+            if args.fuzzy:
+                from query_budget import check_budget
+                from query_cache import CompiledQuery
 
-        self.init_driver(args.URI, args.user, args.password)
+                # Refuse (or limit) the queries whose expansion would run for long in the shared database
+                try:
+                    crisp_query = check_budget(compiled_query, self.get_max_expansion(args), args.budget_policy)
+                except ValueError as err:
+                    print('parse_send: ' + str(err))
+                    return
+                compiled_query = CompiledQuery(crisp_query, compiled_query.fuzzy_query, params)
+
+            self.init_driver(args.URI, args.user, args.password, args.pool_size)
+            self.check_skip_edges()
+
+        if args.partitions != None:
+            if not args.fuzzy or args.local != None or args.stream:
+                self.parser_s.error('--partitions can only be used with fuzzy queries (-f), without --local (-L) or --stream (-S)')
+            if args.partitions < 1:
+                self.parser_s.error('--partitions must be a positive integer')
+
+            from partitioned_query import make_partitions, run_partitioned
+
+            known_sources = self.cache.stats.sources() if self.cache.stats != None else []
+            partitions = make_partitions(self.driver, args.partitions, args.partition_by, known_sources or None)
 
         try:
             if testing_mode:
                 logger.start("only_query")
-            res = run_query(self.driver, crisp_query)
+            if args.approximate != None:
+                matches = matcher.approximate_matches(args.approximate, args.insertions)[:args.top_k]
+            elif args.local != None:
+                # The records are produced (and ranked) by chunks, as with --stream
+                res = match_corpus(corpus, query, indexes)
+            elif args.partitions != None:
+                # The rankings of the partitions are merged here, and used as is by the process functions
+                res = run_partitioned(self.driver, compiled_query, partitions, args.top_k, timeout=args.timeout)
+            elif args.stream:
+                # The first record is pulled here so that query errors are reported like without streaming
+                stream = stream_query(self.driver, crisp_query, params, timeout=args.timeout)
+                first_record = next(stream, None)
+                res = stream if first_record is None else chain([first_record], stream)
+            else:
+                res = run_query(self.driver, crisp_query, params, read_only=args.fuzzy, timeout=args.timeout)
             if testing_mode:
                 logger.end("only_query")
         except neo4j.exceptions.CypherSyntaxError as err:
             print('parse_send: query syntax error: ' + str(err))
             return
+        except neo4j.exceptions.ClientError as err:
+            if not is_timeout_error(err):
+                raise
+            print(f'parse_send: the query has been stopped after {args.timeout} seconds (--timeout)')
+            return
+        except ValueError as err: # Query not supported by the local corpus
+            print('parse_send: local corpus: ' + str(err))
+            return
+
+        if args.approximate != None:
+            if args.json:
+                print(json.dumps(matches, indent=4))
+            else:
+                for match in matches:
+                    print(f"{match['source']} : {match['start']} - {match['end']} ({match['substitutions']} substitution(s), {match['insertions']} insertion(s))")
+            return
 
         if args.text_output == None and args.mp3 == None:
             if args.fuzzy:
                 if args.json:
-                    print(process_results_to_json(res, query))
+                    print(process_results_to_json(res, query, args.top_k))
                 else:
-                    print(process_results_to_text(res, query))
+                    print(process_results_to_text(res, query, args.top_k))
 
             else:
                 if args.json:
@@ -565,11 +935,65 @@ class Parser:
                     print(res)
                     self.parser_s.error('Can only process result to text if the query is fuzzy !\nThe result has been printed above.')
 
-                processed_res = process_results_to_text(res, query)
+                processed_res = process_results_to_text(res, query, args.top_k)
                 write_to_file(args.text_output, processed_res)
 
             if args.mp3 != None:
-                process_results_to_mp3(res, query, args.mp3, self.driver)
+                process_results_to_mp3(res, query, args.mp3, self.driver, args.top_k)
+
+        self.close_driver()
+
+    def parse_send_batch(self, args, content):
+        '''Parse the args for the send mode with --batch (`content` is the content of the batch file)'''
+
+        import neo4j
+        from batch_query import compile_batch, run_batch
+        from process_results import process_results_to_text, process_results_to_dict
+
+        if not args.fuzzy:
+            self.parser_s.error('--batch can only be used with fuzzy queries (-f)')
+        if args.local != None or args.stream or args.rank_on_server or args.partitions != None or args.mp3 != None or args.text_output != None:
+            self.parser_s.error('--batch cannot be used with --local (-L), --stream (-S), --rank-on-server (-R), --partitions, --mp3 (-m) or --text-output (-t)')
+        # A LIMIT would apply to the rows of all the patterns of a batch (see `compile_batch`)
+        if args.budget_policy == 'limit':
+            self.parser_s.error('--batch cannot be used with --budget-policy limit (the queries above the budget are refused)')
+
+        try:
+            queries = json.loads(content)
+        except json.JSONDecodeError as err:
+            self.parser_s.error(f'--batch: {args.QUERY} is not a valid json file: {err}')
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            self.parser_s.error(f'--batch: {args.QUERY} must hold a list of fuzzy queries (strings)')
+
+        try:
+            batches, compiled_queries = compile_batch(self.cache, queries, self.get_max_expansion(args))
+        except ValueError as err: # Query above the budget
+            print('parse_send: ' + str(err))
+            return
+        except:
+            print('parse_send: compile query: error: a query may not be correctly written')
+            return
+
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
+        self.check_skip_edges()
+
+        try:
+            results = run_batch(self.driver, batches, compiled_queries, args.top_k, args.timeout)
+        except neo4j.exceptions.CypherSyntaxError as err:
+            print('parse_send: query syntax error: ' + str(err))
+            return
+        except neo4j.exceptions.ClientError as err:
+            if not is_timeout_error(err):
+                raise
+            print(f'parse_send: the batch has been stopped after {args.timeout} seconds (--timeout)')
+            return
+
+        if args.json:
+            print(json.dumps([process_results_to_dict(res, query, args.top_k) for res, query in zip(results, queries)]))
+        else:
+            for idx, (res, query) in enumerate(zip(results, queries)):
+                print(f'Query {idx + 1}:')
+                print(process_results_to_text(res, query, args.top_k))
 
         self.close_driver()
 
@@ -639,7 +1063,7 @@ class Parser:
     def parse_get(self, args):
         '''Parse the args for the get mode'''
 
-        self.init_driver(args.URI, args.user, args.password)
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
 
         if args.NAME not in list_available_songs(self.driver):
             self.close_driver()
@@ -657,7 +1081,7 @@ class Parser:
     def parse_list(self, args):
         '''Parse the args for the list mode'''
 
-        self.init_driver(args.URI, args.user, args.password)
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
 
         if args.number_per_line != None and args.number_per_line < 0:
             self.close_driver();
@@ -686,6 +1110,111 @@ class Parser:
         self.close_driver();
 
 
+    def parse_serve(self, args):
+        '''Parse the args for the serve mode'''
+
+        from query_server import QueryService, create_server, DEFAULT_HOST, DEFAULT_PORT
+
+        host = DEFAULT_HOST if args.host == None else args.host
+        port = DEFAULT_PORT if args.port == None else args.port
+
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
+        self.check_skip_edges()
+        service = QueryService(self.cache, self.driver, args.timeout, self.get_max_expansion(args), args.budget_policy)
+
+        try:
+            server = create_server(service, host, port, args.socket)
+        except (OSError, ValueError) as err:
+            self.close_driver()
+            self.parser_serve.error(f'cannot start the service: {err}')
+
+        print(f'Serving on {args.socket if args.socket != None else f"http://{host}:{port}"} (Ctrl+C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close_driver()
+
+
+    def parse_export(self, args):
+        '''Parse the args for the export mode'''
+
+        from corpus_engine import Corpus, update_corpus
+        from ngram_index import build_indexes
+        from corpus_stats import CorpusStats, STATS_FILE
+
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
+
+        if args.append:
+            corpus = update_corpus(args.CORPUS, self.driver)
+        else:
+            corpus = Corpus.export(self.driver)
+            corpus.save(args.CORPUS)
+            build_indexes(corpus, args.CORPUS)
+            CorpusStats.from_corpus(corpus).save(join(args.CORPUS, STATS_FILE))
+        print(f'{corpus} written to {args.CORPUS}')
+
+        self.close_driver()
+
+
+    def parse_enrich(self, args):
+        '''Parse the args for the enrich mode'''
+
+        from skip_edges import create_skip_edges
+
+        if args.max_gap == 0:
+            self.parser_en.error('--max-gap must be positive')
+
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
+
+        nb_edges = create_skip_edges(self.driver, args.max_gap, verbose=args.verbose)
+        print(f'{nb_edges} SKIP relationships created. Use them with --skip-max-gap {args.max_gap}')
+
+        self.close_driver()
+
+
+    def parse_stats(self, args):
+        '''Parse the args for the stats mode'''
+
+        from corpus_stats import update_stats
+
+        self.init_driver(args.URI, args.user, args.password, args.pool_size)
+
+        stats = update_stats(args.FILE, self.driver, args.rebuild)
+        print(f'{stats} written to {args.FILE}')
+
+        self.close_driver()
+
+    def parse_estimate(self, args):
+        '''Parse the args for the estimate mode'''
+
+        from query_budget import estimate_query
+
+        if self.cache.stats == None:
+            self.parser_es.error('the statistics of the corpus are needed (--stats FILE, written by the stats mode)')
+
+        if args.file:
+            query = get_file_content(args.QUERY, self.parser_es)
+        else:
+            query = args.QUERY
+
+        try:
+            estimate = estimate_query(query, self.cache.stats)
+        except:
+            print('parse_estimate: error: query may not be correctly written')
+            return
+
+        if args.json:
+            print(json.dumps(estimate))
+        else:
+            print(f"Estimated results : {estimate['rows']}")
+            print(f"Examined paths    : {estimate['work']}")
+            print(f"Gap expansion     : {estimate['gap_expansion']:.2f}")
+            print(f"Latency class     : {estimate['latency']}")
+
+
     # class Version(argparse.Action):
     #     '''Class used to show Synk version.'''
     #
@@ -700,6 +1229,8 @@ if __name__ == '__main__':
     testing_mode = False
 
     if testing_mode:
+        from testing_utilities import PerformanceLogger
+
         logger = PerformanceLogger()
         app = Parser()
         app.parse()
@@ -1,13 +1,381 @@
-from neo4j import GraphDatabase
+import atexit
+import threading
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+
+# The neo4j driver is imported only when a connection is made, so that importing this module stays cheap
+
+# Default maximum number of connections in the pool (same as the neo4j driver)
+DEFAULT_POOL_SIZE = 100
+
+# Number of records pulled at once from the server when streaming
+DEFAULT_FETCH_SIZE = 1000
+
+class QueryCancelled(Exception):
+    '''Raised by `fetch_cancellable` when the query is cancelled before all its records are fetched.'''
+
+def is_timeout_error(err):
+    '''Return True if `err` (a neo4j exception) tells that the transaction was stopped by its timeout.'''
+
+    return 'TransactionTimedOut' in (getattr(err, 'code', None) or '')
+
+class ConnectionManager:
+    '''
+    Wraps a neo4j driver shared by the whole process.
+
+    - Sessions are reused : inside a `with manager.session():` block, all the queries of the
+      current thread run in the same session instead of opening one per query ;
+    - Read queries run in explicit read transactions (`run_read`) ;
+    - Pool utilization counters are available with `pool_stats`, to size `max_pool_size` under load.
+    '''
+
+    def __init__(self, uri, user, password, max_pool_size=DEFAULT_POOL_SIZE):
+        '''
+        - uri           : the uri of the database ;
+        - user          : the username to access the database ;
+        - password      : the password to access the database ;
+        - max_pool_size : the maximum number of connections kept by the driver.
+        '''
+
+        from neo4j import GraphDatabase
+
+        self.uri = uri
+        self.user = user
+        self.max_pool_size = max_pool_size
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_pool_size)
+
+        self._local = threading.local() # Session currently reused by each thread
+        self._lock = threading.Lock()
+        self.sessions_opened = 0
+        self.sessions_reused = 0
+        self.sessions_active = 0
+        self.sessions_peak = 0
+        self.read_transactions = 0
+        self.auto_commit_queries = 0
+
+    #---Sessions
+    @contextmanager
+    def session(self):
+        '''
+        Context manager giving a session. Nested (or back-to-back, inside the same block) uses
+        in the current thread reuse the same session, which is closed when the outermost block ends.
+        '''
+
+        current = getattr(self._local, 'session', None)
+        if current is not None:
+            self._local.depth += 1
+            with self._lock:
+                self.sessions_reused += 1
+            try:
+                yield current
+            finally:
+                self._local.depth -= 1
+            return
+
+        session = self.driver.session()
+        with self._lock:
+            self.sessions_opened += 1
+            self.sessions_active += 1
+            self.sessions_peak = max(self.sessions_peak, self.sessions_active)
+
+        self._local.session = session
+        self._local.depth = 1
+        try:
+            yield session
+        finally:
+            self._local.session = None
+            self._local.depth = 0
+            session.close()
+            with self._lock:
+                self.sessions_active -= 1
+
+    #---Queries
+    def run_read(self, query, params=None, timeout=None):
+        '''
+        Run `query` in a read transaction and return the list of records.
+        If `timeout` (in seconds) is given, the database stops the transaction when it runs longer.
+        '''
+
+        with self.session() as session:
+            records = session.execute_read(_read_work(timeout), query, params)
+
+        with self._lock:
+            self.read_transactions += 1
+        return records
+
+    def run(self, query, params=None, timeout=None):
+        '''Run `query` in an auto-commit transaction (read or write) and return the list of records (see `run_read` for `timeout`).'''
+
+        with self.session() as session:
+            records = list(session.run(_make_query(query, timeout), params))
+
+        with self._lock:
+            self.auto_commit_queries += 1
+        return records
+
+    def stream_read(self, query, params=None, fetch_size=DEFAULT_FETCH_SIZE, timeout=None):
+        '''
+        Run `query` in a read transaction and yield the records lazily, `fetch_size` at a time.
+        The stream uses its own session, so that other queries can run while it is consumed.
+        Closing the generator before its end rolls back the transaction, which stops the query in the database.
+        '''
+
+        with self._lock:
+            self.sessions_opened += 1
+            self.sessions_active += 1
+            self.sessions_peak = max(self.sessions_peak, self.sessions_active)
+            self.read_transactions += 1
+
+        try:
+            yield from _stream_from_driver(self.driver, query, params, fetch_size, timeout)
+        finally:
+            with self._lock:
+                self.sessions_active -= 1
+
+    #---Stats
+    def pool_stats(self):
+        '''Return the pool utilization counters as a dict.'''
+
+        with self._lock:
+            return {
+                'max_pool_size': self.max_pool_size,
+                'sessions_active': self.sessions_active,
+                'sessions_peak': self.sessions_peak,
+                'sessions_opened': self.sessions_opened,
+                'sessions_reused': self.sessions_reused,
+                'read_transactions': self.read_transactions,
+                'auto_commit_queries': self.auto_commit_queries
+            }
+
+    def close(self):
+        self.driver.close()
+
+# Process-wide connection managers, by (uri, user)
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_connection_manager(uri, user, password, max_pool_size=DEFAULT_POOL_SIZE):
+    '''
+    Return the process-wide connection manager for (`uri`, `user`), creating it if needed.
+    It is closed at exit (or with `close_connections`).
+    '''
+
+    with _managers_lock:
+        manager = _managers.get((uri, user))
+        if manager is None:
+            manager = ConnectionManager(uri, user, password, max_pool_size)
+            _managers[(uri, user)] = manager
+        return manager
+
+def close_connections():
+    '''Close all the process-wide connection managers.'''
+
+    with _managers_lock:
+        for manager in _managers.values():
+            manager.close()
+        _managers.clear()
+
+atexit.register(close_connections)
+
+def reuse_session(driver):
+    '''
+    Context manager making the queries run inside it share a single session, if `driver` is a `ConnectionManager`.
+    For a plain neo4j driver, it does nothing.
+    '''
+
+    if isinstance(driver, ConnectionManager):
+        return driver.session()
+    return nullcontext()
+
+def _make_query(query, timeout):
+    '''Return `query`, with its transaction timeout (in seconds) if given.'''
+
+    if timeout is None:
+        return query
+
+    from neo4j import Query
+    return Query(query, timeout=timeout)
+
+def _read_work(timeout):
+    '''Return the transaction function of a read query (fetching all its records), with its transaction timeout if given.'''
+
+    def work(tx, query, params):
+        return list(tx.run(query, params))
+
+    if timeout is None:
+        return work
+
+    from neo4j import unit_of_work
+    return unit_of_work(timeout=timeout)(work)
+
+def _stream_from_driver(driver, query, params, fetch_size, timeout=None):
+    from neo4j import READ_ACCESS
+
+    with driver.session(default_access_mode=READ_ACCESS, fetch_size=fetch_size) as session:
+        with session.begin_transaction(timeout=timeout) as tx:
+            yield from tx.run(query, params)
+
+# Function to stream the records of a read query (with its optional parameters) instead of fetching them all.
+# The records are pulled from the server while the generator is consumed.
+def stream_query(driver, query, params=None, fetch_size=DEFAULT_FETCH_SIZE, timeout=None):
+    if isinstance(driver, ConnectionManager):
+        return driver.stream_read(query, params, fetch_size, timeout)
+    return _stream_from_driver(driver, query, params, fetch_size, timeout)
+
+def fetch_cancellable(driver, query, params=None, cancel_event=None, fetch_size=DEFAULT_FETCH_SIZE, timeout=None):
+    '''
+    Fetch all the records of a read query, stopping as soon as `cancel_event` (a `threading.Event`) is set.
+
+    The records are streamed `fetch_size` at a time, and the event is checked between two records :
+    when it is set, the stream is closed (its transaction is rolled back, which stops the query in the database)
+    and `QueryCancelled` is raised. A query that takes long before giving its first record is only stopped by `timeout`.
+    '''
+
+    records = []
+    stream = stream_query(driver, query, params, fetch_size, timeout)
+    try:
+        for record in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                raise QueryCancelled('the query was cancelled')
+            records.append(record)
+    finally:
+        stream.close()
+
+    if cancel_event is not None and cancel_event.is_set():
+        raise QueryCancelled('the query was cancelled')
+    return records
 
 # Function to connect to the Neo4j database
 def connect_to_neo4j(uri, user, password):
+    from neo4j import GraphDatabase
+
     driver = GraphDatabase.driver(uri, auth=(user, password))
     return driver
 
-# Function to run a query and fetch all results
-def run_query(driver, query):
+class AsyncConnectionManager:
+    '''
+    Same as `ConnectionManager`, with the asyncio neo4j driver : the queries of several coroutines
+    overlap their I/O on one event loop instead of running one after another.
+
+    An async session can not be shared by concurrent coroutines, so each query opens its own session
+    (the connections are still taken from the pool of the driver).
+    It must be created, used and closed (`await manager.close()`, or `async with`) in the same event loop.
+    '''
+
+    def __init__(self, uri, user, password, max_pool_size=DEFAULT_POOL_SIZE):
+        '''
+        - uri           : the uri of the database ;
+        - user          : the username to access the database ;
+        - password      : the password to access the database ;
+        - max_pool_size : the maximum number of connections kept by the driver.
+        '''
+
+        from neo4j import AsyncGraphDatabase
+
+        self.uri = uri
+        self.user = user
+        self.max_pool_size = max_pool_size
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_pool_size)
+
+        self.sessions_active = 0
+        self.sessions_peak = 0
+        self.sessions_opened = 0
+        self.read_transactions = 0
+        self.auto_commit_queries = 0
+
+    #---Sessions
+    @asynccontextmanager
+    async def session(self):
+        '''Async context manager giving a new session.'''
+
+        self.sessions_opened += 1
+        self.sessions_active += 1
+        self.sessions_peak = max(self.sessions_peak, self.sessions_active)
+        try:
+            async with self.driver.session() as session:
+                yield session
+        finally:
+            self.sessions_active -= 1
+
+    #---Queries
+    async def run_read(self, query, params=None, timeout=None):
+        '''Run `query` in a read transaction and return the list of records (see `ConnectionManager.run_read` for `timeout`).'''
+
+        async with self.session() as session:
+            records = await session.execute_read(_async_read_work(timeout), query, params)
+
+        self.read_transactions += 1
+        return records
+
+    async def run(self, query, params=None, timeout=None):
+        '''Run `query` in an auto-commit transaction (read or write) and return the list of records.'''
+
+        async with self.session() as session:
+            records = await _fetch_all(session, _make_query(query, timeout), params)
+
+        self.auto_commit_queries += 1
+        return records
+
+    #---Stats
+    def pool_stats(self):
+        '''Return the pool utilization counters as a dict.'''
+
+        return {
+            'max_pool_size': self.max_pool_size,
+            'sessions_active': self.sessions_active,
+            'sessions_peak': self.sessions_peak,
+            'sessions_opened': self.sessions_opened,
+            'read_transactions': self.read_transactions,
+            'auto_commit_queries': self.auto_commit_queries
+        }
+
+    async def close(self):
+        await self.driver.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+async def _fetch_all(runner, query, params):
+    '''Run `query` with `runner` (an async session or transaction) and return the list of records.'''
+
+    result = await runner.run(query, params)
+    return [record async for record in result]
+
+def _async_read_work(timeout):
+    '''Same as `_read_work`, for the asyncio driver.'''
+
+    if timeout is None:
+        return _fetch_all
+
+    from neo4j import unit_of_work
+    return unit_of_work(timeout=timeout)(_fetch_all)
+
+# Same as `run_query`, for the asyncio driver. `driver` can be a neo4j async driver or an `AsyncConnectionManager`.
+async def run_query_async(driver, query, params=None, read_only=False, timeout=None):
+    if isinstance(driver, AsyncConnectionManager):
+        if read_only:
+            return await driver.run_read(query, params, timeout)
+        return await driver.run(query, params, timeout)
+
+    async with driver.session() as session:
+        if read_only:
+            return await session.execute_read(_async_read_work(timeout), query, params)
+        return await _fetch_all(session, _make_query(query, timeout), params)
+
+# Function to run a query (with its optional parameters) and fetch all results.
+# `driver` can be a neo4j driver or a `ConnectionManager`. Use `read_only=True` for queries that do not write.
+# If `timeout` (in seconds) is given, the database stops the query when it runs longer (`neo4j.exceptions.ClientError`).
+def run_query(driver, query, params=None, read_only=False, timeout=None):
+    if isinstance(driver, ConnectionManager):
+        if read_only:
+            return driver.run_read(query, params, timeout)
+        return driver.run(query, params, timeout)
+
     with driver.session() as session:
-        result = session.run(query)
+        if read_only:
+            return session.execute_read(_read_work(timeout), query, params)
+        result = session.run(_make_query(query, timeout), params)
         # return result.data()
         return list(result)  # Collect all records into a list
@@ -0,0 +1,282 @@
+import os
+from math import ceil, floor
+
+import numpy as np
+
+from contour_index import MelodicContourIndex, RhythmicContourIndex
+
+# Lengths of the indexed n-grams (number of consecutive NEXT relationships)
+NGRAM_LENGTHS = (3, 4, 5)
+
+# Maximum number of keys looked up for one n-gram of a fuzzy query (product of the number of symbols allowed at each position).
+# Above, the n-gram is not used (the candidates are then less restricted, but still a superset of the matches).
+MAX_KEYS_PER_NGRAM = 1024
+
+# An n-gram whose postings hold more than this fraction of the events is not used either (it would barely restrict the candidates).
+MAX_CANDIDATE_RATIO = 0.05
+
+# Symbols are stored on one byte each in the keys : a symbol outside ]-SYMBOL_OFFSET ; SYMBOL_OFFSET[ is not indexed
+SYMBOL_OFFSET = 128
+KEY_BASE = 2 * SYMBOL_OFFSET
+
+# Duration ratios of the grid of `audio_parser.normalize_intervals` (powers of two, and dotted values)
+DURATION_RATIO_GRID = np.array(sorted([2.0**n for n in range(-3, 4)] + [1.5 * 2.0**n for n in range(-3, 4)]))
+INVALID_SYMBOL = np.iinfo(np.int64).min
+
+class NgramIndex:
+    '''
+    Inverted index from the n-grams of a quantized attribute of the NEXT relationships to the events where they start.
+
+    For each indexed length n, the index holds the sorted array of the distinct n-gram `keys`, and for the key `k`,
+    the postings `postings[offsets[k]:offsets[k + 1]]` : the (sorted) indices of the events starting this n-gram.
+    An event index stands for (source, voice, event offset) through the offset table of the corpus (see `Corpus`).
+
+    The index only gives candidates : the matches are then verified by `CorpusMatcher` with the conditions of the query.
+    The subclasses define the indexed attribute (`field`) and its quantization (`symbols`, `symbol_range`).
+    '''
+
+    field = None
+    name = None
+
+    def __init__(self, tables):
+        '''
+        - tables : dict n -> (keys, offsets, postings).
+        '''
+
+        self.tables = tables
+
+    #---Quantization
+    def symbols(self, values):
+        '''Return the symbol of each value (`INVALID_SYMBOL` for a value that is not indexed, e.g null).'''
+
+        raise NotImplementedError
+
+    def symbol_range(self, low, high):
+        '''
+        Return the (min, max) symbols of the values in [low ; high], or None if they can not all be indexed.
+        For any indexed value in [low ; high], its symbol must be in the range.
+        '''
+
+        raise NotImplementedError
+
+    #---Creation
+    @classmethod
+    def build(cls, corpus, lengths=NGRAM_LENGTHS):
+        '''Build the index of `corpus` (see `Corpus`), for the n-grams of `lengths`.'''
+
+        index = cls({})
+        symbols = index.symbols(np.asarray(corpus.events[cls.field]))
+
+        for n in lengths:
+            if len(symbols) < n:
+                index.tables[n] = (np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64))
+                continue
+
+            # The last relationship of a voice has no value, so the n-grams never cross two voices
+            windows = np.lib.stride_tricks.sliding_window_view(symbols, n)
+            valid = (windows != INVALID_SYMBOL).all(axis=1)
+            starts = np.flatnonzero(valid)
+            keys = make_keys(windows[valid])
+
+            order = np.argsort(keys, kind='stable') # The postings of a key stay sorted
+            keys, postings = keys[order], starts[order]
+            unique_keys, firsts = np.unique(keys, return_index=True)
+            index.tables[n] = (unique_keys, np.append(firsts, len(keys)).astype(np.int64), postings.astype(np.int64))
+
+        return index
+
+    #---Storage
+    def paths(self, path, n):
+        return [os.path.join(path, f'{self.name}_{n}_{table}.npy') for table in ('keys', 'offsets', 'postings')]
+
+    def save(self, path):
+        '''Save the index in the corpus directory `path` (three `.npy` files per length, written aside and then renamed).'''
+
+        for n, tables in self.tables.items():
+            for table_path, table in zip(self.paths(path, n), tables):
+                tmp_path = os.path.join(os.path.dirname(table_path), '.' + os.path.basename(table_path) + '.tmp.npy')
+                np.save(tmp_path, table)
+                os.replace(tmp_path, table_path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load the index saved in the corpus directory `path`, or return None if there is none.
+
+        - mmap : if True, the files are memory-mapped (read only) instead of being read.
+        '''
+
+        index = cls({})
+        for n in NGRAM_LENGTHS:
+            paths = index.paths(path, n)
+            if all(os.path.exists(table_path) for table_path in paths):
+                index.tables[n] = tuple(np.load(table_path, mmap_mode='r' if mmap else None) for table_path in paths)
+
+        return index if index.tables else None
+
+    #---Search
+    def lookup(self, n, keys):
+        '''
+        Return the sorted events starting one of the n-grams `keys` (of length `n`),
+        or None if they are more than `MAX_CANDIDATE_RATIO` of the postings.
+        '''
+
+        unique_keys, offsets, postings = self.tables[n]
+        positions = np.searchsorted(unique_keys, keys)
+        inside = positions < len(unique_keys)
+        positions, keys = positions[inside], keys[inside]
+        positions = positions[unique_keys[positions] == keys]
+        if not len(positions):
+            return np.empty(0, dtype=np.int64)
+        if (offsets[positions + 1] - offsets[positions]).sum() > MAX_CANDIDATE_RATIO * len(postings):
+            return None
+
+        return np.unique(np.concatenate([postings[offsets[k]:offsets[k + 1]] for k in positions]))
+
+    def candidates(self, bounds):
+        '''
+        Return the sorted events that can be the first event of a match, or None if the index can not restrict them.
+
+        - bounds : for each NEXT relationship of the query, the (low, high) bounds of its value, or None if it is not constrained.
+
+        Exact values give one key per n-gram, and the candidates are the intersection of the postings of the n-grams of the query.
+        Ranges (fuzzy queries) give the union of the postings of all the n-grams of symbols in the ranges.
+        '''
+
+        if not self.tables:
+            return None
+
+        ranges = [None if bound is None else self.symbol_range(*bound) for bound in bounds]
+        min_length, max_length = min(self.tables), max(self.tables)
+
+        #---Cut the constrained runs of relationships into n-grams
+        ngrams = [] # (position in the query, ranges)
+        run_start = 0
+        for position in range(len(ranges) + 1):
+            if position < len(ranges) and ranges[position] is not None:
+                continue
+
+            length = position - run_start
+            if length >= min_length:
+                n = min(length, max_length)
+                offsets = list(range(run_start, position - n + 1, n))
+                if offsets[-1] != position - n:
+                    offsets.append(position - n) # Overlapping, to cover the end of the run
+                ngrams.extend((offset, ranges[offset:offset + n]) for offset in offsets)
+            run_start = position + 1
+
+        #---Intersection of the candidates of each n-gram
+        candidates = None
+        for offset, ngram_ranges in ngrams:
+            nb_keys = 1
+            for low, high in ngram_ranges:
+                nb_keys *= high - low + 1
+            if nb_keys > MAX_KEYS_PER_NGRAM:
+                continue
+
+            keys = np.zeros(1, dtype=np.int64)
+            for j, (low, high) in enumerate(ngram_ranges):
+                keys = (keys[:, None] + (np.arange(low, high + 1, dtype=np.int64) + SYMBOL_OFFSET) * KEY_BASE ** j).ravel()
+
+            starts = self.lookup(len(ngram_ranges), np.sort(keys))
+            if starts is None:
+                continue
+            starts -= offset
+            starts = starts[starts >= 0]
+            candidates = starts if candidates is None else np.intersect1d(candidates, starts, assume_unique=True)
+
+        return candidates
+
+def make_keys(windows):
+    '''Return the key of each row of `windows` (the symbols of an n-gram), one byte per symbol.'''
+
+    weights = KEY_BASE ** np.arange(windows.shape[1], dtype=np.int64)
+    return ((windows + SYMBOL_OFFSET) * weights).sum(axis=1)
+
+def quantize(values):
+    '''Return the nearest integer of each value as a symbol (`INVALID_SYMBOL` if it is null or too large to be indexed).'''
+
+    symbols = np.full(len(values), INVALID_SYMBOL, dtype=np.int64)
+    with np.errstate(invalid='ignore'):
+        rounded = np.rint(values)
+        valid = np.abs(rounded) < SYMBOL_OFFSET # False for NaN
+    symbols[valid] = rounded[valid]
+    return symbols
+
+def quantize_range(low, high):
+    '''Return the (min, max) symbols (see `quantize`) of the values in [low ; high], or None if some of them are not indexed.'''
+
+    if not (np.isfinite(low) and np.isfinite(high)) or low > high:
+        return None
+
+    low, high = floor(low), ceil(high) # The nearest integer of a value of [low ; high] is in [floor(low) ; ceil(high)]
+    if low <= -SYMBOL_OFFSET or high >= SYMBOL_OFFSET:
+        return None
+    return low, high
+
+class IntervalIndex(NgramIndex):
+    '''
+    Index of the interval n-grams (`NEXT.interval`, in tones), for the transposition invariant queries.
+    The symbol of an interval is its number of semitones.
+    '''
+
+    field = 'interval'
+    name = 'interval_index'
+
+    def symbols(self, values):
+        return quantize(2 * values)
+
+    def symbol_range(self, low, high):
+        return quantize_range(2 * low, 2 * high)
+
+def snap_duration_ratios(values):
+    '''
+    Return the position in `DURATION_RATIO_GRID` of the nearest grid value of each ratio (as `normalize_intervals`,
+    the lowest one on a tie), or `INVALID_SYMBOL` if the ratio is null or not positive.
+    '''
+
+    values = np.asarray(values, dtype=float)
+    middles = (DURATION_RATIO_GRID[1:] + DURATION_RATIO_GRID[:-1]) / 2
+    symbols = np.searchsorted(middles, values, side='left').astype(np.int64)
+    with np.errstate(invalid='ignore'):
+        symbols[~(values > 0)] = INVALID_SYMBOL # False for NaN
+    return symbols
+
+class DurationRatioIndex(NgramIndex):
+    '''
+    Index of the duration ratio n-grams (`NEXT.duration_ratio`), for the homothety invariant queries.
+    The symbol of a ratio is its nearest value in `DURATION_RATIO_GRID`. As the snapping is monotonic,
+    the ratios of [low ; high] have the symbols between the ones of low and high, whatever the duration factor of the query.
+    '''
+
+    field = 'duration_ratio'
+    name = 'duration_ratio_index'
+
+    def symbols(self, values):
+        return snap_duration_ratios(values)
+
+    def symbol_range(self, low, high):
+        if np.isnan(low) or np.isnan(high) or low > high or high <= 0:
+            return None
+
+        low, high = snap_duration_ratios([max(low, DURATION_RATIO_GRID[0]), high])
+        return int(low), int(high)
+
+# Indexes built for a corpus
+INDEX_CLASSES = (IntervalIndex, DurationRatioIndex, MelodicContourIndex, RhythmicContourIndex)
+
+def load_indexes(path, mmap=True):
+    '''Return the list of the indexes saved in the corpus directory `path`.'''
+
+    indexes = [index_class.load(path, mmap) for index_class in INDEX_CLASSES]
+    return [index for index in indexes if index is not None]
+
+def build_indexes(corpus, path=None):
+    '''Build the indexes of `corpus`, and save them in the corpus directory `path` if given. Returns the list of the indexes.'''
+
+    indexes = [index_class.build(corpus) for index_class in INDEX_CLASSES]
+    if path is not None:
+        for index in indexes:
+            index.save(path)
+
+    return indexes
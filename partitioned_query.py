@@ -0,0 +1,114 @@
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from neo4j_connection import run_query
+from process_results import get_ordered_results_2, RankedSequences
+
+# Queries used to split the sources of the database into partitions (read only)
+SOURCES_QUERY = 'MATCH (e:Event) RETURN DISTINCT e.source AS source'
+SOURCE_COLLECTIONS_QUERY = '''
+MATCH (tp:TopRhythmic)-[:RHYTHMIC]->(:Measure)-[:HAS]->(e:Event)
+RETURN DISTINCT e.source AS source, tp.collection AS collection
+'''
+
+# Name of the parameter holding the sources of a partition in the partitioned query
+PARTITION_PARAMETER = 'partition_sources'
+
+# Ways to split the sources : by hash of the source, or by hash of its collection (a collection stays in one partition)
+PARTITION_KEYS = ('source', 'collection')
+
+def partition_of(key, nb_partitions):
+    '''Return the partition of `key` (a string), stable between runs and processes (unlike `hash`).'''
+
+    return zlib.crc32(key.encode('utf-8')) % nb_partitions
+
+def make_partitions(driver, nb_partitions, by='source', sources=None):
+    '''
+    Split the sources of the database into at most `nb_partitions` disjoint lists.
+
+    - driver        : the neo4j driver (or connection manager) ;
+    - nb_partitions : the number of partitions ;
+    - by            : 'source' to split by hash of the source, or 'collection' to split by hash of the collection
+                      of the source (the sources without collection are then split by hash of their source) ;
+    - sources       : the sources of the database if already known (e.g `CorpusStats.sources()`), to skip their query.
+
+    Returns the list of the non-empty partitions (lists of sources).
+    '''
+
+    if nb_partitions < 1:
+        raise ValueError(f'make_partitions: nb_partitions must be at least 1, got {nb_partitions}')
+    if by not in PARTITION_KEYS:
+        raise ValueError(f'make_partitions: unknown partition key "{by}" (expected one of {PARTITION_KEYS})')
+
+    if sources is None:
+        sources = [record['source'] for record in run_query(driver, SOURCES_QUERY, read_only=True)]
+
+    keys = {source: source for source in sources}
+    if by == 'collection':
+        for record in run_query(driver, SOURCE_COLLECTIONS_QUERY, read_only=True):
+            if record['source'] in keys and record['collection'] is not None:
+                keys[record['source']] = record['collection'] # A source of several collections follows the last one
+
+    partitions = [[] for _ in range(nb_partitions)]
+    for source, key in keys.items():
+        partitions[partition_of(key, nb_partitions)].append(source)
+
+    return [partition for partition in partitions if partition]
+
+def partition_query(crisp_query):
+    '''
+    Return the compiled query restricted to the matches starting in the sources of `$partition_sources`.
+    The condition is added at the beginning of the WHERE clause of the match (see `reformulate_fuzzy_query`).
+    '''
+
+    if '\nWHERE\n' not in crisp_query:
+        raise ValueError('partition_query: the query has no WHERE clause')
+
+    return crisp_query.replace('\nWHERE\n', f'\nWHERE\ne0.source IN ${PARTITION_PARAMETER} AND\n', 1)
+
+def merge_rankings(rankings, top_k=None):
+    '''
+    Merge sorted rankings (see `get_ordered_results_2`) into one, with a k-way heap merge.
+    On equal degrees, the sequences of the first rankings come first.
+
+    - rankings : the rankings of disjoint partitions, each sorted by decreasing degree ;
+    - top_k    : if not None, keep only the `top_k` best sequences.
+    '''
+
+    merged = heapq.merge(*rankings, key=lambda sequence: -sequence[3])
+    return RankedSequences(merged if top_k is None else islice(merged, top_k))
+
+def run_partitioned(driver, compiled_query, partitions, top_k=None, max_workers=None, timeout=None):
+    '''
+    Run a compiled fuzzy query once per partition of the sources, concurrently on the pooled driver,
+    so that the database runs the partitions on several cores, and merge their rankings.
+
+    - driver         : the connection manager (see `get_connection_manager`), shared by the worker threads ;
+    - compiled_query : the `CompiledQuery`, parameterized (see `QueryCache.compile`) ;
+    - partitions     : the lists of sources (see `make_partitions`) ;
+    - top_k          : if not None, keep only the `top_k` best sequences (of each partition, and then overall) ;
+    - max_workers    : the maximum number of partitions running at once. If None, all of them ;
+    - timeout        : the maximum duration of each partition in the database (in seconds), or None.
+
+    Returns the ranked sequences (as `get_ordered_results_2`), that the `process_results_to_*` functions use as is.
+    '''
+
+    if compiled_query.params is None:
+        raise ValueError('run_partitioned: the query must be compiled with parameters')
+
+    crisp_query = partition_query(compiled_query.crisp_query)
+
+    def run_partition(sources):
+        params = dict(compiled_query.params, **{PARTITION_PARAMETER: sources})
+        records = run_query(driver, crisp_query, params, read_only=True, timeout=timeout)
+        return get_ordered_results_2(records, compiled_query.fuzzy_query, top_k)
+
+    if not partitions:
+        return RankedSequences()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(partitions)) as executor:
+        rankings = list(executor.map(run_partition, partitions))
+
+    return merge_rankings(rankings, top_k)
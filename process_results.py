@@ -1,13 +1,29 @@
 import os
 import shutil
 import json
+import heapq
+from itertools import islice
 
-from extract_notes_from_query import extract_fuzzy_parameters, extract_attributes_with_membership_functions, extract_fuzzy_membership_functions, extract_notes_from_query_dict
-from note import Note
-from degree_computation import pitch_degree, duration_degree, sequencing_degree, aggregate_note_degrees, aggregate_sequence_degrees, aggregate_degrees, pitch_degree_with_intervals, duration_degree_with_multiplicative_factor
-from generate_audio import generate_mp3
-from utils import get_notes_from_source_and_time_interval, calculate_pitch_interval, calculate_intervals_list, calculate_dur_ratios_list
-from neo4j_connection import connect_to_neo4j, run_query
+from query_parser import parse_fuzzy_query
+from ranking_kernel import DegreeKernel
+from utils import get_notes_from_source_and_time_interval
+from neo4j_connection import reuse_session
+
+# Number of records whose degrees are computed at once
+RANKING_CHUNK_SIZE = 10000
+
+class RankedSequences(list):
+    '''
+    Sequences already ranked, as returned by `get_ordered_results_2` (e.g merged from several partitions by `run_partitioned`).
+    The `process_results_to_*` functions use them as is instead of ranking them again.
+    '''
+
+def rank_results(result, query, top_k=None):
+    '''Return the ranked sequences of `result` (see `get_ordered_results_2`), unless it is already ranked (`RankedSequences`).'''
+
+    if isinstance(result, RankedSequences):
+        return result if top_k is None else result[:top_k]
+    return get_ordered_results_2(result, query, top_k)
 
 def min_aggregation(*degrees):
     return min(degrees)
@@ -49,159 +65,63 @@ def almost_all_aggregation_yager(*degrees):
 
     return max_min_alpha_degree
 
-def get_ordered_results_2(result, query):
+def get_ordered_results_2(result, query, top_k=None):
     """
     Extracts and ranks query results based on fuzzy degrees, handling cases with or without transposition,
     and supporting arbitrary membership functions.
 
+    The records are read from `result` by chunks of `RANKING_CHUNK_SIZE`, whose degrees are computed with
+    NumPy (see `ranking_kernel`). Only the records with a degree of at least alpha are kept, and their details
+    are built only then. So `result` can be a stream of records (see `stream_query`), and the memory used
+    is then bounded by the chunk size and the number of results kept, not by the number of records.
+
+    With `top_k`, only the best `top_k` sequences are kept in a bounded min-heap. Once it is full, its minimum
+    degree acts as a dynamic alpha : records that cannot beat it are rejected before their details are built.
+    Ties are broken as in the full sort (the first records received are kept).
+
     Parameters:
-        result (list): The list of records returned from the query execution.
-        query (str): The original query string.
+        result (iterable): The records returned from the query execution (list, or stream of records).
+        query (str | FuzzyQuery): The original query string, or its parsed form.
+        top_k (int | None): The maximum number of sequences to return. If None, return them all.
 
     Returns:
         list: A sorted list of sequences, each containing source, start, end, degree, and note details.
     """
-    # Extract the query notes and fuzzy parameters
-    query_notes = extract_notes_from_query_dict(query)
-    query_notes = {node_name: attrs for node_name, attrs in query_notes.items() if attrs['type'] == 'Fact'}
-    pitch_gap, duration_factor, sequencing_gap, alpha, allow_transpose, allow_homothety = extract_fuzzy_parameters(query)
-    
-    # Extract membership functions and their associated attributes
-    attributes_with_membership_functions = extract_attributes_with_membership_functions(query)
-    membership_functions = extract_fuzzy_membership_functions(query)
-    
-    # Build the aliases used in the return clause for these attributes
-    attribute_aliases = []
-    for node_name, attribute_name, membership_function_name in attributes_with_membership_functions:
-        alias = f"{attribute_name}_{node_name}_{membership_function_name}"
-        attribute_aliases.append((alias, node_name, attribute_name, membership_function_name))
-
-    if allow_transpose:
-        intervals = calculate_intervals_list(query_notes)
-    if allow_homothety:
-        duration_ratios = calculate_dur_ratios_list(query_notes)
-
-    note_sequences = []
-    stored_attribute_values = []  # To store attribute values for membership function computation
-    
-    for record in result:
-        note_sequence = []
-        
-        fact_nb = 0  # Corresponds to the index of the first fact for the current event
-        attribute_values = {}  # Store attribute values for this record
-        for event_nb, event in enumerate(query_notes):
-            pitch = record[f"pitch_{event_nb}"]
-            octave = record[f"octave_{event_nb}"]
-            duration = record[f"duration_{event_nb}"]
-            dots = record[f"dots_{event_nb}"]
-            start = record[f"start_{event_nb}"]
-            end = record[f"end_{event_nb}"]
-            id_ = record[f"id_{event_nb}"]
-
-            # Handle dotted note duration calculation
-            if dots and dots > 0:
-                note = Note(pitch, octave, int(1 / (duration / 1.5)), dots, duration, start, end, id_)
-            else:
-                note = Note(pitch, octave, int(1 / duration), dots, duration, start, end, id_)
-
-            # Retrieve interval and duration ratio
-            interval, duration_ratio = None, None
-            if allow_transpose:
-                if event_nb > 0:
-                    interval = record[f"interval_{event_nb - 1}"]
-
-            if allow_homothety:
-                if event_nb > 0:
-                    duration_ratio = record[f"duration_ratio_{event_nb - 1}"]
-            
-            note_sequence.append((note, interval, duration_ratio))
-            fact_nb += 1  # Would be used for chords
-        
-            # Store membership function attribute values
-            for alias, node_name, attribute_name, membership_function_name in attribute_aliases:
-                attribute_values[alias] = record[alias]
-        
-        stored_attribute_values.append(attribute_values)
-        note_sequences.append((note_sequence, record['source'], record['start'], record['end']))
-    
+    kernel = DegreeKernel(parse_fuzzy_query(query))
+
+    if top_k is not None and top_k <= 0:
+        return []
+
     sequence_details = []
-    for seq_idx, (note_sequence, source, start, end) in enumerate(note_sequences):
-        note_degrees = [[] for _ in range(len(note_sequence))]  # Store degrees per note
-        interval_degrees  = [[] for _ in range(len(note_sequence)-1)] # Store degrees per interval
-        p_d_g_note_degrees = [[] for _ in range(len(note_sequence))] # Store pitch, duration and gap degrees for rendering purposes
-        
-        for idx, note_data in enumerate(note_sequence):
-            note = note_data[0]
-            interval = note_data[1]
-            duration_ratio = note_data[2]
-            query_note = query_notes[f'f{idx}']
-            pitch_deg, duration_deg, sequencing_deg = 1.0, 1.0, 1.0 # Values for rendering
-
-            # Compute pitch or interval degree
-            if pitch_gap > 0:
-                if allow_transpose:
-                    if idx > 0:  # Skip first note for interval comparison
-                        pitch_deg = pitch_degree_with_intervals(intervals[idx - 1], interval, pitch_gap)
-                        interval_degrees[idx - 1].append(pitch_deg)
-                else:
-                    if 'class' in query_note.keys() and 'octave' in query_note.keys():
-                        pitch_deg = pitch_degree(query_note['class'], query_note['octave'], note.pitch, note.octave, pitch_gap)
-                        note_degrees[idx].append(pitch_deg)
-            
-            # Compute duration degree
-            if duration_factor != 1:
-                if 'dur' in query_note.keys() and query_note['dur'] is not None:
-                    expected_duration = 1.0 / query_note['dur']
-                    if query_note.get('dots', None):
-                        expected_duration *= 1.5
-                    if allow_homothety:
-                        if idx > 0:  # Skip first note 
-                            duration_deg = duration_degree_with_multiplicative_factor(duration_ratios[idx - 1], duration_ratio, duration_factor)
-                            note_degrees[idx].append(duration_deg)
-                    else:
-                        duration_deg = duration_degree_with_multiplicative_factor(expected_duration, note.duration, duration_factor)
-                        note_degrees[idx].append(duration_deg) 
-            
-            # Compute sequencing degree
-            if sequencing_gap > 0:
-                if idx > 0:
-                    prev_note = note_sequence[idx - 1][0]
-                    sequencing_deg = sequencing_degree(prev_note.end, note.start, sequencing_gap)
-                    note_degrees[idx].append(sequencing_deg)
-            
-            p_d_g_note_degrees[idx] = [pitch_deg, duration_deg, sequencing_deg]
-            
-        # Compute degrees from membership functions
-        attribute_values = stored_attribute_values[seq_idx]
-        membership_function_degrees = [[] for _ in range(len(note_sequence))]
-        for alias, node_name, attribute_name, membership_function_name in attribute_aliases:
-            attribute_value = attribute_values[alias]
-            membership_function = membership_functions[membership_function_name]
-            degree = membership_function(attribute_value)
-            
-            idx = int(node_name[1:])
-            if node_name.startswith("n"):  # Interval-based
-                interval_degrees[idx].append(degree)
-                membership_function_degrees[idx+1].append(f'{membership_function_name}-> {round(degree, 3)}')
-            else:  # Note-based (f or e)
-                note_degrees[idx].append(degree)
-                membership_function_degrees[idx].append(f'{membership_function_name}-> {round(degree, 3)}')
-        membership_function_degrees = ["| ".join(mem_degs) for mem_degs in membership_function_degrees]
-
-        for idx in range(len(note_degrees)):
-            if idx > 0:
-                note_degrees[idx].extend(interval_degrees[idx - 1])
-        
-        # Aggregate all degrees per note
-        aggregated_degrees = [aggregate_degrees(min_aggregation, degrees) if degrees else 1.0 for degrees in note_degrees]
-        
-        # Compute sequence degree
-        sequence_degree = aggregate_degrees(min_aggregation, aggregated_degrees)
-        
-        if sequence_degree >= alpha:
-            note_details = [(note_data[0], pitch_deg, duration_deg, sequencing_deg, deg, mem_degs) for note_data, deg, (pitch_deg, duration_deg, sequencing_deg), mem_degs in zip(note_sequence, aggregated_degrees, p_d_g_note_degrees, membership_function_degrees)]
-            sequence_details.append([source, start, end, sequence_degree, note_details])
-    
+    heap = [] # (degree, -record number, details), the worst kept sequence first (used with top_k)
+    record_nb = 0
+
+    records = iter(result)
+    while True:
+        chunk = list(islice(records, RANKING_CHUNK_SIZE))
+        if not chunk:
+            break
+
+        scored_records = kernel.score(chunk)
+
+        if top_k is None:
+            sequence_details.extend(scored_records.details(scored_records.select()))
+
+        else:
+            floor = heap[0][0] if len(heap) == top_k else None
+            selected = scored_records.select(top_k, floor)
+            for i, details in zip(selected, scored_records.details(selected)):
+                entry = (details[3], -(record_nb + i), details)
+                if len(heap) < top_k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+        record_nb += len(chunk)
+
+    if top_k is not None:
+        return [details for degree, neg_record_nb, details in sorted(heap, key=lambda x: (-x[0], -x[1]))]
+
     # Sort the sequences by their overall degree in descending order
     sequence_details.sort(key=lambda x: x[3], reverse=True)
     
@@ -258,16 +178,17 @@ def process_crisp_results_to_json(result):
 
     return json.dumps(process_crisp_results_to_dict(result))
 
-def process_results_to_dict(result, query):
+def process_results_to_dict(result, query, top_k=None):
     '''
     Process the results of the query and return a sorted list of dictionaries.
     Each dictionary represent a song.
 
-    - result : the result of the query (list from `run_query`) ;
-    - query  : the *fuzzy* query (to extract info from it).
+    - result : the result of the query (list from `run_query`, or `RankedSequences`) ;
+    - query  : the *fuzzy* query (to extract info from it) ;
+    - top_k  : if not None, keep only the `top_k` best results.
     '''
 
-    sequence_details = get_ordered_results_2(result, query)
+    sequence_details = rank_results(result, query, top_k)
 
     res = []
     
@@ -293,26 +214,28 @@ def process_results_to_dict(result, query):
 
     return res
 
-def process_results_to_json(result, query):
+def process_results_to_json(result, query, top_k=None):
     '''
     Process the results of the query and return a sorted list of dictionaries.
     Each dictionary represent a song.
 
-    - result : the result of the query (list from `run_query`) ;
-    - query  : the *fuzzy* query (to extract info from it).
+    - result : the result of the query (list from `run_query`, or `RankedSequences`) ;
+    - query  : the *fuzzy* query (to extract info from it) ;
+    - top_k  : if not None, keep only the `top_k` best results.
     '''
 
-    return json.dumps(process_results_to_dict(result, query))
+    return json.dumps(process_results_to_dict(result, query, top_k))
 
-def process_results_to_text(result, query):
+def process_results_to_text(result, query, top_k=None):
     '''
     Process the results of the query and return a readable string.
 
-    - result : the result of the query (list from `run_query`) ;
-    - query  : the *fuzzy* query (to extract info from it).
+    - result : the result of the query (list from `run_query`, or `RankedSequences`) ;
+    - query  : the *fuzzy* query (to extract info from it) ;
+    - top_k  : if not None, keep only the `top_k` best results.
     '''
 
-    sequence_details = get_ordered_results_2(result, query)
+    sequence_details = rank_results(result, query, top_k)
 
     res = ''
     for source, start, end, sequence_degree, note_details in sequence_details:
@@ -335,13 +258,14 @@ def process_results_to_text(result, query):
     return res
 
 
-def process_results_to_mp3(result, query, max_files, driver):
+def process_results_to_mp3(result, query, max_files, driver, top_k=None):
+    from generate_audio import generate_mp3 # pydub is only needed here
 
-    sequence_details = get_ordered_results_2(result, query)
+    # Only the best `max_files` results are needed
+    if top_k is None or top_k > max_files:
+        top_k = max_files
 
-    if len(sequence_details) > max_files:
-        # Limit the number of files to generate
-        sequence_details = sequence_details[:max_files]
+    sequence_details = rank_results(result, query, top_k)
 
     # Clear previous results in audio directory
     audio_dir = os.path.join(os.getcwd(), "audio/output")
@@ -350,11 +274,12 @@ def process_results_to_mp3(result, query, max_files, driver):
         shutil.rmtree(audio_dir)
     os.makedirs(audio_dir)
 
-    # Generate MP3 files
-    for idx, (source, start, end, sequence_degree, note_details) in enumerate(sequence_details):
-        notes = get_notes_from_source_and_time_interval(driver, source, start, end)
-        file_name = f"{source}_{start}_{end}_{round(sequence_degree, 2)}.mp3"
-        generate_mp3(notes, file_name, audio_dir, bpm=60)
+    # Generate MP3 files (the notes of all the results are fetched in the same session)
+    with reuse_session(driver):
+        for idx, (source, start, end, sequence_degree, note_details) in enumerate(sequence_details):
+            notes = get_notes_from_source_and_time_interval(driver, source, start, end)
+            file_name = f"{source}_{start}_{end}_{round(sequence_degree, 2)}.mp3"
+            generate_mp3(notes, file_name, audio_dir, bpm=60)
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
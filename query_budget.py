@@ -0,0 +1,264 @@
+from math import prod, log2
+
+from query_parser import parse_fuzzy_query
+from reformulation_V3 import get_max_hops, estimate_selectivities
+
+# Number of semitones a searched note can take when its pitch is not constrained (range of a piano)
+PITCH_RANGE = 88
+
+# Number of durations a searched note can take when its duration is not constrained (from a 64th note to a breve)
+DURATION_RANGE = 8
+
+# Default number of rows of the LIMIT added to a query above the budget
+DEFAULT_BUDGET_LIMIT = 10000
+
+# What to do with a query above the budget : raise an error, or add a LIMIT to it
+BUDGET_POLICIES = ('refuse', 'limit')
+
+def get_pitch_width(pitch_distance, alpha):
+    '''Return the number of semitones allowed around a searched pitch (or interval), with a pitch distance of `pitch_distance` tones.'''
+
+    return 2 * int(2 * pitch_distance * (1 - alpha)) + 1
+
+def get_interval_width(low, high):
+    '''Return the number of semitones allowed by an interval in [low ; high] (in tones), at most `PITCH_RANGE`.'''
+
+    if high - low == float('inf'):
+        return PITCH_RANGE
+    return min(int(2 * (high - low)) + 1, PITCH_RANGE)
+
+def get_ratio_width(low, high):
+    '''Return the number of durations allowed by a duration ratio in [low ; high], at most `DURATION_RANGE`.'''
+
+    if low <= 0 or high == float('inf'):
+        return DURATION_RANGE
+    return min(int(log2(high / low)) + 1, DURATION_RANGE)
+
+def get_edge_bounds(query):
+    '''
+    Return the bounds of the conditions on the relationships between consecutive searched notes :
+    a dict (idx, attribute) -> [low, high] for `n{idx}.interval` and `n{idx}.duration_ratio`,
+    from their comparisons (`n0.interval >= 1`) and their membership functions (the support of `n0.interval IS leapUp`).
+    '''
+
+    supports = query.membership_function_support_intervals()
+
+    bounds = {}
+    for condition in query.conditions:
+        if condition.variable is None or not condition.variable.startswith('n') or not condition.variable[1:].isdigit():
+            continue
+        if condition.attribute not in ('interval', 'duration_ratio'):
+            continue
+
+        if condition.membership_function is not None:
+            low, high = supports.get(condition.membership_function, (float('-inf'), float('inf')))
+        elif isinstance(condition.value, (int, float)) and condition.operator in ('=', '<', '<=', '>', '>='):
+            low = condition.value if condition.operator in ('=', '>', '>=') else float('-inf')
+            high = condition.value if condition.operator in ('=', '<', '<=') else float('inf')
+        else:
+            continue
+
+        bound = bounds.setdefault((int(condition.variable[1:]), condition.attribute), [float('-inf'), float('inf')])
+        bound[0] = max(bound[0], low)
+        bound[1] = min(bound[1], high)
+
+    return bounds
+
+def get_note_widths(query):
+    '''
+    Return, for each searched note, the number of pitches (semitones) and of durations it can take :
+        - a note with a pitch (resp. a duration) allows `get_pitch_width` semitones (resp. the durations within the duration factor) ;
+        - with `ALLOW_TRANSPOSITION` (resp. `ALLOW_HOMOTHETY`), the first note is free, and the others are constrained by their interval (resp. duration ratio) ;
+        - a condition on the interval or on the duration ratio with the previous note (e.g a contour, see `get_edge_bounds`) narrows the note ;
+        - otherwise, the note allows the whole `PITCH_RANGE` (resp. `DURATION_RANGE`).
+
+    - query : the fuzzy query (string or `FuzzyQuery`).
+
+    Returns a list of (pitch width, duration width).
+    '''
+
+    query = parse_fuzzy_query(query)
+    notes = [attrs for attrs in query.notes.values() if attrs.get('type') == 'Fact']
+
+    pitch_width = get_pitch_width(query.pitch_distance, query.alpha)
+    duration_factor = query.duration_factor if query.duration_factor >= 1 else 1.0 / query.duration_factor
+    duration_width = get_ratio_width(1.0 / duration_factor, duration_factor)
+    edge_bounds = get_edge_bounds(query)
+
+    widths = []
+    for idx, attrs in enumerate(notes):
+        previous = notes[idx - 1] if idx > 0 else {}
+
+        if query.allow_transposition:
+            pitches = pitch_width if idx > 0 and attrs.get('class') is not None and previous.get('class') is not None else PITCH_RANGE
+        else:
+            pitches = pitch_width if attrs.get('class') is not None else PITCH_RANGE
+
+        if query.allow_homothety:
+            durations = duration_width if idx > 0 and attrs.get('dur') is not None and previous.get('dur') is not None else DURATION_RANGE
+        else:
+            durations = duration_width if attrs.get('dur') is not None else DURATION_RANGE
+
+        if idx > 0:
+            if (idx - 1, 'interval') in edge_bounds:
+                pitches = min(pitches, get_interval_width(*edge_bounds[(idx - 1, 'interval')]))
+            if (idx - 1, 'duration_ratio') in edge_bounds:
+                durations = min(durations, get_ratio_width(*edge_bounds[(idx - 1, 'duration_ratio')]))
+
+        widths.append((pitches, durations))
+
+    return widths
+
+def estimate_expansion(query):
+    '''
+    Estimate the size of the path expansion of a fuzzy query in the database, from its shape only (no statistics needed).
+
+    It is the number of event paths that can follow each starting event (with a duration gap, two consecutive searched events
+    are linked by up to `get_max_hops(duration_gap)` NEXT relationships), times the number of pitch and duration combinations
+    that the searched notes allow (see `get_note_widths`).
+
+    The result is only a relative cost : a query without tolerance costs 1.
+
+    - query : the fuzzy query (string or `FuzzyQuery`).
+    '''
+
+    query = parse_fuzzy_query(query)
+
+    widths = get_note_widths(query)
+    if not widths:
+        return 1
+
+    hops = get_max_hops(query.duration_gap) if query.duration_gap > 0 else 1
+    return hops ** (len(widths) - 1) * prod(pitches * durations for pitches, durations in widths)
+
+def add_limit(crisp_query, limit):
+    '''
+    Return the compiled query with a LIMIT of `limit` rows.
+    A query ranked on the database (see `reformulate_fuzzy_query`) already ends with its own LIMIT, so it is returned as is.
+    '''
+
+    if '\nLIMIT ' in crisp_query:
+        return crisp_query
+    return f'{crisp_query}\nLIMIT {int(limit)}'
+
+def check_budget(compiled_query, max_expansion=None, policy='refuse', limit=DEFAULT_BUDGET_LIMIT):
+    '''
+    Check that a compiled fuzzy query fits in the budget, before sending it, so that a careless combination
+    of duration gap and pitch distance does not run for minutes in the shared database.
+
+    - compiled_query : the `CompiledQuery` (see `QueryCache.compile`) ;
+    - max_expansion  : the maximum estimated expansion (see `estimate_expansion`). If None (default), there is no budget ;
+    - policy         : above the budget, 'refuse' raises a ValueError, and 'limit' adds a LIMIT of `limit` rows to the query
+                       (the ranking is then done on the first matches found, not on all of them).
+
+    Returns the crisp query to send.
+    '''
+
+    if policy not in BUDGET_POLICIES:
+        raise ValueError(f'check_budget: unknown policy "{policy}" (expected one of {BUDGET_POLICIES})')
+
+    if max_expansion is None:
+        return compiled_query.crisp_query
+
+    expansion = estimate_expansion(compiled_query.fuzzy_query)
+    if expansion <= max_expansion:
+        return compiled_query.crisp_query
+
+    if policy == 'refuse':
+        raise ValueError(f'check_budget: the estimated expansion of the query ({expansion}) is above the budget ({max_expansion}). {get_budget_advice(compiled_query.fuzzy_query)}')
+    return add_limit(compiled_query.crisp_query, limit)
+
+def get_budget_advice(query):
+    '''Return what can be changed to reduce the expansion of a query, from what makes it large (see `estimate_expansion`).'''
+
+    query = parse_fuzzy_query(query)
+
+    advice = []
+    if query.duration_gap > 0:
+        advice.append('reduce the duration gap')
+    if query.pitch_distance > 0 or query.duration_factor != 1:
+        advice.append('reduce the pitch distance or the duration factor')
+    if any(pitches == PITCH_RANGE or durations == DURATION_RANGE for pitches, durations in get_note_widths(query)):
+        advice.append('constrain the free notes (their pitch, duration, or their interval / duration ratio with the previous note)')
+    advice.append('search fewer notes')
+
+    return 'To reduce it : ' + ', '.join(advice[:-1]) + (' or ' if len(advice) > 1 else '') + advice[-1] + '.'
+
+#---Estimation
+# Latency classes of the estimates, with the maximum number of paths the database examines (see `estimate_query`).
+# Above the last one, the query is 'very slow'.
+LATENCY_CLASSES = (('fast', 10 ** 4), ('medium', 10 ** 6), ('slow', 10 ** 8))
+
+def get_latency_class(work):
+    '''Return the latency class (see `LATENCY_CLASSES`) of a query examining `work` paths.'''
+
+    for name, max_work in LATENCY_CLASSES:
+        if work <= max_work:
+            return name
+    return 'very slow'
+
+def get_gap_expansion(duration_gap, stats):
+    '''
+    Estimate the gap expansion factor : the mean number of events that can follow a searched event within `duration_gap`
+    (1 without gap). It is 1 plus the number of mean events fitting in the gap, bounded by `get_max_hops(duration_gap)`.
+    '''
+
+    if duration_gap <= 0:
+        return 1.0
+
+    histogram = stats.histograms.get(('Event', 'duration')) or stats.histograms.get(('Fact', 'duration'))
+    mean_duration = None if histogram is None else histogram.mean()
+    if not mean_duration:
+        return float(get_max_hops(duration_gap))
+
+    return min(1 + duration_gap / mean_duration, get_max_hops(duration_gap))
+
+def estimate_query(query, stats):
+    '''
+    Estimate the number of rows returned by a compiled fuzzy query, and how long it runs, from the corpus statistics only
+    (without the database), e.g to warn before sending it, or to choose between a fast and an exhaustive search.
+
+    The selectivity of each searched note and of each relationship between two of them comes from the histograms
+    (see `estimate_selectivities`). As the database, the estimate starts from the most selective note,
+    and expands the partial matches to the following notes and then to the previous ones : each step examines
+    the events following (or preceding) the ones of the partial matches (see `get_gap_expansion`), and keeps
+    the ones satisfying the conditions. The conditions on the source or on the collection are not counted.
+
+    - query : the fuzzy query (string, or `FuzzyQuery` to skip the parsing, e.g `CompiledQuery.fuzzy_query`) ;
+    - stats : the corpus statistics (`CorpusStats`).
+
+    Returns a dict with :
+        - `rows`          : the estimated number of matches (rows returned) ;
+        - `work`          : the estimated number of paths examined by the database ;
+        - `gap_expansion` : the estimated number of events following a searched event ;
+        - `latency`       : the latency class of the query (see `get_latency_class`).
+    '''
+
+    query = parse_fuzzy_query(query)
+    fact_fractions, edge_fractions = estimate_selectivities(query, stats)
+
+    nb_events = stats.counts.get('Event', 0)
+    gap_expansion = get_gap_expansion(query.duration_gap, stats)
+    if not fact_fractions or nb_events == 0:
+        return {'rows': 0, 'work': 0, 'gap_expansion': gap_expansion, 'latency': get_latency_class(0)}
+
+    # Number of facts of an event (chords), and of events following an event (voices)
+    facts_per_event = stats.counts.get('Fact', 0) / nb_events
+    next_per_event = stats.counts.get('NEXT', 0) / nb_events
+    step = next_per_event * gap_expansion * facts_per_event
+
+    note_selectivities = [prod(fractions.values()) for fractions in fact_fractions]
+    edge_selectivities = [prod(fractions.values()) for fractions in edge_fractions]
+
+    anchor = min(range(len(note_selectivities)), key=note_selectivities.__getitem__)
+    rows = stats.counts.get('Fact', 0) * note_selectivities[anchor]
+    work = rows
+
+    # The edge between the notes idx and idx + 1 is `edge_selectivities[idx]`
+    steps = [(idx, idx - 1) for idx in range(anchor + 1, len(note_selectivities))] + [(idx, idx) for idx in range(anchor - 1, -1, -1)]
+    for idx, edge in steps:
+        rows *= step
+        work += rows
+        rows *= note_selectivities[idx] * edge_selectivities[edge]
+
+    return {'rows': round(rows), 'work': round(work), 'gap_expansion': gap_expansion, 'latency': get_latency_class(work)}
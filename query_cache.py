@@ -0,0 +1,281 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from refactor import refactor_variable_names
+from query_parser import parse_fuzzy_query, tokenize, is_number, VALUE, KEYWORD
+from reformulation_V3 import reformulate_fuzzy_query
+
+# Bump this when the compilation changes, so that entries written by an older version are not reused
+CACHE_VERSION = 3
+
+# Cypher keywords that are upper-cased in the canonical form (the other identifiers are case sensitive)
+CANONICAL_KEYWORDS = {'AND', 'OR', 'NOT', 'XOR', 'IS', 'NULL', 'IN', 'AS', 'RETURN', 'DISTINCT', 'ORDER', 'BY', 'ASC', 'DESC', 'LIMIT', 'SKIP', 'WITH', 'TRUE', 'FALSE'}
+
+def normalize_tokens(text):
+    '''
+    Return `text` with normalized whitespaces, numbers and keywords.
+    E.g `f0.octave=05 and e0.duration = 0.50` -> `f0.octave = 5 AND e0.duration = 0.5`.
+
+    - text : a part of a query.
+    '''
+
+    words = []
+    for token in tokenize(text)[:-1]:
+        if is_number(token):
+            words.append(repr(float(token[VALUE])) if '.' in token[VALUE] else str(int(token[VALUE])))
+        elif token[KEYWORD] in CANONICAL_KEYWORDS:
+            words.append(token[KEYWORD])
+        else:
+            words.append(token[VALUE])
+
+    return ' '.join(words)
+
+def canonicalize_query(query):
+    '''
+    Compute the canonical form of a fuzzy query.
+
+    Variables are renamed with `refactor_variable_names`, the fuzzy parameters and membership
+    functions are written in a fixed order, the conditions of the WHERE clause are sorted,
+    and whitespaces / numbers are normalized.
+    So two queries that differ only by these aspects have the same canonical form.
+
+    - query : the fuzzy query (string).
+
+    Returns the canonical text and the `FuzzyQuery` of the renamed query.
+    '''
+
+    fuzzy_query = parse_fuzzy_query(refactor_variable_names(query))
+
+    lines = []
+    for name in sorted(fuzzy_query.membership_functions):
+        function = fuzzy_query.membership_functions[name]
+        lines.append(f"{function.kind} {name} AS ({', '.join(repr(p) for p in function.parameters)})")
+
+    lines.append('MATCH')
+    if fuzzy_query.allow_transposition:
+        lines.append('ALLOW_TRANSPOSITION')
+    if fuzzy_query.allow_homothety:
+        lines.append('ALLOW_HOMOTHETY')
+    lines.append(f'TOLERANT pitch={fuzzy_query.pitch_distance!r}, duration={fuzzy_query.duration_factor!r}, gap={fuzzy_query.duration_gap!r}')
+    lines.append(f'ALPHA {fuzzy_query.alpha!r}')
+
+    lines.append(normalize_tokens(fuzzy_query.match_body))
+    if fuzzy_query.conditions:
+        lines.append('WHERE ' + ' AND '.join(sorted(set(normalize_tokens(condition.text) for condition in fuzzy_query.conditions))))
+    if fuzzy_query.tail:
+        lines.append(normalize_tokens(fuzzy_query.tail))
+
+    return '\n'.join(lines), fuzzy_query
+
+class CompiledQuery:
+    '''
+    What is stored in the cache : the crisp query, its parameters (None if the values are inlined),
+    and the parsed fuzzy query used to rank the results.
+    '''
+
+    def __init__(self, crisp_query, fuzzy_query, params=None):
+        self.crisp_query = crisp_query
+        self.fuzzy_query = fuzzy_query
+        self.params = params
+
+class QueryCache:
+    '''
+    Cache of compiled fuzzy queries, keyed by their canonical form. It can be shared between threads.
+
+    It has two tiers :
+        - an in-memory LRU tier, holding at most `max_entries` entries ;
+        - an optional on-disk tier (in `cache_dir`), shared between processes. When its size
+          exceeds `max_disk_bytes`, the least recently used files are removed.
+    '''
+
+    def __init__(self, max_entries=256, cache_dir=None, max_disk_bytes=64 * 1024 * 1024, skip_max_gap=None, stats=None):
+        '''
+        - max_entries    : the maximum number of entries in memory ;
+        - cache_dir      : the directory of the on-disk tier. If None, only the memory tier is used ;
+        - max_disk_bytes : the maximum size of the on-disk tier, in bytes ;
+        - skip_max_gap   : the maximum gap of the SKIP relationships of the database, used by the compiled queries
+                           (see `reformulate_fuzzy_query`). None if there are none ;
+        - stats          : the corpus statistics (`CorpusStats`) used to choose where the compiled queries start
+                           (see `reformulate_fuzzy_query`), or None.
+        '''
+
+        if max_entries < 1:
+            raise ValueError(f'QueryCache: max_entries must be at least 1, got {max_entries}')
+
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.skip_max_gap = skip_max_gap
+        self.stats = stats
+
+        self.entries = OrderedDict() # key -> CompiledQuery, the least recently used first
+        self.aliases = OrderedDict() # (query text, compile options) -> key, to skip the canonicalization of queries already seen as is
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.RLock() # Protects the memory tier and the counters
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, canonical_query):
+        '''Return the key of a canonical query.'''
+
+        return hashlib.sha256(f'{CACHE_VERSION}\n{canonical_query}'.encode('utf-8')).hexdigest()
+
+    def stats_fingerprint(self):
+        '''Return the fingerprint of the statistics used by the compilation (None without statistics).'''
+
+        return None if self.stats is None else self.stats.fingerprint
+
+    #---Memory tier
+    def get(self, key):
+        '''Return the entry for `key`, or None if it is in neither tier.'''
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_from_disk(key)
+
+        with self._lock:
+            if entry is not None:
+                self._store_in_memory(key, entry)
+                self.disk_hits += 1
+                return entry
+
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        '''Store `entry` in both tiers.'''
+
+        self._store_in_memory(key, entry)
+        self._write_to_disk(key, entry)
+
+    def _store_in_memory(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    #---Disk tier
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def _read_from_disk(self, key):
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            return None
+        except Exception: # Corrupted (or outdated) file : drop it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        return entry
+
+    def _write_to_disk(self, key, entry):
+        if self.cache_dir is None:
+            return
+
+        # Write to a temporary file and rename it, so that other processes never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        '''Remove the least recently used files until the on-disk tier fits in `max_disk_bytes`.'''
+
+        files = []
+        total_size = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # Removed by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        files.sort()
+        for mtime, size, path in files:
+            if total_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        '''Empty both tiers.'''
+
+        with self._lock:
+            self.entries.clear()
+            self.aliases.clear()
+        if self.cache_dir is not None:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.pickle'):
+                    os.remove(entry.path)
+
+    #---Compilation
+    def compile(self, query, parameterized=False, rank_on_server=False, top_k=None):
+        '''
+        Compile a fuzzy query, using the cache.
+
+        - query          : the fuzzy query (string) ;
+        - parameterized  : if True, the values of the searched notes are given as parameters (see `reformulate_fuzzy_query`) ;
+        - rank_on_server : if True, the degrees are computed, filtered and ordered by the database (see `reformulate_fuzzy_query`) ;
+        - top_k          : with `rank_on_server`, only the `top_k` best matches are returned.
+
+        Returns a `CompiledQuery`. Its `fuzzy_query` is the one that must be used to rank the results
+        (its variables may have been renamed).
+        '''
+
+        alias = (query, parameterized, rank_on_server, top_k)
+        with self._lock:
+            key = self.aliases.get(alias)
+            if key is not None and key in self.entries:
+                self.aliases.move_to_end(alias)
+                return self.get(key)
+
+        canonical_query, fuzzy_query = canonicalize_query(query)
+        key = self.make_key(f'{canonical_query}\n{parameterized}\n{rank_on_server}\n{top_k}\n{self.skip_max_gap}\n{self.stats_fingerprint()}')
+
+        entry = self.get(key)
+        if entry is None:
+            params = {} if parameterized else None
+            entry = CompiledQuery(reformulate_fuzzy_query(fuzzy_query, params, rank_on_server, top_k, self.skip_max_gap, self.stats), fuzzy_query, params)
+            self.put(key, entry)
+
+        with self._lock:
+            self.aliases[alias] = key
+            while len(self.aliases) > self.max_entries:
+                self.aliases.popitem(last=False)
+
+        return entry
@@ -0,0 +1,583 @@
+import re
+
+from extract_notes_from_query import create_trapezoidal_function, create_ascending_function, create_descending_function
+
+# Single regex used to tokenize the whole query in one pass.
+# Each match is (skipped whitespaces and comments, token).
+# Order matters: multi-character operators must be tried before single characters.
+TOKEN_REGEX = re.compile(r'''
+    ((?:\s|//[^\n]*)*)
+    ('[^']*'|"[^"]*"|\d+(?:\.\d+)?|[A-Za-z_]\w*|`[^`]*`|->|<-|--|\.\.|<=|>=|<>|!=|=~|.)?
+''', re.VERBOSE | re.DOTALL)
+
+# A token is a tuple (value, start, end, keyword), where `keyword` is the upper case value
+# (used for case insensitive keyword comparisons). The last token is always an EOF token.
+VALUE, START, END, KEYWORD = range(4)
+EOF = ''
+
+# Keywords that close the pattern part of a MATCH clause
+MATCH_END_KEYWORDS = {'WHERE', 'RETURN', 'WITH', 'ORDER', 'LIMIT', 'SKIP', 'UNION', 'OPTIONAL', EOF}
+
+# Keywords that close the WHERE clause
+WHERE_END_KEYWORDS = {'RETURN', 'WITH', 'ORDER', 'LIMIT', 'SKIP', 'UNION', 'OPTIONAL', 'DETACH', 'DELETE', 'SET', 'CREATE', EOF}
+
+# Comparison operators recognised in `variable.attribute operator value` conditions
+COMPARISON_OPERATORS = {'=', '!=', '<>', '<', '>', '<=', '>=', 'IS'}
+
+# Number of parameters expected by each kind of membership function definition
+MEMBERSHIP_FUNCTION_ARITY = {'DEFINETRAP': 4, 'DEFINEASC': 2, 'DEFINEDESC': 2}
+
+# Default values of the TOLERANT parameters
+TOLERANT_DEFAULTS = {'pitch': 0.0, 'duration': 1.0, 'gap': 0.0}
+
+def is_identifier(token):
+    '''Return True iff `token` is an identifier (variable, label, keyword, ...).'''
+
+    first = token[VALUE][:1]
+    return first.isalpha() or first in ('_', '`')
+
+def is_number(token):
+    '''Return True iff `token` is a (non negative) number.'''
+
+    return token[VALUE][:1].isdigit()
+
+class MembershipFunction:
+    def __init__(self, kind, name, parameters):
+        self.kind = kind # 'DEFINETRAP', 'DEFINEASC' or 'DEFINEDESC'
+        self.name = name
+        self.parameters = parameters
+
+    def support_interval(self):
+        '''
+        Return the support interval (min_value, max_value) of the membership function.
+        For ascending functions, `max_value` is `float('inf')`, for descending ones, `min_value` is `float('-inf')`.
+        '''
+
+        if self.kind == 'DEFINETRAP':
+            return (self.parameters[0], self.parameters[3])
+        elif self.kind == 'DEFINEASC':
+            return (self.parameters[0], float('inf'))
+        else:
+            return (float('-inf'), self.parameters[1])
+
+    def core_interval(self):
+        '''
+        Return the core interval (min_value, max_value) of the membership function : the values with a membership degree of 1.
+        For ascending functions, `max_value` is `float('inf')`, for descending ones, `min_value` is `float('-inf')`.
+        '''
+
+        if self.kind == 'DEFINETRAP':
+            return (self.parameters[1], self.parameters[2])
+        elif self.kind == 'DEFINEASC':
+            return (self.parameters[1], float('inf'))
+        else:
+            return (float('-inf'), self.parameters[0])
+
+    def to_function(self):
+        '''Return the python function corresponding to the membership function.'''
+
+        if self.kind == 'DEFINETRAP':
+            return create_trapezoidal_function(*self.parameters)
+        elif self.kind == 'DEFINEASC':
+            return create_ascending_function(*self.parameters)
+        else:
+            return create_descending_function(*self.parameters)
+
+    def __repr__(self):
+        return f"{self.kind} {self.name} AS {self.parameters}"
+
+class PatternElement:
+    def __init__(self, is_node, variable, label, properties):
+        self.is_node = is_node
+        self.variable = variable
+        self.label = label
+        self.properties = properties # List of (key, value_text), moved to the WHERE clause
+
+    def to_cypher(self):
+        '''Return the element as cypher, without its properties.'''
+
+        content = f'{self.variable}:{self.label}' if self.label else self.variable
+        return f'({content})' if self.is_node else f'[{content}]'
+
+    def __repr__(self):
+        return self.to_cypher()
+
+class Pattern:
+    def __init__(self, text, elements):
+        self.text = text # The pattern without properties
+        self.elements = elements
+
+    def node_variables(self):
+        '''Return the names of the (named) nodes in the pattern.'''
+
+        return [element.variable for element in self.elements if element.is_node and element.variable]
+
+    def __repr__(self):
+        return self.text
+
+class Condition:
+    def __init__(self, text, variable=None, attribute=None, operator=None, value=None, membership_function=None, equalities=None):
+        self.text = text
+        self.variable = variable
+        self.attribute = attribute
+        self.operator = operator
+        self.value = value
+        self.membership_function = membership_function # Name of the membership function if the condition is `x.attr IS name`
+        self.equalities = [] if equalities is None else equalities # (variable, attribute, value) for each `x.attr = value`
+
+    def __repr__(self):
+        return self.text
+
+class FuzzyQuery:
+    '''
+    Typed representation of a fuzzy query.
+
+    It is built once by `parse_fuzzy_query`, and every compilation / ranking stage reads from it
+    instead of scanning the query text again.
+    '''
+
+    def __init__(self, membership_functions, tolerant, alpha, allow_transposition, allow_homothety, patterns, match_body, conditions, tail):
+        self.membership_functions = membership_functions # name -> MembershipFunction
+        self.pitch_distance = tolerant['pitch']
+        self.duration_factor = tolerant['duration']
+        self.duration_gap = tolerant['gap']
+        self.alpha = alpha
+        self.allow_transposition = allow_transposition
+        self.allow_homothety = allow_homothety
+        self.patterns = patterns
+        self.match_body = match_body # Patterns of the MATCH clause, without properties
+        self.conditions = conditions # Conditions of the WHERE clause, including the moved properties
+        self.tail = tail # What follows the WHERE clause (RETURN, ...)
+
+        self.notes = self._build_notes_dict()
+        self.attributes_with_membership_functions = [
+            [condition.variable, condition.attribute, condition.membership_function]
+            for condition in self.conditions if condition.membership_function is not None
+        ]
+
+    def fuzzy_parameters(self):
+        '''Return the parameters in the same order as `extract_fuzzy_parameters`.'''
+
+        return self.pitch_distance, self.duration_factor, self.duration_gap, self.alpha, self.allow_transposition, self.allow_homothety
+
+    def membership_function_support_intervals(self):
+        '''Return a dict with the support interval of each membership function.'''
+
+        return {name: function.support_interval() for name, function in self.membership_functions.items()}
+
+    def membership_function_core_intervals(self):
+        '''Return a dict with the core interval (values of degree 1) of each membership function.'''
+
+        return {name: function.core_interval() for name, function in self.membership_functions.items()}
+
+    def membership_function_callables(self):
+        '''Return a dict with the python function of each membership function.'''
+
+        return {name: function.to_function() for name, function in self.membership_functions.items()}
+
+    def _build_notes_dict(self):
+        '''Build the same dictionary as `extract_notes_from_query_dict`.'''
+
+        notes = {}
+        for pattern in self.patterns:
+            for element in pattern.elements:
+                attributes = notes.setdefault(element.variable, {})
+                if element.label:
+                    attributes['type'] = element.label
+
+        for condition in self.conditions:
+            for variable, attribute, value in condition.equalities:
+                if variable in notes:
+                    notes[variable][attribute] = value
+                else:
+                    notes[variable] = {attribute: value}
+
+        return notes
+
+def tokenize(query):
+    '''
+    Split `query` into a list of tokens (whitespaces and comments are dropped).
+    The list always ends with an EOF token.
+
+    - query : the fuzzy query.
+    '''
+
+    tokens = []
+    position = 0
+    for skipped, value in TOKEN_REGEX.findall(query):
+        start = position + len(skipped)
+        position = start + len(value)
+        if value:
+            tokens.append((value, start, position, value.upper()))
+
+    tokens.append((EOF, len(query), len(query), EOF))
+    return tokens
+
+def parse_value(value, operator):
+    '''
+    Convert the textual `value` of a condition to a python value, the same way `extract_notes_from_query_dict` does.
+
+    - value    : the text on the right of the operator ;
+    - operator : the (upper case) operator.
+    '''
+
+    # Remove surrounding parentheses from value if present
+    if value.startswith('(') and value.endswith(')'):
+        value = value[1:-1].strip()
+
+    if (value.startswith("'") and value.endswith("'")) or (value.startswith('"') and value.endswith('"')):
+        value = value[1:-1]
+    elif operator in ('IS', 'IS NOT'):
+        value = value.upper()
+    else:
+        try:
+            if '.' in value:
+                value = float(value)
+            else:
+                value = int(value)
+        except ValueError:
+            pass
+
+    if value == 'None':
+        value = None
+
+    return value
+
+def format_property_value(value):
+    '''Format a property value of the MATCH clause as it will appear in the WHERE clause (strings are quoted).'''
+
+    if not (value.startswith("'") and value.endswith("'")) and not (value.startswith('"') and value.endswith('"')):
+        if not re.match(r'^-?\d+(\.\d+)?$', value) and value.lower() not in ('true', 'false', 'null'):
+            value = f"'{value}'"
+
+    return value
+
+class _Parser:
+    '''Recursive descent parser for the fuzzy query dialect.'''
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    #---Helpers
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        if token[VALUE] != EOF:
+            self.pos += 1
+        return token
+
+    def error(self, message, token=None):
+        if token is None:
+            token = self.peek()
+        where = 'end of query' if token[VALUE] == EOF else f'position {token[START]} ({token[VALUE]!r})'
+        return ValueError(f'{message} at {where}')
+
+    def expect(self, keyword):
+        if self.peek()[KEYWORD] != keyword:
+            raise self.error(f'Expected "{keyword}"')
+        return self.advance()
+
+    def parse_number(self):
+        sign = 1
+        if self.peek()[VALUE] == '-':
+            self.advance()
+            sign = -1
+        if not is_number(self.peek()):
+            raise self.error('Expected a number')
+        return sign * float(self.advance()[VALUE])
+
+    #---Grammar
+    def parse(self):
+        membership_functions = self.parse_definitions()
+
+        self.expect('MATCH')
+        tolerant, alpha, allow_transposition, allow_homothety = self.parse_match_modifiers()
+        patterns, match_body = self.parse_patterns()
+
+        conditions = []
+        if self.peek()[KEYWORD] == 'WHERE':
+            self.advance()
+            conditions = self.parse_conditions(membership_functions)
+
+        # Properties defined in the MATCH clause are moved to the WHERE clause
+        for pattern in patterns:
+            for element in pattern.elements:
+                for key, value in element.properties:
+                    text = f"{element.variable}.{key} = {value}"
+                    value = parse_value(value, '=')
+                    conditions.append(Condition(text, element.variable, key, '=', value, equalities=[(element.variable, key, value)]))
+
+        tail = self.query[self.peek()[START]:].strip()
+
+        return FuzzyQuery(membership_functions, tolerant, alpha, allow_transposition, allow_homothety, patterns, match_body, conditions, tail)
+
+    def parse_definitions(self):
+        '''DEFINETRAP name AS (a, b, c, d) | DEFINEASC name AS (g, d) | DEFINEDESC name AS (g, d)'''
+
+        membership_functions = {}
+        while self.peek()[KEYWORD] != 'MATCH':
+            token = self.advance()
+            if token[VALUE] == EOF:
+                raise ValueError('No MATCH clause found in the query')
+            if token[KEYWORD] not in MEMBERSHIP_FUNCTION_ARITY:
+                raise self.error('Expected a membership function definition or MATCH', token)
+
+            kind = token[KEYWORD]
+            name = self.advance()
+            if not is_identifier(name):
+                raise self.error(f'Expected a name after {kind}', name)
+            name = name[VALUE]
+
+            self.expect('AS')
+            self.expect('(')
+            parameters = [self.parse_number()]
+            while self.peek()[VALUE] == ',':
+                self.advance()
+                parameters.append(self.parse_number())
+            self.expect(')')
+
+            if len(parameters) != MEMBERSHIP_FUNCTION_ARITY[kind]:
+                raise ValueError(f'{kind} {name} expects {MEMBERSHIP_FUNCTION_ARITY[kind]} parameters, but {len(parameters)} were given')
+
+            membership_functions[name] = MembershipFunction(kind, name, tuple(parameters))
+
+        return membership_functions
+
+    def parse_match_modifiers(self):
+        '''ALLOW_TRANSPOSITION, ALLOW_HOMOTHETY, TOLERANT k=v, ..., ALPHA a (any order, before the first pattern)'''
+
+        tolerant = dict(TOLERANT_DEFAULTS)
+        alpha = 0.0
+        allow_transposition = False
+        allow_homothety = False
+
+        while self.peek()[VALUE] not in ('(', EOF):
+            token = self.advance()
+
+            if token[KEYWORD] == 'ALLOW_TRANSPOSITION':
+                allow_transposition = True
+            elif token[KEYWORD] == 'ALLOW_HOMOTHETY':
+                allow_homothety = True
+            elif token[KEYWORD] == 'ALPHA':
+                alpha = self.parse_number()
+            elif token[KEYWORD] == 'TOLERANT':
+                while True:
+                    key = self.advance()
+                    if key[VALUE] not in tolerant:
+                        raise self.error('Expected one of ' + ', '.join(tolerant), key)
+                    self.expect('=')
+                    tolerant[key[VALUE]] = self.parse_number()
+
+                    # The comma may also separate the last parameter from the first pattern
+                    if self.peek()[VALUE] == ',' and self.peek(1)[VALUE] in tolerant:
+                        self.advance()
+                    else:
+                        break
+            else:
+                raise self.error('Unexpected token in MATCH clause', token)
+
+        return tolerant, alpha, allow_transposition, allow_homothety
+
+    def parse_patterns(self):
+        '''Parse the comma separated patterns of the MATCH clause. Return the patterns and the MATCH body without properties.'''
+
+        query = self.query
+        tokens = self.tokens
+        patterns = []
+        typed_variables = {True: set(), False: set()} # is_node -> variables already typed
+        body_parts = []
+        cursor = tokens[self.pos][START] # Position up to which the source has been copied in `body_parts`
+
+        token = tokens[self.pos]
+        while token[KEYWORD] not in MATCH_END_KEYWORDS:
+            pattern_start = token[START]
+            elements = []
+            pattern_parts = []
+            pattern_cursor = pattern_start
+            last_end = pattern_start
+
+            while token[VALUE] != ',' and token[KEYWORD] not in MATCH_END_KEYWORDS:
+                if token[VALUE] in ('(', '['):
+                    element, element_end = self.parse_element()
+                    if element.label:
+                        typed_variables[element.is_node].add(element.variable)
+                    elif element.variable not in typed_variables[element.is_node]:
+                        raise ValueError(f'{"Node" if element.is_node else "Relationship"} "{element.variable}" is not typed in the MATCH clause')
+                    elements.append(element)
+                    pattern_parts.append(query[pattern_cursor:token[START]])
+                    pattern_parts.append(element.to_cypher())
+                    pattern_cursor = element_end
+                    last_end = element_end
+                else:
+                    self.pos += 1
+                    last_end = token[END]
+                token = tokens[self.pos]
+
+            pattern_parts.append(query[pattern_cursor:last_end])
+            pattern_text = ''.join(pattern_parts)
+            patterns.append(Pattern(pattern_text.strip(), elements))
+
+            body_parts.append(query[cursor:pattern_start])
+            body_parts.append(pattern_text)
+            cursor = last_end
+
+            if token[VALUE] == ',':
+                self.pos += 1
+                token = tokens[self.pos]
+
+        return patterns, ''.join(body_parts).strip()
+
+    def parse_element(self):
+        '''Parse a node `(var:Label{props})` or a relationship `[var:TYPE{props}]`. Return the element and its end position.'''
+
+        is_node = self.advance()[VALUE] == '('
+        close = ')' if is_node else ']'
+
+        variable = ''
+        label = None
+        properties = []
+
+        if is_identifier(self.peek()):
+            variable = self.advance()[VALUE]
+
+        if self.peek()[VALUE] == ':':
+            label_start = self.advance()[END]
+            label_end = label_start
+            while self.peek()[VALUE] not in ('{', close, EOF):
+                label_end = self.advance()[END]
+            label = self.query[label_start:label_end].strip() or None
+
+        if self.peek()[VALUE] == '{':
+            self.advance()
+            while self.peek()[VALUE] not in ('}', EOF):
+                key = self.advance()
+                if not is_identifier(key) or self.peek()[VALUE] not in (':', '='):
+                    raise self.error('Invalid property format', key)
+                self.advance()
+
+                value_start = self.peek()[START]
+                value_end = value_start
+                while self.peek()[VALUE] not in (',', '}', EOF):
+                    value_end = self.advance()[END]
+                properties.append((key[VALUE], format_property_value(self.query[value_start:value_end].strip())))
+
+                if self.peek()[VALUE] == ',':
+                    self.advance()
+            self.expect('}')
+
+        if self.peek()[VALUE] != close:
+            raise self.error(f'Expected "{close}"')
+        end = self.advance()[END]
+
+        return PatternElement(is_node, variable, label, properties), end
+
+    def parse_conditions(self, membership_functions):
+        '''Parse the WHERE clause into a list of conditions separated by AND.'''
+
+        tokens = self.tokens
+        conditions = []
+        condition_start = self.pos
+
+        token = tokens[self.pos]
+        while token[KEYWORD] not in WHERE_END_KEYWORDS:
+            if token[KEYWORD] == 'AND':
+                if condition_start < self.pos:
+                    conditions.append(self.make_condition(tokens[condition_start:self.pos], membership_functions))
+                condition_start = self.pos + 1
+            self.pos += 1
+            token = tokens[self.pos]
+
+        if condition_start < self.pos:
+            conditions.append(self.make_condition(tokens[condition_start:self.pos], membership_functions))
+
+        return conditions
+
+    def make_condition(self, tokens, membership_functions):
+        '''Build a Condition from its tokens.'''
+
+        text = self.query[tokens[0][START]:tokens[-1][END]]
+
+        # Split on OR to find the equalities (`x.attr = value`) used to describe the searched notes
+        sub_conditions = [[]]
+        for token in tokens:
+            if token[KEYWORD] == 'OR':
+                sub_conditions.append([])
+            else:
+                sub_conditions[-1].append(token)
+
+        comparisons = [self.parse_comparison(sub_condition) for sub_condition in sub_conditions]
+        equalities = [(variable, attribute, value) for variable, attribute, operator, value in filter(None, comparisons) if operator == '=']
+
+        condition = Condition(text, equalities=equalities)
+        if comparisons[0] is not None:
+            condition.variable, condition.attribute, condition.operator, condition.value = comparisons[0]
+
+        # `x.attr IS name` (possibly with the attribute between parentheses), where `name` is a membership function
+        values = [token[VALUE] for token in tokens]
+        if values[0] == '(' and len(values) > 4 and values[4] == ')':
+            values = values[1:4] + values[5:]
+        if len(values) == 5 and values[1] == '.' and values[3].upper() == 'IS' and values[4] in membership_functions:
+            condition.variable, condition.attribute = values[0], values[2]
+            condition.operator, condition.value = 'IS', values[4]
+            condition.membership_function = values[4]
+
+        return condition
+
+    def parse_comparison(self, tokens):
+        '''Parse `variable.attribute operator value`. Return a tuple, or None if `tokens` do not follow this form.'''
+
+        if len(tokens) < 5 or not is_identifier(tokens[0]) or tokens[1][VALUE] != '.' or not is_identifier(tokens[2]):
+            return None
+
+        operator = tokens[3][KEYWORD]
+        value_index = 4
+        if operator == 'IS' and tokens[4][KEYWORD] == 'NOT':
+            operator = 'IS NOT'
+            value_index = 5
+        elif operator not in COMPARISON_OPERATORS:
+            return None
+
+        if value_index >= len(tokens):
+            return None
+
+        value = self.query[tokens[value_index][START]:tokens[-1][END]].strip()
+        return tokens[0][VALUE], tokens[2][VALUE], operator, parse_value(value, operator)
+
+def parse_fuzzy_query(query):
+    '''
+    Parse a fuzzy query into a `FuzzyQuery`.
+
+    The query is tokenized and parsed in a single pass. Properties given in the MATCH clause
+    (e.g `(f0:Fact{class:'c'})`) are moved to the conditions of the WHERE clause.
+
+    - query : the fuzzy query (string). If it is already a `FuzzyQuery`, it is returned as is.
+    '''
+
+    if isinstance(query, FuzzyQuery):
+        return query
+
+    return _Parser(query).parse()
+
+if __name__ == "__main__":
+    query = """DEFINEASC leapUp AS (1.0,1.5)
+    DEFINETRAP medium AS (1.0,2.0,3.0,4.0)
+    MATCH
+    ALLOW_TRANSPOSITION
+    TOLERANT pitch=0.0, duration=1.0, gap=0.0
+    ALPHA 0.5
+    (e0:Event)-[t0:NEXT]->(e1:Event)-[t1:NEXT]->(e2:Event),
+    (e0)--(f0:Fact{class:'c', octave:5, dur:4}),
+    (e1)--(f1:Fact),
+    (e2)--(f2:Fact)
+    WHERE t0.interval IS leapUp AND f1.class = 'd' AND f2.class = 'e'
+    RETURN e0.source AS source, e0.start AS start"""
+
+    fuzzy_query = parse_fuzzy_query(query)
+    print(fuzzy_query.fuzzy_parameters())
+    print(fuzzy_query.match_body)
+    print(fuzzy_query.conditions)
+    print(fuzzy_query.notes)
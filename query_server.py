@@ -0,0 +1,271 @@
+import json
+import os
+import socket
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from neo4j_connection import run_query, fetch_cancellable, is_timeout_error, QueryCancelled
+from query_budget import check_budget, estimate_query
+from utils import get_first_k_notes_of_each_score, create_query_from_list_of_notes, create_query_from_contour, list_available_songs
+
+# Default address of the service
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+class QueryService:
+    '''
+    The operations of the command line (compile, write, send, estimate, get, list), run in a long-lived process.
+
+    The connection manager (pooled driver) and the compile cache are shared by all the requests,
+    so that a request only costs the compilation (when not cached), the execution and the ranking.
+    '''
+
+    def __init__(self, cache, driver, timeout=None, max_expansion=None, budget_policy='refuse'):
+        '''
+        - cache         : the `QueryCache` used to compile the fuzzy queries ;
+        - driver        : the connection manager (see `get_connection_manager`) ;
+        - timeout       : the maximum duration of a query in the database (in seconds), or None ;
+        - max_expansion : the budget of the fuzzy queries (see `check_budget`), or None ;
+        - budget_policy : what to do with a fuzzy query above the budget ('refuse' or 'limit').
+        '''
+
+        self.cache = cache
+        self.driver = driver
+        self.timeout = timeout
+        self.max_expansion = max_expansion
+        self.budget_policy = budget_policy
+
+        self._running = {} # request id -> cancel event of the fuzzy queries being sent
+        self._running_lock = threading.Lock()
+
+    def compile(self, query, parameters=False, rank_on_server=False, top_k=None):
+        '''Compile a fuzzy query. Returns `{"query": ..., "params": ...}` (`params` is None if the values are inlined).'''
+
+        if top_k is not None and not rank_on_server:
+            raise ValueError('top_k can only be used with rank_on_server')
+
+        compiled_query = self.cache.compile(query, parameters, rank_on_server, top_k)
+        return {'query': compiled_query.crisp_query, 'params': compiled_query.params}
+
+    def write(self, notes=None, contour=None, pitch_distance=0.0, duration_factor=1.0, duration_gap=0.0, alpha=0.0,
+              allow_transposition=False, allow_homothety=False, incipit_only=False, collections=None):
+        '''
+        Write a fuzzy query, from a list of notes (as for the `write` command, e.g `[[["c", 5], 4], [["d", 5], 8, 1]]`),
+        or from a contour (`{"melodic": ["U", "d"], "rhythmic": ["L", "s"]}`).
+        '''
+
+        if (notes is None) == (contour is None):
+            raise ValueError('exactly one of notes and contour must be given')
+
+        if contour is not None:
+            if len(contour.get('melodic', [])) != len(contour.get('rhythmic', [])):
+                raise ValueError('both rhythmic and melodic contours must have the same length')
+            return create_query_from_contour(contour, incipit_only, collections)
+
+        if not notes:
+            raise ValueError('notes must be a non-empty list')
+        return create_query_from_list_of_notes(notes, pitch_distance, duration_factor, duration_gap, alpha, allow_transposition, allow_homothety, incipit_only, collections)
+
+    def send(self, query, fuzzy=False, top_k=None, rank_on_server=False, text=False, timeout=None, request_id=None):
+        '''
+        Send a query and return its processed result (as with `send -j`, or `send -t` if `text`).
+
+        - query          : the query (crisp, or fuzzy if `fuzzy`). A crisp query can only read the database ;
+        - fuzzy          : if True, the query is compiled before being sent, and the results are ranked ;
+        - top_k          : with `fuzzy`, keep only the `top_k` best results ;
+        - rank_on_server : with `fuzzy`, compute the degrees in the database (see `reformulate_fuzzy_query`) ;
+        - text           : with `fuzzy`, return the result as text instead of a list of dicts ;
+        - timeout        : the maximum duration of the query in the database (in seconds). It can not exceed the timeout of the service ;
+        - request_id     : with `fuzzy`, a name given to the request, so that it can be stopped with `cancel`.
+        '''
+
+        from process_results import process_results_to_dict, process_results_to_text, process_crisp_results_to_dict
+
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive')
+        if self.timeout is not None:
+            timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+
+        if not fuzzy:
+            if rank_on_server or top_k is not None or text or request_id is not None:
+                raise ValueError('top_k, rank_on_server, text and request_id can only be used with fuzzy queries')
+            # Crisp queries run in a read transaction : the service must not let a client write to (or wipe) the database
+            return process_crisp_results_to_dict(run_query(self.driver, query, read_only=True, timeout=timeout))
+
+        compiled_query = self.cache.compile(query, True, rank_on_server, top_k if rank_on_server else None)
+        crisp_query = check_budget(compiled_query, self.max_expansion, self.budget_policy)
+
+        if request_id is None:
+            result = run_query(self.driver, crisp_query, compiled_query.params, read_only=True, timeout=timeout)
+        else:
+            cancel_event = threading.Event()
+            with self._running_lock:
+                if request_id in self._running:
+                    raise ValueError(f'a request "{request_id}" is already running')
+                self._running[request_id] = cancel_event
+            try:
+                result = fetch_cancellable(self.driver, crisp_query, compiled_query.params, cancel_event, timeout=timeout)
+            finally:
+                with self._running_lock:
+                    del self._running[request_id]
+
+        if text:
+            return process_results_to_text(result, compiled_query.fuzzy_query, top_k)
+        return process_results_to_dict(result, compiled_query.fuzzy_query, top_k)
+
+    def estimate(self, query):
+        '''Estimate the number of results and the latency class of a fuzzy query (see `estimate_query`), without the database.'''
+
+        if self.cache.stats is None:
+            raise ValueError('the service has no corpus statistics (--stats)')
+
+        # The parsed query of the compile cache is reused, so that a cached query is not parsed again
+        return estimate_query(self.cache.compile(query, True).fuzzy_query, self.cache.stats)
+
+    def cancel(self, request_id):
+        '''
+        Ask the fuzzy query sent with `request_id` to stop. The cancellation is cooperative : the query stops
+        at its next fetched record, and its `send` request then fails with a 409 error.
+        Returns True if the request was running, False otherwise.
+        '''
+
+        with self._running_lock:
+            cancel_event = self._running.get(request_id)
+        if cancel_event is None:
+            return False
+
+        cancel_event.set()
+        return True
+
+    def running(self):
+        '''Return the request ids of the fuzzy queries being sent.'''
+
+        with self._running_lock:
+            return list(self._running)
+
+    def get(self, name, number):
+        '''Return the `number` first notes of the song `name`.'''
+
+        if name not in list_available_songs(self.driver):
+            raise ValueError(f'"{name}" is not a valid song name')
+        return get_first_k_notes_of_each_score(number, name, self.driver)
+
+    def list(self, collection=None):
+        '''Return the available songs (of `collection` if given).'''
+
+        return list_available_songs(self.driver, collection)
+
+    def stats(self):
+        '''Return the counters of the compile cache and of the connection pool.'''
+
+        return {
+            'cache': {'entries': len(self.cache.entries), 'hits': self.cache.hits, 'disk_hits': self.cache.disk_hits, 'misses': self.cache.misses},
+            'pool': self.driver.pool_stats(),
+            'running': self.running()
+        }
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handles the requests of the service :
+        - `POST /compile`, `/write`, `/send`, `/estimate`, `/cancel`, `/get`, `/list`, with a json object holding the arguments
+          of the corresponding `QueryService` method, e.g `{"query": "...", "fuzzy": true, "top_k": 10, "request_id": "q1"}`
+          for `/send`, and `{"request_id": "q1"}` for `/cancel` ;
+        - `GET /stats`.
+
+    The answer is `{"result": ...}`, or `{"error": "<operation>: ..."}` (the messages of `QueryService` are only prefixed here) with status 400 (invalid request or query),
+    404 (unknown operation), 408 (query timed out), 409 (query cancelled), 503 (database not available) or 500.
+    '''
+
+    OPERATIONS = ('compile', 'write', 'send', 'estimate', 'cancel', 'get', 'list')
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self.send_json(200, {'result': self.server.service.stats()})
+        else:
+            self.send_json(404, {'error': f'unknown operation "{self.path}"'})
+
+    def do_POST(self):
+        import neo4j
+
+        operation = self.path.strip('/')
+        if operation not in self.OPERATIONS:
+            self.send_json(404, {'error': f'unknown operation "{self.path}"'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            arguments = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(arguments, dict):
+                raise ValueError('the body must be a json object')
+        except ValueError as err:
+            self.send_json(400, {'error': f'invalid request: {err}'})
+            return
+
+        try:
+            result = getattr(self.server.service, operation)(**arguments)
+        except (TypeError, ValueError, neo4j.exceptions.CypherSyntaxError) as err:
+            self.send_json(400, {'error': f'{operation}: {err}'})
+            return
+        except QueryCancelled as err:
+            self.send_json(409, {'error': f'{operation}: {err}'})
+            return
+        except neo4j.exceptions.ClientError as err:
+            if is_timeout_error(err):
+                self.send_json(408, {'error': f'{operation}: the query timed out: {err}'})
+            else:
+                self.send_json(400, {'error': f'{operation}: {err}'})
+            return
+        except neo4j.exceptions.ServiceUnavailable as err:
+            self.send_json(503, {'error': f'{operation}: the database is not available: {err}'})
+            return
+        except Exception as err:
+            self.send_json(500, {'error': f'{operation}: {type(err).__name__}: {err}'})
+            return
+
+        self.send_json(200, {'result': result})
+
+    def send_json(self, status, content):
+        body = json.dumps(content, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # The client address of a unix socket is not a (host, port) tuple
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return self.server.server_address
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    '''HTTP server listening on a unix socket, handling each request in a thread.'''
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # Only a socket left by a previous run is removed, never another file given by mistake
+        if os.path.lexists(self.server_address):
+            if not stat.S_ISSOCK(os.lstat(self.server_address).st_mode):
+                raise ValueError(f'create_server: "{self.server_address}" exists and is not a socket')
+            os.remove(self.server_address)
+        super().server_bind()
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    '''
+    Create the server of `service` (a `QueryService`), on `host`:`port`, or on the unix socket `socket_path` if given.
+    Requests are handled concurrently (one thread per connection).
+    '''
+
+    if socket_path is not None:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('create_server: unix sockets are not available on this platform')
+        server = ThreadingUnixHTTPServer(socket_path, QueryRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+        server.daemon_threads = True
+
+    server.service = service
+    return server
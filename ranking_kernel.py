@@ -0,0 +1,306 @@
+from operator import itemgetter
+
+import numpy as np
+
+from note import Note
+from degree_computation import convert_note_to_sharp, SEMITONES_FROM_C
+from utils import calculate_intervals_list, calculate_dur_ratios_list
+
+def to_columns(records, keys):
+    '''
+    Convert the numeric fields `keys` of the records to float arrays (None becoming NaN).
+
+    - records : a list of records ;
+    - keys    : the keys of the fields.
+
+    Returns a dict key -> array.
+    '''
+
+    if not keys:
+        return {}
+    if len(keys) == 1:
+        return {keys[0]: np.array([record[keys[0]] for record in records], dtype=float).reshape(len(records))}
+
+    table = np.array(list(map(itemgetter(*keys), records)), dtype=float).reshape(len(records), len(keys))
+    return {key: table[:, j] for j, key in enumerate(keys)}
+
+def semitone_column(pitches):
+    '''Convert a list of pitch classes to their semitone distance from C (NaN for None or unknown pitch classes).'''
+
+    cache = {}
+    column = np.empty(len(pitches), dtype=float)
+    for i, pitch in enumerate(pitches):
+        semitone = cache.get(pitch)
+        if semitone is None:
+            semitone = np.nan if pitch is None else SEMITONES_FROM_C.get(convert_note_to_sharp(pitch), np.nan)
+            cache[pitch] = semitone
+        column[i] = semitone
+
+    return column
+
+def membership_degrees(function, x):
+    '''
+    Vectorized version of the python membership functions (see `create_trapezoidal_function`, ...).
+
+    - function : a `MembershipFunction` ;
+    - x        : the array of attribute values.
+    '''
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if function.kind == 'DEFINETRAP':
+            a_minus, a, b, b_plus = function.parameters
+            return np.select(
+                [(x < a_minus) | (x > b_plus), (a_minus <= x) & (x < a), (a <= x) & (x <= b), (b < x) & (x <= b_plus)],
+                [0.0, (x - a_minus) / (a - a_minus), 1.0, (b_plus - x) / (b_plus - b)],
+                0.0
+            )
+
+        gamma, delta = function.parameters
+        if function.kind == 'DEFINEASC':
+            return np.select([x < gamma, (gamma <= x) & (x <= delta)], [0.0, (x - gamma) / (delta - gamma)], 1.0)
+        return np.select([x < gamma, (gamma <= x) & (x <= delta)], [1.0, (delta - x) / (delta - gamma)], 0.0)
+
+class Degree:
+    '''A degree column : its values for all the records, and whether the python version clips it with `max(d, 0)`.'''
+
+    def __init__(self, values, clipped):
+        self.values = values
+        self.clipped = clipped
+        self.clipped_values = np.maximum(values, 0) if clipped else values
+
+    def python_values(self, indices):
+        '''
+        Values for the records `indices`, exactly as returned by the python functions
+        (`max(d, 0)` returns the int 0 when d < 0).
+        '''
+
+        values = self.values[indices]
+        if self.clipped and (values < 0).any():
+            return [0 if v < 0 else v for v in values.tolist()]
+        return values.tolist()
+
+class DegreeKernel:
+    '''
+    Computes the degrees of the records of a fuzzy query with NumPy.
+
+    The records are converted once into column arrays (pitch semitone, octave, duration, start, end,
+    interval and duration ratio per note position, and the attributes used by membership functions).
+    The pitch, duration, sequencing and membership degrees and their min-aggregation are then computed
+    as array operations over all the records, with the same numeric output as `degree_computation`.
+    '''
+
+    def __init__(self, query):
+        '''
+        - query : the parsed fuzzy query (`FuzzyQuery`).
+        '''
+
+        self.query_notes = {node_name: attrs for node_name, attrs in query.notes.items() if attrs['type'] == 'Fact'}
+        self.pitch_gap, self.duration_factor, self.sequencing_gap, self.alpha, self.allow_transpose, self.allow_homothety = query.fuzzy_parameters()
+        self.nb_notes = len(self.query_notes)
+
+        # Attributes associated with membership functions, with their alias in the return clause
+        self.attribute_aliases = []
+        for node_name, attribute_name, membership_function_name in query.attributes_with_membership_functions:
+            alias = f"{attribute_name}_{node_name}_{membership_function_name}"
+            self.attribute_aliases.append((alias, node_name, query.membership_functions[membership_function_name]))
+
+        if self.allow_transpose:
+            self.intervals = calculate_intervals_list(self.query_notes)
+        if self.allow_homothety:
+            self.duration_ratios = calculate_dur_ratios_list(self.query_notes)
+
+    def score(self, records):
+        '''
+        Compute the degrees of `records`.
+
+        - records : a list of records.
+
+        Returns a `ScoredRecords`.
+        '''
+
+        return ScoredRecords(self, records)
+
+class ScoredRecords:
+    '''The degrees of a list of records (see `DegreeKernel`).'''
+
+    def __init__(self, kernel, records):
+        self.kernel = kernel
+        self.records = records
+        nb_records = len(records)
+        nb_notes = kernel.nb_notes
+
+        #---Columns
+        keys = [f"{field}_{idx}" for field in ('octave', 'duration', 'start', 'end') for idx in range(nb_notes)]
+        if kernel.allow_transpose:
+            keys += [f"interval_{idx}" for idx in range(nb_notes - 1)]
+        if kernel.allow_homothety:
+            keys += [f"duration_ratio_{idx}" for idx in range(nb_notes - 1)]
+        keys += list(dict.fromkeys(alias for alias, node_name, function in kernel.attribute_aliases))
+        columns = to_columns(records, keys)
+
+        if nb_notes > 1:
+            pitch_rows = list(map(itemgetter(*[f"pitch_{idx}" for idx in range(nb_notes)]), records))
+            pitches = [semitone_column([row[idx] for row in pitch_rows]) for idx in range(nb_notes)]
+        else:
+            pitches = [semitone_column([record["pitch_0"] for record in records])] if nb_notes else []
+        octaves = [columns[f"octave_{idx}"] for idx in range(nb_notes)]
+        durations = [columns[f"duration_{idx}"] for idx in range(nb_notes)]
+        starts = [columns[f"start_{idx}"] for idx in range(nb_notes)]
+        ends = [columns[f"end_{idx}"] for idx in range(nb_notes)]
+        if kernel.allow_transpose:
+            intervals = [columns[f"interval_{idx}"] for idx in range(nb_notes - 1)]
+        if kernel.allow_homothety:
+            duration_ratios = [columns[f"duration_ratio_{idx}"] for idx in range(nb_notes - 1)]
+
+        #---Degrees, in the order used by `get_ordered_results_2` before the vectorization
+        ones = np.ones(nb_records)
+        self.note_degrees = [[] for _ in range(nb_notes)] # Degree columns aggregated for each note
+        interval_degrees = [[] for _ in range(nb_notes - 1)]
+        self.displayed_degrees = [[None, None, None] for _ in range(nb_notes)] # Pitch, duration and sequencing degrees (None means 1.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for idx, query_note in enumerate(kernel.query_notes.values()):
+                # Pitch or interval degree
+                if kernel.pitch_gap > 0:
+                    if kernel.allow_transpose:
+                        if idx > 0:
+                            expected = kernel.intervals[idx - 1]
+                            if isinstance(expected, (int, float)):
+                                values = np.where(np.isnan(intervals[idx - 1]), 1.0, 1 - (np.abs(expected - intervals[idx - 1]) / kernel.pitch_gap))
+                            else: # Interval unknown in the query
+                                values = ones
+                            degree = Degree(values, True)
+                            interval_degrees[idx - 1].append(degree)
+                            self.displayed_degrees[idx][0] = degree
+                    elif 'class' in query_note.keys() and 'octave' in query_note.keys():
+                        distance = self.pitch_distances(query_note['class'], query_note['octave'], pitches[idx], octaves[idx])
+                        degree = Degree(1 - (distance / kernel.pitch_gap), True)
+                        self.note_degrees[idx].append(degree)
+                        self.displayed_degrees[idx][0] = degree
+
+                # Duration degree
+                if kernel.duration_factor != 1:
+                    if 'dur' in query_note.keys() and query_note['dur'] is not None:
+                        a = -1 / (kernel.duration_factor - 1)
+                        b = 1 - a
+                        degree = None
+                        if kernel.allow_homothety:
+                            if idx > 0:
+                                expected, actual = kernel.duration_ratios[idx - 1], duration_ratios[idx - 1]
+                                degree = Degree(ones if expected is None else a * np.maximum(expected / actual, actual / expected) + b, False)
+                        else:
+                            expected = 1.0 / query_note['dur']
+                            if query_note.get('dots', None):
+                                expected *= 1.5
+                            actual = durations[idx]
+                            degree = Degree(a * np.maximum(expected / actual, actual / expected) + b, False)
+
+                        if degree is not None:
+                            self.note_degrees[idx].append(degree)
+                            self.displayed_degrees[idx][1] = degree
+
+                # Sequencing degree
+                if kernel.sequencing_gap > 0:
+                    if idx > 0:
+                        degree = Degree(1 - ((starts[idx] - ends[idx - 1]) / kernel.sequencing_gap), True)
+                        self.note_degrees[idx].append(degree)
+                        self.displayed_degrees[idx][2] = degree
+
+            # Membership functions degrees
+            self.membership_degrees = [[] for _ in range(nb_notes)] # (name, degree) displayed for each note
+            for alias, node_name, function in kernel.attribute_aliases:
+                degree = Degree(membership_degrees(function, columns[alias]), False)
+
+                idx = int(node_name[1:])
+                if node_name.startswith("n"): # Interval-based
+                    interval_degrees[idx].append(degree)
+                    self.membership_degrees[idx + 1].append((function.name, degree))
+                else: # Note-based (f or e)
+                    self.note_degrees[idx].append(degree)
+                    self.membership_degrees[idx].append((function.name, degree))
+
+        for idx in range(1, nb_notes):
+            self.note_degrees[idx].extend(interval_degrees[idx - 1])
+
+        #---Min-aggregation (a degree above 1, e.g with a duration factor below 1, counts as 1)
+        self.degrees = ones.copy()
+        for degrees in self.note_degrees:
+            for degree in degrees:
+                np.minimum(self.degrees, degree.clipped_values, out=self.degrees)
+
+    def pitch_distances(self, query_class, query_octave, semitones, octaves):
+        '''Vectorized version of `note_distance_in_tones(query_class, query_octave, pitch, octave)`.'''
+
+        # When one of the pitch classes is unspecified, only the octaves are compared
+        if query_octave is None:
+            octave_distance = np.zeros(len(octaves))
+        else:
+            octave_distance = np.where(np.isnan(octaves), 0, 12 * np.abs(octaves - query_octave) / 2)
+
+        if query_class is None:
+            return octave_distance
+
+        query_semitone = SEMITONES_FROM_C[convert_note_to_sharp(query_class)]
+        if query_octave is None: # The octave of the query note is the one of the record
+            distance = np.abs(semitones - query_semitone) / 2
+        else:
+            record_octaves = np.where(np.isnan(octaves), query_octave, octaves)
+            distance = np.abs((semitones + record_octaves * 12) - (query_semitone + query_octave * 12)) / 2
+
+        return np.where(np.isnan(semitones), octave_distance, distance)
+
+    def select(self, top_k=None, floor=None):
+        '''
+        Return the indices (in record order) of the records with a degree of at least alpha,
+        strictly above `floor` (if given), and among the `top_k` best ones (if given, ties broken by record order).
+        '''
+
+        threshold = self.kernel.alpha if floor is None else max(self.kernel.alpha, floor)
+        keep = self.degrees >= threshold
+        if floor is not None:
+            keep &= self.degrees > floor
+
+        indices = np.flatnonzero(keep)
+        if top_k is not None and len(indices) > top_k:
+            best = np.argsort(-self.degrees[indices], kind='stable')[:top_k]
+            indices = np.sort(indices[best])
+
+        return indices.tolist()
+
+    def details(self, indices):
+        '''Return `[source, start, end, degree, note_details]` for each record of `indices`, as `get_ordered_results_2` does.'''
+
+        if not indices:
+            return []
+
+        nb_notes = self.kernel.nb_notes
+        note_degrees = [[degree.python_values(indices) for degree in degrees] for degrees in self.note_degrees]
+        displayed_degrees = [[None if degree is None else degree.python_values(indices) for degree in degrees] for degrees in self.displayed_degrees]
+        membership_degrees = [[(name, degree.python_values(indices)) for name, degree in degrees] for degrees in self.membership_degrees]
+
+        details = []
+        for k, i in enumerate(indices):
+            record = self.records[i]
+
+            note_details = []
+            aggregated_degrees = []
+            for idx in range(nb_notes):
+                duration = record[f"duration_{idx}"]
+                dots = record[f"dots_{idx}"]
+                if dots and dots > 0:
+                    note = Note(record[f"pitch_{idx}"], record[f"octave_{idx}"], int(1 / (duration / 1.5)), dots, duration, record[f"start_{idx}"], record[f"end_{idx}"], record[f"id_{idx}"])
+                else:
+                    note = Note(record[f"pitch_{idx}"], record[f"octave_{idx}"], int(1 / duration), dots, duration, record[f"start_{idx}"], record[f"end_{idx}"], record[f"id_{idx}"])
+
+                # Capped at 1, as `degrees` and the degree computed by the database (see `create_degree_clause`)
+                note_degree = min([values[k] for values in note_degrees[idx]] + [1.0])
+                aggregated_degrees.append(note_degree)
+
+                pitch_deg, duration_deg, sequencing_deg = [1.0 if values is None else values[k] for values in displayed_degrees[idx]]
+                mem_degs = "| ".join([f'{name}-> {round(values[k], 3)}' for name, values in membership_degrees[idx]])
+
+                note_details.append((note, pitch_deg, duration_deg, sequencing_deg, note_degree, mem_degs))
+
+            details.append([record['source'], record['start'], record['end'], min(aggregated_degrees), note_details])
+
+        return details
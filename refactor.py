@@ -210,7 +210,7 @@ def refactor_variable_names(query):
     # Initialize dictionaries to keep track of variables and their standardized names
     variable_types = {}  # Original variable name -> type
     standardized_names = {}  # Original variable name -> standardized name
-    type_counters = {}  # Type -> counter (starting from 0)
+    type_counters = {}  # First letter of the type -> counter (starting from 0)
 
     # Step 1: Extract the MATCH clause and the rest of the query
     match_match = re.search(r'\bMATCH\b', query, flags=re.IGNORECASE)
@@ -257,13 +257,15 @@ def refactor_variable_names(query):
 
     # Now, create standardized names for variables based on their types
     for var_name, var_type in variable_types.items():
-        # Initialize counter for this type if not already
-        if var_type not in type_counters:
-            type_counters[var_type] = 0
+        # Types sharing the same first letter share the same counter, so that names stay unique
+        prefix = var_type[0].lower()
+        # Initialize counter for this prefix if not already
+        if prefix not in type_counters:
+            type_counters[prefix] = 0
         # Create standardized name
-        standardized_name = f'{var_type[0].lower()}{type_counters[var_type]}'
+        standardized_name = f'{prefix}{type_counters[prefix]}'
         # Increment counter
-        type_counters[var_type] += 1
+        type_counters[prefix] += 1
         # Map original variable name to standardized name
         standardized_names[var_name] = standardized_name
 
@@ -275,11 +277,14 @@ def refactor_variable_names(query):
     escaped_var_names = [re.escape(var_name) for var_name in variable_types.keys()]
     # Sort variable names by length in descending order to avoid partial replacements
     escaped_var_names.sort(key=len, reverse=True)
-    var_pattern = r'(?<!\w)(' + '|'.join(escaped_var_names) + r')(?!\w)'
+    # String literals are matched too, so that they are kept unchanged (e.g `f.class = 'f'`)
+    var_pattern = r'(\'[^\']*\'|"[^"]*")|(?<!\w)(' + '|'.join(escaped_var_names) + r')(?!\w)'
 
     # Define a replacement function
     def replace_var(match):
-        var_name = match.group(1)
+        if match.group(1):
+            return match.group(1)
+        var_name = match.group(2)
         return standardized_names.get(var_name, var_name)
 
     # Replace variable names in the entire query
@@ -1,12 +1,40 @@
 import re
+from math import prod
 from find_nearby_pitches import find_frequency_bounds, find_nearby_pitches
-from extract_notes_from_query import extract_notes_from_query_dict, extract_fuzzy_parameters, extract_match_clause, extract_where_clause, extract_attributes_with_membership_functions, extract_membership_function_support_intervals
 from find_duration_range import find_duration_range_decimal, find_duration_range_multiplicative_factor_sym
 from utils import calculate_intervals_list, calculate_dur_ratios_list
-from degree_computation import convert_note_to_sharp
+from degree_computation import convert_note_to_sharp, SEMITONES_FROM_C
 from refactor import move_attribute_values_to_where_clause, refactor_variable_names
+from query_parser import parse_fuzzy_query
 
-def make_duration_condition(duration_factor, duration, node_name, alpha, dotted):
+# Semitone distance from C of each spelling of a pitch class found in the database (used by the degrees computed on the server)
+RECORD_PITCH_CLASSES = {
+    spelling: SEMITONES_FROM_C[convert_note_to_sharp(spelling)]
+    for letter in 'cdefgab' for spelling in (letter, letter + '#', letter + 's', letter + 'b', letter + 'f')
+    if convert_note_to_sharp(spelling) in SEMITONES_FROM_C
+}
+
+def make_parameter(value, name, params):
+    '''
+    Return the text standing for `value` in the query.
+
+    - value  : the literal value ;
+    - name   : the name of the parameter ;
+    - params : the query parameters. If None, `value` is inlined in the query.
+               Otherwise, `value` is added to `params` and `$name` is returned, so that queries
+               with the same shape but different values share the same text (and Neo4j plan).
+    '''
+
+    if params is None:
+        return f"'{value}'" if isinstance(value, str) else str(value)
+
+    if hasattr(value, 'item'): # numpy scalars are not accepted by the driver
+        value = value.item()
+
+    params[name] = value
+    return '$' + name
+
+def make_duration_condition(duration_factor, duration, node_name, alpha, dotted, idx=0, params=None):
     if duration == None:
         return ''
 
@@ -19,12 +47,15 @@ def make_duration_condition(duration_factor, duration, node_name, alpha, dotted)
 
     if duration_factor != 1:
         min_duration, max_duration = find_duration_range_multiplicative_factor_sym(duration, duration_factor, alpha)
+        min_duration = make_parameter(min_duration, f'd{idx}_low', params)
+        max_duration = make_parameter(max_duration, f'd{idx}_high', params)
         res = f"{node_name}.duration >= {min_duration} AND {node_name}.duration <= {max_duration}"
     else:
+        duration = make_parameter(duration, f'd{idx}', params)
         res = f"{node_name}.duration = {duration}"
     return res
 
-def make_duration_ratio_condition(duration_ratio, duration_gap, duration_factor, idx, alpha):
+def make_duration_ratio_condition(duration_ratio, duration_gap, duration_factor, idx, alpha, params=None):
     if duration_ratio is None:
         return ''
 
@@ -32,6 +63,12 @@ def make_duration_ratio_condition(duration_ratio, duration_gap, duration_factor,
         duration_factor = 1.0/duration_factor
     
     min_ratio, max_ratio = find_duration_range_multiplicative_factor_sym(duration_ratio, duration_factor, alpha)
+    if duration_factor > 1:
+        min_ratio = make_parameter(min_ratio, f'r{idx}_low', params)
+        max_ratio = make_parameter(max_ratio, f'r{idx}_high', params)
+    else:
+        duration_ratio = make_parameter(duration_ratio, f'r{idx}', params)
+
     if duration_gap > 0:
         if duration_factor > 1:
             duration_ratio_condition = (
@@ -54,7 +91,7 @@ def make_duration_ratio_condition(duration_ratio, duration_gap, duration_factor,
     
     return duration_ratio_condition
 
-def make_interval_condition(interval, duration_gap, pitch_distance, idx, alpha):
+def make_interval_condition(interval, duration_gap, pitch_distance, idx, alpha, params=None):
     if interval == 'NA':
         # No rest involved, but lack information for interval inference
         interval_condition = ''
@@ -64,15 +101,21 @@ def make_interval_condition(interval, duration_gap, pitch_distance, idx, alpha):
         else:
             interval_condition = f"NOT EXISTS(n{idx}.interval)"
     else :
+        if pitch_distance > 0:
+            min_interval = make_parameter(interval - pitch_distance * (1 - alpha), f'i{idx}_low', params)
+            max_interval = make_parameter(interval + pitch_distance * (1 - alpha), f'i{idx}_high', params)
+        else:
+            interval = make_parameter(interval, f'i{idx}', params)
+
         if duration_gap > 0:
             # Utiliser halfTonesFromA4 pour calculer les intervalles entre deux Fact nodes
             if pitch_distance > 0:
                 interval_condition = (
                     f"EXISTS(f{idx + 1}.halfTonesFromA4) AND EXISTS(f{idx}.halfTonesFromA4) AND "
-                    f"{interval - pitch_distance * (1 - alpha)} <= "
+                    f"{min_interval} <= "
                     f"toFloat(f{idx + 1}.halfTonesFromA4 - f{idx}.halfTonesFromA4)/2 AND "
                     f"toFloat(f{idx + 1}.halfTonesFromA4 - f{idx}.halfTonesFromA4)/2 <= "
-                    f"{interval + pitch_distance * (1 - alpha)}"
+                    f"{max_interval}"
                 )
             else:
                 interval_condition = (
@@ -83,8 +126,8 @@ def make_interval_condition(interval, duration_gap, pitch_distance, idx, alpha):
             # Construct interval conditions for direct connections
             if pitch_distance > 0:
                 interval_condition = (
-                    f"{interval - pitch_distance * (1 - alpha)} <= n{idx}.interval AND "
-                    f"n{idx}.interval <= {interval + pitch_distance * (1 - alpha)}"
+                    f"{min_interval} <= n{idx}.interval AND "
+                    f"n{idx}.interval <= {max_interval}"
                 )
             else:
                 interval_condition = f"n{idx}.interval = {interval}"
@@ -113,7 +156,7 @@ def split_note_accidental(note):
     else:
         raise ValueError(f"Invalid note name: {note}")
 
-def make_pitch_condition(pitch_distance, pitch, octave, name, alpha):
+def make_pitch_condition(pitch_distance, pitch, octave, name, alpha, idx=0, params=None):
     """
     Creates a pitch condition for a given note, handling accidentals properly.
 
@@ -122,6 +165,8 @@ def make_pitch_condition(pitch_distance, pitch, octave, name, alpha):
         pitch (str): The pitch class.
         octave (int): The octave number.
         name (str): The variable name of the note in the query.
+        idx (int): The index of the note, used to name the parameters.
+        params (dict | None): The query parameters (see `make_parameter`).
 
     Returns:
         str: The pitch condition as a string.
@@ -130,7 +175,7 @@ def make_pitch_condition(pitch_distance, pitch, octave, name, alpha):
         if octave is None:
             pitch_condition = ''
         else:
-            pitch_condition = f"{name}.octave = {octave}"
+            pitch_condition = f"{name}.octave = {make_parameter(octave, f'p{idx}_octave', params)}"
     else:
         if pitch_distance == 0 or pitch == 'r':
             if pitch == 'r':
@@ -138,15 +183,16 @@ def make_pitch_condition(pitch_distance, pitch, octave, name, alpha):
             else:
                 # Split pitch into base note and accidental
                 base_note, accidental = split_note_accidental(pitch)
-                pitch_condition = f"{name}.class = '{base_note}'"
+                pitch_condition = f"{name}.class = {make_parameter(base_note, f'p{idx}_class', params)}"
                 if accidental:
                     # Add condition for accidental, including accid and accid_ges
-                    pitch_condition += f" AND ({name}.accid = '{accidental}' OR {name}.accid_ges = '{accidental}')"
+                    accidental = make_parameter(accidental, f'p{idx}_accid', params)
+                    pitch_condition += f" AND ({name}.accid = {accidental} OR {name}.accid_ges = {accidental})"
                 else:
                     # No accidental, so accid is NULL or empty
                     pitch_condition += f" AND NOT EXISTS({name}.accid)"
                 if octave is not None:
-                    pitch_condition += f" AND {name}.octave = {octave}"
+                    pitch_condition += f" AND {name}.octave = {make_parameter(octave, f'p{idx}_octave', params)}"
         else:
             o = 4 if octave is None else octave  # Default octave if not specified
             near_pitches = find_nearby_pitches(pitch, o, pitch_distance)
@@ -167,75 +213,74 @@ def make_pitch_condition(pitch_distance, pitch, octave, name, alpha):
             # pitch_condition = pitch_condition.rstrip(' OR ') + '\n)'
 
             low_freq_bound, high_freq_bound = find_frequency_bounds(pitch, o, pitch_distance, alpha)
+            low_freq_bound = make_parameter(low_freq_bound, f'p{idx}_low', params)
+            high_freq_bound = make_parameter(high_freq_bound, f'p{idx}_high', params)
             pitch_condition = f"{low_freq_bound} <= {name}.frequency AND {name}.frequency <= {high_freq_bound}"
             
     return pitch_condition
 
-def make_sequencing_condition(duration_gap, name_1, name_2, alpha):
-    sequencing_condition = f"{name_1}.end >= {name_2}.start - {duration_gap * (1 - alpha)}"
+def make_sequencing_condition(duration_gap, name_1, name_2, alpha, idx=0, params=None):
+    sequencing_condition = f"{name_1}.end >= {name_2}.start - {make_parameter(duration_gap * (1 - alpha), f'g{idx}', params)}"
     return sequencing_condition
 
-def create_match_clause(query):
+def make_skip_condition(duration_gap, idx, alpha, params=None):
     '''
-    Create the MATCH clause for the compiled query.
-
-    - query        : the entire query string;
+    Condition on the relationship `n{idx}` (NEXT or SKIP) between two consecutive searched events, when the skip edges are used :
+    a SKIP relationship must stay within the duration gap, and within the number of events allowed by `create_match_clause`.
     '''
 
-    _, _, duration_gap, _, allow_transposition, _ = extract_fuzzy_parameters(query)
+    gap = make_parameter(duration_gap * (1 - alpha), f'g{idx}', params)
+    max_hops = make_parameter(get_max_hops(duration_gap), 'max_hops', params)
+    return f"(type(n{idx}) = 'NEXT' OR (n{idx}.gap <= {gap} AND n{idx}.hops <= {max_hops}))"
 
-    if duration_gap > 0:
-        # Proceed to create the MATCH clause as per current code
+def get_max_hops(duration_gap):
+    '''
+    Return the maximum number of NEXT relationships between two consecutive searched events, with a duration gap.
+    To give a higher bound to the number of intermediate notes, we suppose the shortest possible note has a duration of 0.0625.
+    '''
 
-        #---Extract notes from the query
-        notes = extract_notes_from_query_dict(query)
+    return max(int(duration_gap / 0.0625), 1) + 1
 
-        #---Init
-        event_nodes = [node for node, attrs in notes.items() if attrs.get('type') == 'Event']
+def uses_skip_edges(duration_gap, skip_max_gap):
+    '''Return True if the query can use the SKIP relationships created for gaps up to `skip_max_gap` (see `skip_edges`).'''
 
-        nb_events = len(event_nodes)
+    return skip_max_gap is not None and 0 < duration_gap <= skip_max_gap
 
-        # To give a higher bound to the number of intermediate notes, we suppose the shortest possible note has a duration of 0.0625
-        max_intermediate_nodes = max(int(duration_gap / 0.0625), 1)
+def create_match_clause(query, skip_max_gap=None):
+    '''
+    Create the MATCH clause for the compiled query.
 
-        # Create a simplified path without intervals
-        event_path = f'-[:NEXT*1..{max_intermediate_nodes + 1}]->'.join([f'({node}:Event)' for node in event_nodes])
+    - query        : the fuzzy query (string or `FuzzyQuery`);
+    - skip_max_gap : the maximum gap of the SKIP relationships of the database (see `skip_edges`), or None if there are none.
+                     With a duration gap up to `skip_max_gap`, consecutive events are linked by one NEXT or SKIP relationship
+                     (`n{idx}`, see `make_skip_condition`) instead of a variable-length NEXT path.
+    '''
 
-        #---Extract the rest of the MATCH clause (non-event chain patterns) from the input query
-        original_match_clause = extract_match_clause(query)
+    query = parse_fuzzy_query(query)
 
-        # Remove fuzzy parameters definitions (if any)
-        # Find the position of the first '(' after MATCH
-        match_start = original_match_clause.find('MATCH')
-        first_paren = original_match_clause.find('(', match_start)
-        if first_paren == -1:
-            raise ValueError('No node patterns found in MATCH clause')
+    if query.duration_gap > 0:
+        # Proceed to create the MATCH clause as per current code
 
-        # Extract the body of the MATCH clause
-        match_body = original_match_clause[first_paren:].strip()
+        #---Init
+        event_nodes = [node for node, attrs in query.notes.items() if attrs.get('type') == 'Event']
 
-        # Split the MATCH clause into individual patterns separated by commas
-        patterns = [p.strip() for p in re.split(r',\s*\n?', match_body) if p.strip()]
-        # Now filter out the event chain patterns
-        # Assume event chain patterns involve only event nodes connected via :NEXT relationships
+        # Create a simplified path without intervals
+        if uses_skip_edges(query.duration_gap, skip_max_gap):
+            event_path = ''.join(f'({node}:Event)-[n{idx}:NEXT|SKIP]->' for idx, node in enumerate(event_nodes[:-1])) + f'({event_nodes[-1]}:Event)'
+        else:
+            event_path = f'-[:NEXT*1..{get_max_hops(query.duration_gap)}]->'.join([f'({node}:Event)' for node in event_nodes])
 
-        # Build a set of event node names
-        event_node_names = set(event_nodes)
+        if not query.patterns:
+            raise ValueError('No node patterns found in MATCH clause')
 
         # Define a function to check if a pattern is part of the event chain
         def is_event_chain_pattern(pattern):
-            # Find all nodes in the pattern
-            nodes = re.findall(r'\(\s*(\w+)(?::[^\)]*)?\s*\)', pattern)
             # Check if all nodes are event nodes (start with 'e')
-            for node in nodes:
-                if not node.startswith('e'):
-                    return False
-            # All nodes are event nodes
-            return True
+            return all(node.startswith('e') for node in pattern.node_variables())
 
         # Replace the event chain patterns with event_path
         simplified_connections = [
-            event_path if is_event_chain_pattern(p) else p for p in patterns
+            event_path if is_event_chain_pattern(p) else p.text for p in query.patterns
         ]
 
         # Reconstruct the simplified connections as a string
@@ -247,33 +292,28 @@ def create_match_clause(query):
         return match_clause
     else:
         # duration_gap = 0
-        # Extract the MATCH clause from the query
-        match_clause = extract_match_clause(query)
-
-        # Remove fuzzy parameters definitions (everything between MATCH and the first '(')
-        # Find the position of the first '(' after MATCH
-        match_start = match_clause.find('MATCH')
-        first_paren = match_clause.find('(', match_start)
-        if first_paren == -1:
+        if not query.patterns:
             raise ValueError('No node patterns found in MATCH clause')
 
-        # Extract the cleaned MATCH clause
-        match_clause_body = match_clause[first_paren:].strip()
+        # The MATCH clause without the fuzzy parameters definitions
+        match_clause_body = query.match_body
 
         # Additional step: when allow_transposition is True, ensure all [:NEXT] relationships are named
-        if allow_transposition:
+        if query.allow_transposition:
             # Initialize a relationship index
             rel_index = 0
 
-            # Function to replace unnamed [:NEXT] relationships with named ones
+            # Function to replace unnamed [:NEXT] relationships with named ones.
+            # The index counts every NEXT relationship, so that the i-th one is always `n{i}`
+            # (and does not collide with the already named ones).
             def replace_unnamed_next(match):
                 nonlocal rel_index
-                replacement = f'[n{rel_index}:NEXT]'
+                replacement = match.group(0) if match.group(1) else f'[n{rel_index}:NEXT]'
                 rel_index += 1
                 return replacement
 
-            # Regular expression to find unnamed relationships of the form [:NEXT]
-            pattern = r'\[\s*:NEXT\s*\]'
+            # Regular expression to find relationships of the form [:NEXT] or [name:NEXT]
+            pattern = r'\[\s*(\w*)\s*:NEXT\s*\]'
 
             # Replace unnamed [:NEXT] relationships with named ones
             match_clause_body = re.sub(pattern, replace_unnamed_next, match_clause_body)
@@ -283,94 +323,208 @@ def create_match_clause(query):
 
         return match_clause
 
-def create_where_clause(query, allow_transposition, allow_homothety, pitch_distance, duration_factor, duration_gap, alpha = 0.0):
-    # Step 1: Extract the WHERE clause from the query
-    try:
-        where_clause = extract_where_clause(query)
-        has_where_clause = True
-    except ValueError as e:
-        # No WHERE clause found
-        where_clause = ''
-        has_where_clause = False
-
-    # Extract attributes associated with membership functions
-    attributes_with_membership_functions = extract_attributes_with_membership_functions(query)
-
-    # Step 2: Remove conditions that specify specific attribute values or membership functions
-    if has_where_clause:
-        # Remove the 'WHERE' keyword
-        where_conditions_str = where_clause[len('WHERE'):].strip()
-
-        # Split conditions using 'AND' or 'OR', keeping the operators
-        tokens = re.split(r'(\bAND\b)', where_conditions_str, flags=re.IGNORECASE)
-        # Build a list of conditions with their preceding operators
-        conditions_with_operators = []
-        i = 0
-        while i < len(tokens):
-            token = tokens[i].strip()
-            if i == 0:
-                # First condition (no preceding operator)
-                condition = token
-                conditions_with_operators.append((None, condition))
-                i += 1
-            else:
-                # Operator and condition
-                operator = token
-                condition = tokens[i + 1].strip() if i + 1 < len(tokens) else ''
-                conditions_with_operators.append((operator, condition))
-                i += 2
-
-        # List to hold filtered conditions
-        filtered_conditions = []
-        for idx, (operator, condition) in enumerate(conditions_with_operators):
-            # Check if the condition matches the pattern to remove
-            match = re.match(
-                r"\b\w+\.(class|octave|dur|interval|dots)\s*=\s*[^\s]+",
-                condition,
-                re.IGNORECASE
-            )
-            if match:
-                # Condition matches; decide whether to remove adjacent operator
-                condition_ends_with_paren = condition.endswith(')')
-                is_last_condition = idx == len(conditions_with_operators) - 1
-
-                if not condition_ends_with_paren and not is_last_condition:
-                    # Remove next operator (operator of the next condition)
-                    if idx + 1 < len(conditions_with_operators):
-                        next_operator, next_condition = conditions_with_operators[idx + 1]
-                        conditions_with_operators[idx + 1] = (None, next_condition)
-                else:
-                    # Remove previous operator (current operator)
-                    pass  # Operator is already excluded when we skip adding this condition
-                # Do not add this condition to filtered_conditions
-            else:
-                # Condition does not match; keep it
-                filtered_conditions.append((operator, condition))
-
-        membership_function_names = [membership_function_name for node_name, attribute_name, membership_function_name in attributes_with_membership_functions]
-
-        # Reconstruct the WHERE clause
-        if filtered_conditions:
-            # Build the conditions string
-            conditions = []
-            for operator, condition in filtered_conditions:
-                # Filter out membership function condition in the where clause
-                if isinstance(condition, str) and " IS " in condition:
-                    _, y = map(str.strip, condition.split(" IS ", 1))
-                    if y not in membership_function_names:
-                        conditions.append(condition)
-                else:
-                    conditions.append(condition)
-            preexisting_where_clause = ' AND '.join(conditions)
+def estimate_pitch_fractions(stats, pitch_distance, pitch, octave, alpha):
+    '''
+    Estimate the fraction of the facts satisfying the pitch condition (see `make_pitch_condition`).
+    Returns a dict attribute -> estimated fraction of the facts satisfying the condition on this attribute.
+    '''
+
+    if pitch is None:
+        return {} if octave is None else {'octave': stats.fraction('Fact', 'octave', octave)}
+
+    if pitch == 'r':
+        return {'type': stats.fraction('Fact', 'type', 'rest')}
+
+    if pitch_distance == 0:
+        base_note, accidental = split_note_accidental(pitch)
+        fractions = {'class': stats.fraction('Fact', 'class', base_note)}
+        if octave is not None:
+            fractions['octave'] = stats.fraction('Fact', 'octave', octave)
+        return fractions
+
+    low_freq_bound, high_freq_bound = find_frequency_bounds(pitch, 4 if octave is None else octave, pitch_distance, alpha)
+    return {'frequency': stats.fraction('Fact', 'frequency', low_freq_bound, high_freq_bound)}
+
+def estimate_duration_fractions(stats, duration_factor, duration, dotted, alpha):
+    '''Same as `estimate_pitch_fractions`, for the duration condition (see `make_duration_condition`).'''
+
+    if duration is None:
+        return {}
+
+    duration = 1.0 / duration
+    if dotted:
+        duration = duration * 1.5
+
+    if duration_factor != 1:
+        min_duration, max_duration = find_duration_range_multiplicative_factor_sym(duration, duration_factor, alpha)
+        return {'duration': stats.fraction('Fact', 'duration', min_duration, max_duration)}
+    return {'duration': stats.fraction('Fact', 'duration', duration)}
+
+def estimate_interval_fractions(stats, interval, pitch_distance, alpha):
+    '''
+    Same as `estimate_pitch_fractions`, for the interval condition of a NEXT relationship (see `make_interval_condition`).
+    A condition that can not use an index (a null interval) is under the key None.
+    '''
+
+    if interval == 'NA':
+        return {}
+    if interval is None:
+        return {None: stats.null_fraction('NEXT', 'interval')}
+
+    if pitch_distance > 0:
+        return {'interval': stats.fraction('NEXT', 'interval', interval - pitch_distance * (1 - alpha), interval + pitch_distance * (1 - alpha))}
+    return {'interval': stats.fraction('NEXT', 'interval', interval)}
+
+def estimate_duration_ratio_fractions(stats, duration_ratio, duration_factor, alpha):
+    '''Same as `estimate_pitch_fractions`, for the duration ratio condition of a NEXT relationship (see `make_duration_ratio_condition`).'''
+
+    if duration_ratio is None:
+        return {}
+
+    if duration_factor < 1:
+        duration_factor = 1.0 / duration_factor
+
+    if duration_factor > 1:
+        min_ratio, max_ratio = find_duration_range_multiplicative_factor_sym(duration_ratio, duration_factor, alpha)
+        return {'duration_ratio': stats.fraction('NEXT', 'duration_ratio', min_ratio, max_ratio)}
+    return {'duration_ratio': stats.fraction('NEXT', 'duration_ratio', duration_ratio)}
+
+def estimate_selectivities(query, stats):
+    '''
+    Estimate the selectivity of the conditions of the compiled query, from the corpus statistics.
+
+    - query : the fuzzy query (string or `FuzzyQuery`) ;
+    - stats : the corpus statistics (`CorpusStats`).
+
+    Returns two lists of dicts attribute -> estimated fraction of the elements satisfying the condition on this attribute :
+    one for the facts `f{idx}` of the searched notes, and one for the relationships `n{idx}` between consecutive notes.
+    The attributes are supposed independent, so the selectivity of a note is the product of its fractions.
+    '''
+
+    query = parse_fuzzy_query(query)
+    pitch_distance, duration_factor, duration_gap, alpha, allow_transposition, allow_homothety = query.fuzzy_parameters()
+
+    notes_dict = query.notes
+    if allow_transposition:
+        intervals = calculate_intervals_list(notes_dict)
+    if allow_homothety:
+        dur_ratios = calculate_dur_ratios_list(notes_dict)
+
+    f_nodes = [node for node, attrs in notes_dict.items() if attrs.get('type') == 'Fact']
+    fact_fractions = []
+    edge_fractions = [{} for _ in f_nodes[1:]]
+    for idx, f_node in enumerate(f_nodes):
+        attrs = notes_dict[f_node]
+        fractions = {}
+
+        if allow_homothety:
+            if idx < len(f_nodes) - 1:
+                edge_fractions[idx].update(estimate_duration_ratio_fractions(stats, dur_ratios[idx], duration_factor, alpha))
         else:
-            # No conditions left after filtering
-            preexisting_where_clause = ''
-    else:
-        preexisting_where_clause = ''
-    # Step 3: Extract notes and make conditions for each note
-    notes_dict = extract_notes_from_query_dict(query)
+            fractions.update(estimate_duration_fractions(stats, duration_factor, attrs.get('dur'), attrs.get('dots'), alpha))
+
+        if allow_transposition:
+            if idx < len(f_nodes) - 1:
+                edge_fractions[idx].update(estimate_interval_fractions(stats, intervals[idx], pitch_distance, alpha))
+        else:
+            fractions.update(estimate_pitch_fractions(stats, pitch_distance, attrs.get('class'), attrs.get('octave'), alpha))
+
+        fact_fractions.append(fractions)
+
+    return fact_fractions, edge_fractions
+
+def choose_anchor(query, stats):
+    '''
+    Choose the element from which the database should start to match the query : the most selective searched note,
+    or the most selective NEXT relationship (only through an index, and without duration gap as the relationships are then not matched).
+
+    - query : the fuzzy query (string or `FuzzyQuery`) ;
+    - stats : the corpus statistics (`CorpusStats`).
+
+    Returns (variable, label, attribute), where attribute is the indexed attribute to start from, or None if it has no indexed attribute.
+    Returns None if no searched note is constrained.
+    '''
+
+    query = parse_fuzzy_query(query)
+    fact_fractions, edge_fractions = estimate_selectivities(query, stats)
+
+    candidates = [] # (estimated number of elements, variable, label, attribute)
+    for idx, fractions in enumerate(fact_fractions):
+        if fractions:
+            indexed = [attribute for attribute in fractions if ('Fact', attribute) in stats.indexes]
+            attribute = min(indexed, key=fractions.get) if indexed else None
+            candidates.append((prod(fractions.values()) * stats.counts.get('Fact', 0), f'f{idx}', 'Fact', attribute))
+
+    if query.duration_gap == 0:
+        for idx, fractions in enumerate(edge_fractions):
+            indexed = [attribute for attribute in fractions if ('NEXT', attribute) in stats.indexes]
+            if indexed:
+                attribute = min(indexed, key=fractions.get)
+                candidates.append((prod(fractions.values()) * stats.counts.get('NEXT', 0), f'n{idx}', 'NEXT', attribute))
+
+    if not candidates:
+        return None
+    return min(candidates, key=lambda candidate: candidate[0])[1:]
+
+def create_using_clause(query, stats):
+    '''
+    Create the planner hint making the database start from the anchor of the query (see `choose_anchor`) :
+    `USING INDEX var:Label(attribute)` if the anchor attribute is indexed.
+    Returns an empty string if there is no anchor, or if it has no index : a label scan would be forced on the whole label,
+    so the database then plans the query itself.
+    '''
+
+    anchor = choose_anchor(query, stats)
+    if anchor is None:
+        return ''
+
+    variable, label, attribute = anchor
+    if attribute is None:
+        return ''
+    return f'\nUSING INDEX {variable}:{label}({attribute})'
+
+def create_where_clause(query, allow_transposition, allow_homothety, pitch_distance, duration_factor, duration_gap, alpha = 0.0, params=None, skip_max_gap=None, stats=None):
+    '''
+    Create the WHERE clause for the compiled query.
+
+    If the corpus statistics (`stats`) are given, the conditions on the searched notes are written
+    from the most selective to the least one (see `estimate_selectivities`), so that the database
+    discards the rows as soon as possible. Otherwise, they are written note by note.
+    '''
+
+    query = parse_fuzzy_query(query)
+
+    # Attributes associated with membership functions
+    attributes_with_membership_functions = query.attributes_with_membership_functions
+
+    # Step 1: Remove conditions that specify specific attribute values or membership functions
+    conditions = []
+    for condition in query.conditions:
+        # Values of the searched notes are handled below (Step 2)
+        if condition.operator == '=' and condition.attribute.lower() in ('class', 'octave', 'dur', 'interval', 'dots'):
+            continue
+
+        # Membership function conditions are handled with their support (Step 3)
+        if condition.membership_function is not None:
+            continue
+
+        conditions.append(condition.text)
+    preexisting_where_clause = ' AND '.join(conditions)
+
+    # Step 2: Make conditions for each note
+    notes_dict = query.notes
 
     where_clauses = []
+    selectivities = [] # Estimated fraction of the rows kept by each condition of `where_clauses` (1 without `stats`)
+
+    def add_condition(condition, estimate_fractions=None):
+        if condition:
+            where_clauses.append(condition)
+            if stats is None or estimate_fractions is None:
+                selectivities.append(1.0)
+            else:
+                selectivities.append(prod(estimate_fractions().values()))
+
     if allow_transposition:
         intervals = calculate_intervals_list(notes_dict)
     if allow_homothety:
@@ -383,48 +537,48 @@ def create_where_clause(query, allow_transposition, allow_homothety, pitch_dista
 
         if allow_homothety:
             if idx < len(f_nodes) - 1:
-                duration_ratio_condition = make_duration_ratio_condition(dur_ratios[idx], duration_gap, duration_factor, idx, alpha)
-                if duration_ratio_condition:
-                    where_clauses.append(duration_ratio_condition)
+                duration_ratio_condition = make_duration_ratio_condition(dur_ratios[idx], duration_gap, duration_factor, idx, alpha, params)
+                add_condition(duration_ratio_condition, lambda: estimate_duration_ratio_fractions(stats, dur_ratios[idx], duration_factor, alpha))
         else:
-            duration_condition = make_duration_condition(duration_factor, duration, f_node, alpha, attrs.get('dots'))
-            if duration_condition:
-                where_clauses.append(duration_condition)
+            duration_condition = make_duration_condition(duration_factor, duration, f_node, alpha, attrs.get('dots'), idx, params)
+            add_condition(duration_condition, lambda: estimate_duration_fractions(stats, duration_factor, duration, attrs.get('dots'), alpha))
         
         if allow_transposition:
             if idx < len(f_nodes) - 1:
-                interval_condition = make_interval_condition(intervals[idx], duration_gap, pitch_distance, idx, alpha)
-                if interval_condition:
-                    where_clauses.append(interval_condition)
+                interval_condition = make_interval_condition(intervals[idx], duration_gap, pitch_distance, idx, alpha, params)
+                add_condition(interval_condition, lambda: estimate_interval_fractions(stats, intervals[idx], pitch_distance, alpha))
         else:
-            pitch_condition = make_pitch_condition(pitch_distance, attrs.get('class'), attrs.get('octave'), f_node, alpha)
-            if pitch_condition:
-                where_clauses.append(pitch_condition)
+            pitch_condition = make_pitch_condition(pitch_distance, attrs.get('class'), attrs.get('octave'), f_node, alpha, idx, params)
+            add_condition(pitch_condition, lambda: estimate_pitch_fractions(stats, pitch_distance, attrs.get('class'), attrs.get('octave'), alpha))
         
 
 
         if duration_gap > 0:
             if idx < len(f_nodes) - 1:
-                sequencing_condition = make_sequencing_condition(duration_gap, f'e{idx}', f'e{idx+1}', alpha)
-                if sequencing_condition:
-                    where_clauses.append(sequencing_condition)
+                sequencing_condition = make_sequencing_condition(duration_gap, f'e{idx}', f'e{idx+1}', alpha, idx, params)
+                add_condition(sequencing_condition)
+                if uses_skip_edges(duration_gap, skip_max_gap):
+                    add_condition(make_skip_condition(duration_gap, idx, alpha, params))
 
-    # Step 4: makes conditions for membership functions
-    # Extract support intervals of the membership functions
-    support_intervals = extract_membership_function_support_intervals(query)
+    # Step 3: makes conditions for membership functions
+    # Support intervals of the membership functions
+    support_intervals = query.membership_function_support_intervals()
 
     # For each attribute associated with a membership function, add a condition to ensure the attribute is within the support interval
-    for node_name, attribute_name, membership_function_name in attributes_with_membership_functions:
+    for k, (node_name, attribute_name, membership_function_name) in enumerate(attributes_with_membership_functions):
         # Get the support interval for the membership function
         min_value, max_value = support_intervals[membership_function_name]
 
         # Add condition for minimum value if it's greater than negative infinity
         if min_value != float('-inf'):
-            where_clauses.append(f"{node_name}.{attribute_name} > {min_value}")
+            add_condition(f"{node_name}.{attribute_name} > {make_parameter(min_value, f'm{k}_low', params)}")
 
         # Add condition for maximum value if it's less than positive infinity
         if max_value != float('inf'):
-            where_clauses.append(f"{node_name}.{attribute_name} < {max_value}")
+            add_condition(f"{node_name}.{attribute_name} < {make_parameter(max_value, f'm{k}_high', params)}")
+
+    # Most selective conditions first (the sort is stable, so the order is unchanged without statistics)
+    where_clauses = [where_clauses[i] for i in sorted(range(len(where_clauses)), key=selectivities.__getitem__)]
 
     if preexisting_where_clause:
         preexisting_where_clause = preexisting_where_clause + ' AND\n'
@@ -436,6 +590,7 @@ def create_return_clause(query, notes_dict, duration_gap, intervals, allow_homot
     Create the RETURN clause for the compiled query.
 
     Parameters:
+        - query        : the fuzzy query (string or `FuzzyQuery`).
         - notes_dict   : dictionary of nodes and their attributes, as returned by `extract_notes_from_query`.
         - duration_gap : the duration gap. Used only when `intervals` is True.
         - intervals    : indicates if the return clause is for a query that allows transposition or contour match.
@@ -488,8 +643,8 @@ def create_return_clause(query, notes_dict, duration_gap, intervals, allow_homot
         f"{last_event_node_name}.end AS end"
     ])
     
-    # Extract attributes associated with membership functions
-    attributes_with_membership_functions = extract_attributes_with_membership_functions(query)
+    # Attributes associated with membership functions
+    attributes_with_membership_functions = parse_fuzzy_query(query).attributes_with_membership_functions
     
     # Collect existing return items to prevent duplicates
     existing_return_items = set(return_clauses)
@@ -505,34 +660,242 @@ def create_return_clause(query, notes_dict, duration_gap, intervals, allow_homot
     
     return return_clause
 
-def reformulate_fuzzy_query(query):
+def make_record_semitone_expression(name):
+    '''Cypher expression of the semitone distance from C of the pitch class of the node `name` (null if unknown).'''
+
+    cases = ' '.join(f"WHEN '{spelling}' THEN {semitone}" for spelling, semitone in RECORD_PITCH_CLASSES.items())
+    return f"CASE {name}.class {cases} END"
+
+def make_pitch_degree_expression(pitch_distance, pitch, octave, name, record_semitone, idx=0, params=None):
+    '''
+    Cypher expression of `pitch_degree(pitch, octave, name.class, name.octave, pitch_distance)`.
+    Returns None if the degree does not depend on the record.
+
+    - record_semitone : the variable holding `make_record_semitone_expression(name)`.
+    '''
+
+    if pitch is None and octave is None:
+        return None
+
+    if octave is None:
+        octave_distance = '0.0'
+    else:
+        octave = make_parameter(octave, f'p{idx}_octave', params)
+        octave_distance = f"CASE WHEN {name}.octave IS NULL THEN 0.0 ELSE 6.0 * abs({name}.octave - {octave}) END"
+
+    if pitch is None:
+        distance = octave_distance
+    else:
+        semitone = make_parameter(SEMITONES_FROM_C[convert_note_to_sharp(pitch)], f'p{idx}_semitone', params)
+        if octave is None: # The octave of the query note is the one of the record
+            distance = f"CASE WHEN {record_semitone} IS NULL THEN 0.0 ELSE abs({record_semitone} - {semitone}) / 2.0 END"
+        else:
+            distance = (
+                f"CASE WHEN {record_semitone} IS NULL THEN {octave_distance} "
+                f"WHEN {name}.octave IS NULL THEN abs({record_semitone} - {semitone}) / 2.0 "
+                f"ELSE abs({record_semitone} + 12 * {name}.octave - {semitone} - 12 * {octave}) / 2.0 END"
+            )
+
+    return f"1 - ({distance}) / {make_parameter(pitch_distance, 'pitch_distance', params)}"
+
+def make_interval_degree_expression(interval, duration_gap, pitch_distance, idx, params=None):
+    '''
+    Cypher expression of `pitch_degree_with_intervals(interval, interval_{idx}, pitch_distance)`.
+    Returns None if the degree does not depend on the record (unknown interval in the query).
+    '''
+
+    if interval is None or interval == 'NA':
+        return None
+
+    if duration_gap > 0:
+        record_interval = f"toFloat(f{idx + 1}.halfTonesFromA4 - f{idx}.halfTonesFromA4)/2"
+    else:
+        record_interval = f"toFloat(n{idx}.interval)"
+
+    interval = make_parameter(interval, f'i{idx}', params)
+    return f"1 - abs({record_interval} - {interval}) / {make_parameter(pitch_distance, 'pitch_distance', params)}"
+
+def make_duration_degree_expression(duration_factor, expected_duration, record_duration, name, params=None):
+    '''
+    Cypher expression of `duration_degree_with_multiplicative_factor(expected_duration, record_duration, duration_factor)`.
+
+    - expected_duration : the text of the expected duration (or duration ratio) ;
+    - record_duration   : the text of the duration (or duration ratio) of the record ;
+    - name              : the name of the parameter of `expected_duration`.
+    '''
+
+    a = -1 / (duration_factor - 1)
+    b = 1 - a
+    expected_duration = make_parameter(expected_duration, name, params)
+    a = make_parameter(a, 'duration_a', params)
+    b = make_parameter(b, 'duration_b', params)
+
+    z = (
+        f"CASE WHEN {expected_duration} / {record_duration} > {record_duration} / {expected_duration} "
+        f"THEN {expected_duration} / {record_duration} ELSE {record_duration} / {expected_duration} END"
+    )
+    return f"{a} * ({z}) + {b}"
+
+def make_sequencing_degree_expression(duration_gap, name_1, name_2, params=None):
+    '''Cypher expression of `sequencing_degree(name_1.end, name_2.start, duration_gap)`.'''
+
+    return f"1 - toFloat({name_2}.start - {name_1}.end) / {make_parameter(duration_gap, 'duration_gap', params)}"
+
+def make_membership_degree_expression(function, value, k, params=None):
+    '''
+    Cypher expression of the membership function `function` (a `MembershipFunction`), applied to `value` (a text).
+
+    - k : the index of the attribute, used to name the parameters.
+    '''
+
+    parameters = [make_parameter(parameter, f'm{k}_{j}', params) for j, parameter in enumerate(function.parameters)]
+
+    if function.kind == 'DEFINETRAP':
+        a_minus, a, b, b_plus = parameters
+        return (
+            f"CASE WHEN {value} < {a_minus} OR {value} > {b_plus} THEN 0.0 "
+            f"WHEN {value} < {a} THEN toFloat({value} - {a_minus}) / ({a} - {a_minus}) "
+            f"WHEN {value} <= {b} THEN 1.0 "
+            f"ELSE toFloat({b_plus} - {value}) / ({b_plus} - {b}) END"
+        )
+
+    gamma, delta = parameters
+    if function.kind == 'DEFINEASC':
+        return f"CASE WHEN {value} < {gamma} THEN 0.0 WHEN {value} <= {delta} THEN toFloat({value} - {gamma}) / ({delta} - {gamma}) ELSE 1.0 END"
+    return f"CASE WHEN {value} < {gamma} THEN 1.0 WHEN {value} <= {delta} THEN toFloat({delta} - {value}) / ({delta} - {gamma}) ELSE 0.0 END"
+
+def create_degree_clause(query, params=None):
+    '''
+    Create the WITH clause computing the degree of each match on the server, with the same
+    degrees as `get_ordered_results_2` (pitch or interval, duration or duration ratio, sequencing and
+    membership degrees, aggregated with min), and keeping only the matches with a degree of at least alpha.
+
+    - query  : the fuzzy query (string or `FuzzyQuery`) ;
+    - params : the query parameters (see `make_parameter`).
+    '''
+
+    query = parse_fuzzy_query(query)
+    pitch_distance, duration_factor, duration_gap, alpha, allow_transposition, allow_homothety = query.fuzzy_parameters()
+
+    notes_dict = query.notes
+    event_nodes = [node_name for node_name, attrs in notes_dict.items() if attrs.get('type') == 'Event']
+    fact_nodes = [node_name for node_name, attrs in notes_dict.items() if attrs.get('type') == 'Fact']
+
+    if allow_transposition:
+        intervals = calculate_intervals_list(notes_dict)
+    if allow_homothety:
+        dur_ratios = calculate_dur_ratios_list(notes_dict)
+
+    degrees = []
+    semitones = [] # Semitone of the pitch class of the facts, computed once for each fact in a first WITH
+    for idx, f_node in enumerate(fact_nodes):
+        attrs = notes_dict[f_node]
+
+        # Pitch or interval degree
+        if pitch_distance > 0:
+            if allow_transposition:
+                if idx > 0:
+                    degrees.append(make_interval_degree_expression(intervals[idx - 1], duration_gap, pitch_distance, idx - 1, params))
+            elif 'class' in attrs and 'octave' in attrs:
+                record_semitone = f'semitone_{idx}'
+                degrees.append(make_pitch_degree_expression(pitch_distance, attrs['class'], attrs['octave'], f_node, record_semitone, idx, params))
+                if attrs['class'] is not None:
+                    semitones.append(f"{make_record_semitone_expression(f_node)} AS {record_semitone}")
+
+        # Duration or duration ratio degree
+        if duration_factor != 1 and attrs.get('dur') is not None:
+            if allow_homothety:
+                if idx > 0 and dur_ratios[idx - 1] is not None:
+                    if duration_gap > 0:
+                        record_ratio = f"(toFloat(f{idx}.duration) / toFloat(f{idx - 1}.duration))"
+                    else:
+                        record_ratio = f"toFloat(n{idx - 1}.duration_ratio)"
+                    degrees.append(make_duration_degree_expression(duration_factor, dur_ratios[idx - 1], record_ratio, f'r{idx - 1}', params))
+            else:
+                expected_duration = 1.0 / attrs['dur']
+                if attrs.get('dots'):
+                    expected_duration *= 1.5
+                degrees.append(make_duration_degree_expression(duration_factor, expected_duration, f"toFloat({event_nodes[idx]}.duration)", f'd{idx}', params))
+
+        # Sequencing degree
+        if duration_gap > 0 and idx > 0:
+            degrees.append(make_sequencing_degree_expression(duration_gap, event_nodes[idx - 1], event_nodes[idx], params))
+
+    # Membership functions degrees
+    for k, (node_name, attribute_name, membership_function_name) in enumerate(query.attributes_with_membership_functions):
+        function = query.membership_functions[membership_function_name]
+        degrees.append(make_membership_degree_expression(function, f"{node_name}.{attribute_name}", k, params))
+
+    degrees = [degree for degree in degrees if degree is not None]
+
+    # Min-aggregation. A negative degree counts as 0 (as with `max(d, 0)`), and a null one (missing attribute) is ignored.
+    degree_list = ',\n  '.join(degrees)
+    with_clause = ''
+    if semitones:
+        with_clause += '\nWITH *, ' + ',\n '.join(semitones)
+    if degrees:
+        with_clause += (
+            f"\nWITH *, reduce(degree = 1.0, d IN [\n  {degree_list}\n ] | "
+            f"CASE WHEN d < 0 THEN 0.0 WHEN d < degree THEN d ELSE degree END) AS degree"
+        )
+    else:
+        with_clause += '\nWITH *, 1.0 AS degree'
+    with_clause += f"\nWHERE degree >= {make_parameter(alpha, 'alpha', params)}"
+    return with_clause
+
+def reformulate_fuzzy_query(query, params=None, rank_on_server=False, top_k=None, skip_max_gap=None, stats=None):
     '''
     Converts a fuzzy query to a cypher one.
 
-    - query : the fuzzy query.
+    - query  : the fuzzy query (string or `FuzzyQuery`) ;
+    - params : if a dict is given, the values computed from the searched notes (pitch / duration bounds, intervals, ...)
+               are not inlined but written as parameters (`$p0_low`, ...), whose values are added to `params`.
+               The result must then be sent with these parameters (see `run_query`) ;
+    - rank_on_server : if True, the degree of each match is computed by the database (see `create_degree_clause`).
+                       Only the matches with a degree of at least alpha are returned, with their `degree`, best first ;
+    - top_k          : with `rank_on_server`, return only the `top_k` best matches ;
+    - skip_max_gap   : the maximum gap of the SKIP relationships of the database (see `skip_edges`), or None if there are none.
+                       Queries with a duration gap up to `skip_max_gap` use them (see `create_match_clause`) ;
+    - stats          : the corpus statistics (`CorpusStats`, see `corpus_stats`). If given, a planner hint makes the database start
+                       from the most selective searched note (see `choose_anchor`), and the most selective conditions are written first.
     '''
 
-    query = move_attribute_values_to_where_clause(query)
+    if top_k is not None and not rank_on_server:
+        raise ValueError('reformulate_fuzzy_query: top_k can only be used with rank_on_server')
 
     #------Init
+    #---Parse the query once (attribute values of the MATCH clause are moved to the conditions)
+    query = parse_fuzzy_query(query)
+
     #---Extract the parameters from the augmented query
-    pitch_distance, duration_factor, duration_gap, alpha, allow_transposition, allow_homothety = extract_fuzzy_parameters(query)
+    pitch_distance, duration_factor, duration_gap, alpha, allow_transposition, allow_homothety = query.fuzzy_parameters()
 
-    #---Extract notes using the new function
-    notes = extract_notes_from_query_dict(query)
+    #---Extract notes
+    notes = query.notes
     
     #------Construct the MATCH clause
-    match_clause = create_match_clause(query)
+    match_clause = create_match_clause(query, skip_max_gap)
+    if stats is not None:
+        match_clause += create_using_clause(query, stats)
 
     #------Construct the WHERE clause
-    where_clause = create_where_clause(query, allow_transposition, allow_homothety, pitch_distance, duration_factor, duration_gap, alpha)
+    where_clause = create_where_clause(query, allow_transposition, allow_homothety, pitch_distance, duration_factor, duration_gap, alpha, params, skip_max_gap, stats)
 
     #------Construct the return clause
     return_clause = create_return_clause(query, notes, duration_gap, allow_transposition, allow_homothety)
     
+    #------Construct the degree clause and the ordering
+    if rank_on_server:
+        degree_clause = create_degree_clause(query, params)
+        return_clause += ', \ndegree\nORDER BY degree DESC'
+        if top_k is not None:
+            return_clause += f"\nLIMIT {make_parameter(top_k, 'k', params)}"
+    else:
+        degree_clause = ''
+
     # ------Construct the final query
     # new_query = match_clause + '\n' + with_clause + where_clause + col_clause + '\n' + return_clause
-    new_query = match_clause  + where_clause + return_clause
+    new_query = match_clause  + where_clause + degree_clause + return_clause
     return new_query.strip('\n')
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+from neo4j_connection import run_query
+from reformulation_V3 import get_max_hops
+
+# Queries of the enrichment. The SKIP relationships of a source are rebuilt at once.
+SOURCES_QUERY = 'MATCH (e:Event) RETURN DISTINCT e.source AS source'
+DELETE_SKIP_EDGES_QUERY = 'MATCH (:Event {source: $source})-[s:SKIP]->() DELETE s'
+CREATE_SKIP_EDGES_QUERY = '''
+MATCH p = (a:Event {{source: $source}})-[:NEXT*2..{max_hops}]->(b:Event)
+WHERE b.start - a.end <= $max_gap
+CREATE (a)-[:SKIP {{gap: b.start - a.end, hops: length(p)}}]->(b)
+RETURN count(*) AS nb_edges
+'''
+# The `SkipEdges` node records the maximum gap of the relationships, and the sources already enriched
+SET_MAX_GAP_QUERY = 'MERGE (m:SkipEdges) SET m.max_gap = $max_gap, m.sources = $sources'
+GET_MAX_GAP_QUERY = 'MATCH (m:SkipEdges) RETURN m.max_gap AS max_gap, m.sources AS sources'
+
+def create_skip_edges(driver, max_gap, sources=None, verbose=False):
+    '''
+    Create the SKIP relationships of the database : for each event, a relationship `(a)-[:SKIP {gap, hops}]->(b)`
+    to each event `b` of its voice, two events further or more, starting at most `max_gap` after the end of `a`
+    (`gap` is `b.start - a.end`, and `hops` the number of NEXT relationships from `a` to `b`).
+
+    With them, queries with a duration gap up to `max_gap` link two consecutive searched events by one NEXT or SKIP
+    relationship instead of a variable-length NEXT path (see `create_match_clause`, and the `--skip-max-gap` option).
+    As with NEXT*1..k, only the events up to `get_max_hops(max_gap)` NEXT relationships further are linked.
+
+    - driver    : the neo4j driver (or connection manager) ;
+    - max_gap   : the maximum gap of the relationships (same unit as the duration gap of the queries) ;
+    - sources   : the sources to enrich. If None, all the sources of the database. Sources can only be added
+                  with the maximum gap of the sources already enriched (see `update_skip_edges`) ;
+    - verbose   : if True, prints the number of relationships created for each source.
+
+    Returns the number of SKIP relationships created.
+    '''
+
+    if max_gap <= 0:
+        raise ValueError(f'create_skip_edges: max_gap must be positive, got {max_gap}')
+
+    enriched_sources = set()
+    if sources is None:
+        sources = [record['source'] for record in run_query(driver, SOURCES_QUERY, read_only=True)]
+    else:
+        current_max_gap, enriched_sources = get_skip_edges_marker(driver)
+        if current_max_gap is not None and current_max_gap != max_gap:
+            raise ValueError(f'create_skip_edges: the database is enriched with a maximum gap of {current_max_gap}, enrich all the sources to change it to {max_gap}')
+
+    query = CREATE_SKIP_EDGES_QUERY.format(max_hops=get_max_hops(max_gap))
+    nb_edges = 0
+    for source in sources:
+        run_query(driver, DELETE_SKIP_EDGES_QUERY, {'source': source})
+        nb_source_edges = run_query(driver, query, {'source': source, 'max_gap': max_gap})[0]['nb_edges']
+        nb_edges += nb_source_edges
+        if verbose:
+            print(f'{source} : {nb_source_edges} SKIP relationships')
+
+    run_query(driver, SET_MAX_GAP_QUERY, {'max_gap': max_gap, 'sources': sorted(enriched_sources | set(sources))})
+    return nb_edges
+
+def get_skip_edges_marker(driver):
+    '''Return the maximum gap of the SKIP relationships of the database and the set of the enriched sources, or (None, empty set) if there are none.'''
+
+    records = run_query(driver, GET_MAX_GAP_QUERY, read_only=True)
+    if not records:
+        return None, set()
+    return records[0]['max_gap'], set(records[0]['sources'] or ())
+
+def get_skip_max_gap(driver):
+    '''Return the maximum gap of the SKIP relationships of the database (see `create_skip_edges`), or None if there are none.'''
+
+    return get_skip_edges_marker(driver)[0]
+
+def update_skip_edges(driver, verbose=False):
+    '''
+    Create the SKIP relationships of the sources added since the enrichment (e.g by `execute_cypher_dumps`),
+    with the maximum gap of the database. Does nothing if the database has no SKIP relationships.
+
+    Returns the number of SKIP relationships created.
+    '''
+
+    max_gap, enriched_sources = get_skip_edges_marker(driver)
+    if max_gap is None:
+        return 0
+
+    sources = [record['source'] for record in run_query(driver, SOURCES_QUERY, read_only=True)]
+    new_sources = [source for source in sources if source not in enriched_sources]
+    if not new_sources:
+        return 0
+
+    return create_skip_edges(driver, max_gap, new_sources, verbose)
+
+def check_skip_max_gap(driver, skip_max_gap):
+    '''
+    Check that queries compiled with `skip_max_gap` (see `create_match_clause`) can use the SKIP relationships of the database :
+    with a larger gap than the one of the enrichment, the matches spanning more than one NEXT relationship would be lost.
+    Raises a ValueError otherwise.
+    '''
+
+    if skip_max_gap is None:
+        return
+
+    max_gap = get_skip_max_gap(driver)
+    if max_gap is None:
+        raise ValueError('the database has no SKIP relationships : run the enrich mode before using --skip-max-gap')
+    if skip_max_gap > max_gap:
+        raise ValueError(f'--skip-max-gap {skip_max_gap} is larger than the maximum gap of the SKIP relationships of the database ({max_gap})')
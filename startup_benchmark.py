@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Measures the startup time of each subcommand of `main_parser.py`, and checks that the light ones
+(write, compile) do not import the heavy dependencies (neo4j driver, numpy, pydub, matplotlib).
+
+Usage : python3 startup_benchmark.py [-n NB_RUNS]
+'''
+
+##-Imports
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+##-Init
+MAIN_PARSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main_parser.py')
+
+# Top-level packages that must only be imported by the subcommands that need them
+HEAVY_MODULES = ('neo4j', 'numpy', 'pydub', 'matplotlib')
+
+NOTES = "[[('c', 5), 4], [('d', 5), 8], [('e', 5), 8, 1]]"
+
+##-Functions
+def run_with_import_time(args):
+    '''
+    Run `python3 -X importtime args`.
+
+    Returns (wall time in seconds, cumulative import time in seconds, set of the top-level packages imported).
+    '''
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, capture_output=True, text=True)
+    wall_time = time.perf_counter() - start
+
+    import_time = 0
+    packages = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '): # Top-level import (only those are summed, as the cumulative time includes the nested ones)
+            import_time += int(cumulative)
+        packages.add(name.strip().split('.')[0])
+
+    return wall_time, import_time / 1e6, packages
+
+def benchmark(nb_runs=5):
+    '''
+    Benchmark the startup of each subcommand.
+
+    - nb_runs : the number of runs of each subcommand (the minimum time is kept).
+
+    Returns a list of (name, wall time, import time, heavy modules imported, heavy modules allowed).
+    '''
+
+    query = subprocess.run([sys.executable, MAIN_PARSER, 'write', NOTES, '-p', '1'], capture_output=True, text=True).stdout
+
+    # (name, arguments, heavy modules allowed)
+    # The subcommands using the database are run with -h (the database may not be available),
+    # and the imports done when they run are measured separately.
+    cases = [
+        ('write', [MAIN_PARSER, 'write', NOTES], ()),
+        ('compile', [MAIN_PARSER, 'compile', query], ()),
+        ('send -h', [MAIN_PARSER, 'send', '-h'], ()),
+        ('get -h', [MAIN_PARSER, 'get', '-h'], ()),
+        ('list -h', [MAIN_PARSER, 'list', '-h'], ()),
+        ('serve -h', [MAIN_PARSER, 'serve', '-h'], ()),
+        ('export -h', [MAIN_PARSER, 'export', '-h'], ()),
+        ('enrich -h', [MAIN_PARSER, 'enrich', '-h'], ()),
+        ('stats -h', [MAIN_PARSER, 'stats', '-h'], ()),
+        ('estimate -h', [MAIN_PARSER, 'estimate', '-h'], ()),
+        ('send (imports)', ['-c', 'import sys; sys.path.insert(0, sys.argv[1]); import main_parser, process_results, neo4j', os.path.dirname(MAIN_PARSER)], ('neo4j', 'numpy')),
+        ('send -m (imports)', ['-c', 'import sys; sys.path.insert(0, sys.argv[1]); import main_parser, process_results, generate_audio, neo4j', os.path.dirname(MAIN_PARSER)], ('neo4j', 'numpy', 'pydub')),
+    ]
+
+    results = []
+    for name, args, allowed in cases:
+        runs = [run_with_import_time(args) for _ in range(nb_runs)]
+        wall_time = min(run[0] for run in runs)
+        import_time = min(run[1] for run in runs)
+        heavy = sorted(set(HEAVY_MODULES) & runs[0][2])
+        results.append((name, wall_time, import_time, heavy, allowed))
+
+    return results
+
+##-Run
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the startup time of the subcommands of main_parser.py')
+    parser.add_argument('-n', '--nb-runs', type=int, default=5, help='number of runs of each subcommand. Default is 5.')
+    args = parser.parse_args()
+
+    errors = 0
+    print(f'{"subcommand":<20} {"wall (ms)":>10} {"imports (ms)":>13}  heavy modules')
+    for name, wall_time, import_time, heavy, allowed in benchmark(args.nb_runs):
+        unexpected = [module for module in heavy if module not in allowed]
+        errors += len(unexpected)
+        print(f'{name:<20} {wall_time * 1000:>10.1f} {import_time * 1000:>13.1f}  {", ".join(heavy) or "-"}{"  <- unexpected: " + ", ".join(unexpected) if unexpected else ""}')
+
+    sys.exit(1 if errors else 0)
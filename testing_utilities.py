@@ -287,6 +287,32 @@ def execute_queries_v2(test_name, sequences, pattern_length, suffix=None):
         print(f"Running command: {command}")
         subprocess.run(command, shell=True)
 
+def execute_queries_async(test_name, sequences, pattern_length, suffix=None, max_concurrency=8,
+                          uri="bolt://localhost:7687", user="neo4j", password="12345678"):
+    '''
+    Same as `execute_queries_v2`, but the queries are sent concurrently from this process
+    (at most `max_concurrency` at once, see `async_queries.send_many`), instead of one `send` command after another.
+
+    Returns the total time (in seconds) and the list of the results (or exceptions), in the order of `sequences`.
+    '''
+    from query_cache import QueryCache
+    from async_queries import send_many
+
+    dir_path = f"./queries/test_queries/{test_name}/"
+    queries = []
+    for seq_index, sequence in enumerate(sequences):
+        if suffix:
+            query_file = f"{test_name}_{suffix}_len_{pattern_length}_seq_{seq_index + 1}.cypher"
+        else:
+            query_file = f"{test_name}_len_{pattern_length}_seq_{seq_index + 1}.cypher"
+        with open(f"{dir_path}{query_file}", "r") as file:
+            queries.append(file.read())
+
+    print(f"Running {len(queries)} queries ({max_concurrency} at once)")
+    start = time.perf_counter()
+    results = send_many(QueryCache(), uri, user, password, queries, max_concurrency, fuzzy=True)
+    return time.perf_counter() - start, results
+
 def process_and_generate_latex(test_name, param_values, max_length, nb_sequences):
     """
     Génère du code LaTeX pour les temps totaux et les temps d'exécution à partir d'un fichier CSV.
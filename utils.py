@@ -1,5 +1,4 @@
 from neo4j_connection import connect_to_neo4j, run_query
-from generate_audio import generate_mp3
 from degree_computation import convert_note_to_sharp
 from note import Note
 from refactor import move_attribute_values_to_where_clause
@@ -187,6 +186,23 @@ def create_query_from_contour(contour, incipit_only, collection=None):
 
     return move_attribute_values_to_where_clause(query)
 
+def list_available_songs(driver, collection=None):
+    '''
+    Return a list of all the available songs.
+
+    - driver     : the neo4j connection driver ;
+    - collection : List only scores for the given collection. If `None`, list for all.
+    '''
+
+    if collection == None:
+        query = 'MATCH (s:Score) RETURN DISTINCT s.source AS source'
+    else:
+        query = f'MATCH (s:Score) WHERE s.collection CONTAINS "{collection}" RETURN DISTINCT s.source AS source'
+
+    result = run_query(driver, query, read_only=True)
+
+    return [record['source'] for record in result]
+
 def get_first_k_notes_of_each_score(k, source, driver):
     # In : an integer, a driver for the DB
     # Out : a crisp query returning the sequences of k first notes for each score in the DB
@@ -220,7 +236,7 @@ def get_first_k_notes_of_each_score(k, source, driver):
     query = match_clause + where_clause + return_clause
     
     # Run the query
-    results = run_query(driver, query)
+    results = run_query(driver, query, read_only=True)
 
     # Process the results
     sequences = []
@@ -241,6 +257,8 @@ def get_first_k_notes_of_each_score(k, source, driver):
     return sequences[0]
 
 def generate_mp3_from_source_and_time_interval(driver, source, start_time, end_time, bpm=60):
+    from generate_audio import generate_mp3 # pydub is only needed here
+
     notes = get_notes_from_source_and_time_interval(driver, source, start_time, end_time)
     file_name = f"{source}_{start_time}_{end_time}.mp3"
     generate_mp3(notes, file_name, bpm)
@@ -256,7 +274,7 @@ def get_notes_from_source_and_time_interval(driver, source, start_time, end_time
     ORDER BY e.start
     """  
 
-    results = run_query(driver, query)
+    results = run_query(driver, query, read_only=True)
     notes = [Note(record['class'], record['octave'], record['dur'], record['dots'], None, record['start'], record['end']) for record in results]
 
     return notes
@@ -384,7 +402,7 @@ def calculate_dur_ratios_list(notes_dict: dict) -> list[float]:
     
     return dur_ratios
 
-def execute_cypher_dumps(directory_path: str, uri: str, user: str, password: str, verbose: bool = False):
+def execute_cypher_dumps(directory_path: str, uri: str, user: str, password: str, verbose: bool = False, corpus_path: str = None, stats_path: str = None):
     '''
     Executes all .cypher dump files in the specified directory one by one.
 
@@ -392,7 +410,9 @@ def execute_cypher_dumps(directory_path: str, uri: str, user: str, password: str
     - uri            : Neo4j database URI (e.g., "bolt://localhost:7687");
     - user           : database username;
     - password       : database password;
-    - verbose        : if True, prints execution logs.
+    - verbose        : if True, prints execution logs;
+    - corpus_path    : if given, the new sources are then appended to the local corpus in this directory (see `update_corpus`);
+    - stats_path     : if given, the new sources are then added to the statistics of this file (see `update_stats`).
     '''
 
     # Check if the directory exists
@@ -427,6 +447,25 @@ def execute_cypher_dumps(directory_path: str, uri: str, user: str, password: str
 
     print("All Cypher dump files have been executed successfully.")
 
+    # The new sources get their SKIP relationships, if the database has some (see `skip_edges`)
+    from skip_edges import update_skip_edges
+
+    nb_edges = update_skip_edges(driver, verbose)
+    if nb_edges:
+        print(f'{nb_edges} SKIP relationships created for the new sources')
+
+    if corpus_path is not None:
+        from corpus_engine import update_corpus # numpy is only needed here
+
+        corpus = update_corpus(corpus_path, driver)
+        print(f'{corpus} written to {corpus_path}')
+
+    if stats_path is not None:
+        from corpus_stats import update_stats
+
+        stats = update_stats(stats_path, driver)
+        print(f'{stats} written to {stats_path}')
+
 
 if __name__ == "__main__":
     # Set up a driver just to clear the cache